@@ -0,0 +1,236 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional, Tuple
+
+from telegram.ext import BaseRateLimiter
+
+from metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограммы задержек Bot API (секунды)
+API_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Функция бота, от имени которой идут запросы к API (наследуется задачами asyncio)
+current_feature: ContextVar[str] = ContextVar('api_feature', default='other')
+
+# Методы только для чтения: одинаковые одновременные запросы можно объединять
+READ_METHODS = frozenset({
+    'getMe', 'getChat', 'getChatAdministrators', 'getChatMember', 'getChatMemberCount',
+    'getWebhookInfo', 'getMyCommands', 'getUserProfilePhotos', 'getFile',
+})
+
+
+def api_feature(name: str):
+    """Декоратор: все запросы к API внутри функции учитываются на функцию name"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_feature.set(name)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                current_feature.reset(token)
+        return wrapper
+    return decorator
+
+
+class _CallStats:
+    __slots__ = ('calls', 'shared', 'errors', 'total_time', 'latencies')
+
+    def __init__(self, samples: int):
+        self.calls = 0
+        self.shared = 0  # запросы, получившие результат уже выполняющегося такого же запроса
+        self.errors: Counter = Counter()
+        self.total_time = 0.0
+        self.latencies: Deque[float] = deque(maxlen=samples)  # последние задержки для перцентилей
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+class ApiCallMonitor(BaseRateLimiter):
+    """Учет всех вызовов Bot API.
+
+    Подключается к боту как rate_limiter, поэтому через него проходит каждый
+    запрос бота (context.bot.*, очередь исходящих сообщений, одобрения). Сам
+    ничего не ограничивает - только измеряет длительность и считает ошибки
+    по методам API и функциям бота (см. api_feature).
+
+    Одинаковые одновременные запросы методов чтения (READ_METHODS с теми же
+    параметрами) не дублируются: пока первый запрос выполняется, остальные
+    ждут его и получают тот же ответ (или ту же ошибку).
+
+    Кроме метрик Prometheus ведется оконная статистика для отчета: количество
+    вызовов, ошибки по классам и перцентили задержки по последним samples вызовам.
+    """
+
+    def __init__(self, metrics: MetricsRegistry, samples: int = 1000):
+        self.samples = samples
+        self.duration = metrics.histogram(
+            'bot_api_request_duration_seconds', 'Длительность запросов к Bot API',
+            ('method', 'feature'), API_BUCKETS
+        )
+        self.errors = metrics.counter(
+            'bot_api_errors_total', 'Ошибки запросов к Bot API по классу ошибки', ('method', 'feature', 'error')
+        )
+        self.shared = metrics.counter(
+            'bot_api_shared_total', 'Запросы, объединенные с таким же выполняющимся запросом', ('method', 'feature')
+        )
+        self._inflight: Dict[Tuple, asyncio.Future] = {}  # (метод, параметры) -> выполняющийся запрос
+        self._window: Dict[Tuple[str, str], _CallStats] = {}  # (метод, функция) -> статистика окна
+        self._window_start = time.time()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Any],
+    ):
+        key = self._flight_key(endpoint, data)
+        if key is None:
+            return await self._call(callback, args, kwargs, endpoint)
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            # Запрос выполняется отдельной задачей: отмена первого вызывающего не отменяет его для остальных
+            flight = self._inflight[key] = asyncio.ensure_future(self._call(callback, args, kwargs, endpoint))
+            flight.add_done_callback(functools.partial(self._land, key))
+        else:
+            feature = current_feature.get()
+            self.shared.inc(endpoint, feature)
+            self._stats(endpoint, feature).shared += 1
+        return await asyncio.shield(flight)
+
+    @staticmethod
+    def _flight_key(endpoint: str, data: Dict[str, Any]) -> Optional[Tuple]:
+        if endpoint not in READ_METHODS:
+            return None
+        key = (endpoint, tuple(sorted(data.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _land(self, key: Tuple, flight: asyncio.Future):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        if not flight.cancelled():
+            flight.exception()  # ошибка уже передана всем ожидавшим
+
+    async def _call(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any,
+                    kwargs: Dict[str, Any], endpoint: str):
+        feature = current_feature.get()
+        started = time.monotonic()
+        error = None
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            self.errors.inc(endpoint, feature, error)
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self.duration.observe(elapsed, endpoint, feature)
+            self._record(endpoint, feature, elapsed, error)
+
+    def _stats(self, method: str, feature: str) -> _CallStats:
+        stats = self._window.get((method, feature))
+        if stats is None:
+            stats = self._window[(method, feature)] = _CallStats(self.samples)
+        return stats
+
+    def _record(self, method: str, feature: str, elapsed: float, error: Optional[str]):
+        stats = self._stats(method, feature)
+        stats.calls += 1
+        stats.total_time += elapsed
+        stats.latencies.append(elapsed)
+        if error is not None:
+            stats.errors[error] += 1
+
+    def summary(self) -> List[Dict]:
+        """Статистика окна по (метод, функция), самые частые вызовы первыми"""
+        rows = []
+        for (method, feature), stats in self._window.items():
+            latencies = sorted(stats.latencies)
+            rows.append({
+                'method': method,
+                'feature': feature,
+                'calls': stats.calls,
+                'shared': stats.shared,
+                'errors': dict(stats.errors),
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'total_time': stats.total_time,
+            })
+        rows.sort(key=lambda row: row['calls'], reverse=True)
+        return rows
+
+    @property
+    def window_seconds(self) -> float:
+        return time.time() - self._window_start
+
+    def reset_window(self):
+        self._window.clear()
+        self._window_start = time.time()
+
+    def format_report(self, limit: int = 15) -> str:
+        """Текст отчета для команды /apistats"""
+        rows = self.summary()
+        minutes = int(self.window_seconds // 60)
+        if not rows:
+            return f"📡 Запросов к Bot API за {minutes} мин не было"
+
+        lines = [f"📡 Запросы к Bot API за {minutes} мин: {sum(row['calls'] for row in rows)}"]
+        by_feature: Counter = Counter()
+        for row in rows:
+            by_feature[row['feature']] += row['calls']
+        lines.append("🧩 По функциям: " + ", ".join(f"{feature} {calls}" for feature, calls in by_feature.most_common()))
+        lines.append("")
+        for row in rows[:limit]:
+            line = (
+                f"• {row['method']} [{row['feature']}]: {row['calls']}, "
+                f"p50 {row['p50'] * 1000:.0f} мс, p95 {row['p95'] * 1000:.0f} мс, p99 {row['p99'] * 1000:.0f} мс"
+            )
+            if row['shared']:
+                line += f", объединено {row['shared']}"
+            if row['errors']:
+                line += " ❗ " + ", ".join(f"{error} {count}" for error, count in row['errors'].items())
+            lines.append(line)
+        if len(rows) > limit:
+            lines.append(f"… и еще {len(rows) - limit}")
+        return "\n".join(lines)
+
+    def log_summary(self):
+        """Пишет сводку окна в лог и начинает новое окно"""
+        rows = self.summary()
+        if rows:
+            total = sum(row['calls'] for row in rows)
+            errors = sum(sum(row['errors'].values()) for row in rows)
+            logger.info(f"📡 Bot API за {self.window_seconds / 60:.0f} мин: {total} запросов, {errors} ошибок")
+            for row in rows[:10]:
+                logger.info(
+                    f"   {row['method']} [{row['feature']}]: {row['calls']} вызовов, "
+                    f"p50={row['p50'] * 1000:.0f}мс p95={row['p95'] * 1000:.0f}мс p99={row['p99'] * 1000:.0f}мс, "
+                    f"объединено: {row['shared']}, ошибки: {row['errors'] or 0}"
+                )
+        self.reset_window()
@@ -0,0 +1,320 @@
+import asyncio
+import heapq
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from telegram.error import RetryAfter
+
+from rate_limit import TokenBucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Ключ заявки: (chat_id, user_id)
+RequestKey = Tuple[int, int]
+DueCallback = Callable[[List[RequestKey]], Awaitable[None]]
+ApproveCallback = Callable[[int, int], Awaitable[bool]]
+ChatDoneCallback = Callable[[int, int], Awaitable[None]]
+RescheduleCallback = Callable[[int, int, float], None]
+
+
+class PendingRequests:
+    """Индекс ожидающих заявок по ключу (chat_id, user_id).
+
+    Поиск по паре - O(1); дополнительные индексы позволяют перебирать заявки
+    конкретного чата или конкретного пользователя и дешево считать нагрузку по чатам.
+    Для каждой заявки хранится только время подачи и имя пользователя для логов.
+    """
+
+    def __init__(self):
+        self._entries: Dict[RequestKey, Tuple[float, Optional[str]]] = {}
+        self._by_chat: Dict[int, Set[int]] = {}
+        self._by_user: Dict[int, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: RequestKey) -> bool:
+        return key in self._entries
+
+    def add(self, chat_id: int, user_id: int, first_name: Optional[str] = None, request_time: Optional[float] = None):
+        """Добавляет (или обновляет) заявку пользователя в чат"""
+        self._entries[(chat_id, user_id)] = (time.time() if request_time is None else request_time, first_name)
+        self._by_chat.setdefault(chat_id, set()).add(user_id)
+        self._by_user.setdefault(user_id, set()).add(chat_id)
+
+    def get(self, chat_id: int, user_id: int) -> Optional[Tuple[float, Optional[str]]]:
+        """Возвращает (время подачи, имя) или None"""
+        return self._entries.get((chat_id, user_id))
+
+    def pop(self, chat_id: int, user_id: int) -> Optional[Tuple[float, Optional[str]]]:
+        """Удаляет заявку и возвращает ее данные (или None, если заявки нет)"""
+        entry = self._entries.pop((chat_id, user_id), None)
+        if entry is None:
+            return None
+        self._discard(self._by_chat, chat_id, user_id)
+        self._discard(self._by_user, user_id, chat_id)
+        return entry
+
+    def users_in_chat(self, chat_id: int) -> Iterator[int]:
+        """Пользователи с ожидающими заявками в чат"""
+        return iter(self._by_chat.get(chat_id, ()))
+
+    def chats_for_user(self, user_id: int) -> Iterator[int]:
+        """Чаты, в которые пользователь подал ожидающие заявки"""
+        return iter(self._by_user.get(user_id, ()))
+
+    def count_for_chat(self, chat_id: int) -> int:
+        """Количество ожидающих заявок в чат"""
+        return len(self._by_chat.get(chat_id, ()))
+
+    @staticmethod
+    def _discard(index: Dict[int, Set[int]], key: int, value: int):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
+
+
+class ApprovalScheduler:
+    """Планировщик автоматического одобрения заявок.
+
+    Все ожидающие заявки хранятся в одной куче, упорядоченной по времени одобрения,
+    и обслуживаются одной фоновой задачей вместо отдельной задачи JobQueue на каждую
+    заявку. Каждое изменение дописывается в журнал на диске, поэтому после перезапуска
+    ожидающие одобрения восстанавливаются.
+
+    Формат журнала (одна запись на строку):
+        A <due_ts> <chat_id> <user_id>  - заявка запланирована
+        D <chat_id> <user_id>           - заявка обработана
+    """
+
+    # Журнал переписывается, когда в нем накопилось столько отработанных записей
+    COMPACT_THRESHOLD = 10000
+
+    def __init__(self, journal_path: str = 'pending_approvals.journal'):
+        self.journal_path = journal_path
+        self._heap: List[Tuple[float, int, int]] = []  # (due_ts, chat_id, user_id)
+        self._due: Dict[RequestKey, float] = {}  # актуальное время одобрения по ключу
+        self._in_flight: Dict[RequestKey, float] = {}  # извлеченные, но еще не обработанные
+        self._journal = None
+        self._dead_records = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._callback: Optional[DueCallback] = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def __contains__(self, key: RequestKey) -> bool:
+        return key in self._due
+
+    def keys(self) -> List[RequestKey]:
+        """Ключи всех запланированных и обрабатываемых заявок"""
+        return list(self._in_flight) + list(self._due)
+
+    def load(self):
+        """Восстанавливает ожидающие заявки из журнала и открывает его для записи"""
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    try:
+                        if parts[0] == 'A' and len(parts) == 4:
+                            self._due[(int(parts[2]), int(parts[3]))] = float(parts[1])
+                        elif parts[0] == 'D' and len(parts) == 3:
+                            self._due.pop((int(parts[1]), int(parts[2])), None)
+                            self._dead_records += 1
+                    except (IndexError, ValueError):
+                        # Оборванная последняя строка после аварийного завершения
+                        logger.warning(f"Пропущена поврежденная запись журнала одобрений: {line!r}")
+        except FileNotFoundError:
+            pass
+
+        self._heap = [(due, chat_id, user_id) for (chat_id, user_id), due in self._due.items()]
+        heapq.heapify(self._heap)
+        # Переписываем журнал сразу: в нем остаются только актуальные заявки
+        self._compact()
+
+        if self._due:
+            logger.info(f"Восстановлено {len(self._due)} ожидающих заявок из журнала")
+
+    def schedule(self, chat_id: int, user_id: int, delay: float):
+        """Планирует одобрение заявки через delay секунд (повторная заявка переносит срок)"""
+        due = time.time() + delay
+        key = (chat_id, user_id)
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, chat_id, user_id))
+        self._write(f"A {due:.3f} {chat_id} {user_id}\n")
+
+        if self._wakeup is not None and self._heap[0][0] == due:
+            self._wakeup.set()
+
+    def lag(self, now: Optional[float] = None) -> float:
+        """На сколько секунд самая старая наступившая заявка опаздывает с одобрением"""
+        now = time.time() if now is None else now
+        oldest = min(self._in_flight.values(), default=now)
+        # Верх кучи может быть устаревшей записью перенесенной заявки - тогда оценка только завышается
+        if self._heap:
+            oldest = min(oldest, self._heap[0][0])
+        return max(0.0, now - oldest)
+
+    def start(self, callback: DueCallback):
+        """Запускает фоновую задачу, которая передает наступившие заявки в callback"""
+        self._callback = callback
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и закрывает журнал"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+            self._journal = None
+
+    def pop_due(self, now: Optional[float] = None) -> List[RequestKey]:
+        """Извлекает все заявки, срок одобрения которых наступил.
+
+        В журнале заявки остаются до вызова complete(), поэтому при падении во время
+        обработки они будут повторно обработаны после перезапуска.
+        """
+        now = time.time() if now is None else now
+        due_keys = []
+        while self._heap and self._heap[0][0] <= now:
+            due, chat_id, user_id = heapq.heappop(self._heap)
+            key = (chat_id, user_id)
+            # Пропускаем устаревшие записи перенесенных заявок
+            if self._due.get(key) != due:
+                continue
+            del self._due[key]
+            self._in_flight[key] = due
+            due_keys.append(key)
+        return due_keys
+
+    def complete(self, keys: List[RequestKey]):
+        """Отмечает в журнале, что извлеченные заявки обработаны"""
+        for chat_id, user_id in keys:
+            self._in_flight.pop((chat_id, user_id), None)
+            # Заявка могла быть запланирована повторно, пока шла обработка
+            if (chat_id, user_id) not in self._due:
+                self._mark_done(chat_id, user_id)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = max(0.0, self._heap[0][0] - time.time())
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            due_keys = self.pop_due()
+            if not due_keys:
+                continue
+            try:
+                await self._callback(due_keys)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке {len(due_keys)} заявок из планировщика: {e}")
+            self.complete(due_keys)
+
+    def _mark_done(self, chat_id: int, user_id: int):
+        self._write(f"D {chat_id} {user_id}\n")
+        self._dead_records += 1
+        if self._dead_records >= self.COMPACT_THRESHOLD and self._dead_records > len(self._due):
+            self._compact()
+
+    def _write(self, record: str):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal.write(record)
+        self._journal.flush()
+
+    def _compact(self):
+        """Атомарно переписывает журнал, оставляя только ожидающие заявки"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        tmp_path = f"{self.journal_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for pending in (self._in_flight, self._due):
+                    for (chat_id, user_id), due in pending.items():
+                        f.write(f"A {due:.3f} {chat_id} {user_id}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.journal_path)
+            self._dead_records = 0
+            # Мусор в куче от перенесенных заявок тоже убираем
+            if len(self._heap) > 2 * len(self._due):
+                self._heap = [(due, chat_id, user_id) for (chat_id, user_id), due in self._due.items()]
+                heapq.heapify(self._heap)
+        except OSError as e:
+            logger.error(f"Не удалось сжать журнал одобрений: {e}")
+
+
+class ApprovalWorker:
+    """Одобряет наступившие заявки пачками по чатам.
+
+    Все запросы approve_chat_join_request проходят через общее ведро токенов, которое
+    ставится на паузу при RetryAfter, а после обработки пачки чата один раз вызывается
+    on_chat_done (например, чтобы обновить счетчик участников). Заявка, которую не
+    удалось одобрить за MAX_ATTEMPTS попыток из-за RetryAfter, не теряется: она
+    передается в reschedule (chat_id, user_id, пауза) и планируется заново.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, approve: ApproveCallback, on_chat_done: ChatDoneCallback, bucket: TokenBucket,
+                 reschedule: RescheduleCallback):
+        self.approve = approve
+        self.on_chat_done = on_chat_done
+        self.bucket = bucket
+        self.reschedule = reschedule
+
+    async def process(self, due_requests: List[RequestKey]):
+        """Группирует заявки по чатам и обрабатывает чаты параллельно"""
+        by_chat: Dict[int, List[int]] = {}
+        for chat_id, user_id in due_requests:
+            by_chat.setdefault(chat_id, []).append(user_id)
+
+        await asyncio.gather(*(self._process_chat(chat_id, user_ids) for chat_id, user_ids in by_chat.items()))
+
+    async def _process_chat(self, chat_id: int, user_ids: List[int]):
+        approved = 0
+        for user_id in user_ids:
+            delay = 0.0
+            for attempt in range(1, self.MAX_ATTEMPTS + 1):
+                await self.bucket.acquire()
+                try:
+                    if await self.approve(chat_id, user_id):
+                        approved += 1
+                    break
+                except RetryAfter as e:
+                    delay = retry_after_seconds(e)
+                    self.bucket.pause(delay)
+                    logger.warning(f"⏳ RetryAfter при одобрении заявки {user_id} в чате {chat_id}: пауза {delay} с (попытка {attempt}/{self.MAX_ATTEMPTS})")
+            else:
+                # Повторная запись в журнале - заявка переживет и перезапуск
+                logger.warning(f"⏳ Заявка {user_id} в чате {chat_id} не одобрена за {self.MAX_ATTEMPTS} попыток, повтор через {delay} с")
+                self.reschedule(chat_id, user_id, delay)
+
+        if approved:
+            logger.info(f"✅ Одобрено {approved} из {len(user_ids)} заявок в чате {chat_id}")
+            try:
+                await self.on_chat_done(chat_id, approved)
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка после одобрения пачки заявок в чате {chat_id}: {e}")
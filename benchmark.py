@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота без Telegram.
+
+TelegramBot запускается в webhook режиме против локальной заглушки Bot API
+(задержка ответов, лимиты частоты и ответы 429 с retry_after), а генератор
+отправляет в webhook синтетические заявки на вступление с заданной частотой.
+В конце печатается пропускная способность, задержка одобрения и память.
+
+    python benchmark.py --rate 10000 --chats 1000 --duration 60
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import secrets
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+from api_client import percentile
+from bot import TelegramBot
+from rate_limit import TokenBucket
+
+logger = logging.getLogger('benchmark')
+
+BOT_ID = 7000000001
+BOT_TOKEN = f"{BOT_ID}:benchmark-token-0000000000000000000"
+FIRST_CHAT_ID = -1001000000000
+FIRST_USER_ID = 100000000
+
+# Методы, на которые распространяются лимиты отправки сообщений Telegram
+MESSAGE_METHODS = ('sendMessage',)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _user(user_id: int, is_bot: bool = False) -> Dict:
+    return {'id': user_id, 'is_bot': is_bot, 'first_name': f"User {user_id}"}
+
+
+def _chat(chat_id: int) -> Dict:
+    return {'id': chat_id, 'type': 'supergroup', 'title': f"Bench {chat_id}"}
+
+
+def _member(user: Dict, status: str) -> Dict:
+    if status != 'administrator':
+        return {'status': status, 'user': user}
+    rights = ('can_manage_chat', 'can_delete_messages', 'can_manage_video_chats', 'can_restrict_members',
+              'can_promote_members', 'can_change_info', 'can_invite_users', 'can_post_stories',
+              'can_edit_stories', 'can_delete_stories')
+    return {'status': status, 'user': user, 'can_be_edited': False, 'is_anonymous': False,
+            **{right: True for right in rights}}
+
+
+class FakeBotApi:
+    """Заглушка Bot API: отвечает на методы, которые вызывает бот.
+
+    Каждый ответ задерживается на latency (± jitter). sendMessage ограничен
+    глобально (message_rate в секунду) и по чатам: group_message_rate для групп,
+    private_message_rate для личных чатов. Остальные методы - общим лимитом
+    api_rate (0 - без ограничения). При превышении лимита возвращается 429
+    с retry_after, как у Telegram.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, message_rate: float = 30,
+                 group_message_rate: float = 20 / 60, private_message_rate: float = 1, api_rate: float = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.message_bucket = TokenBucket(message_rate) if message_rate else None
+        self.group_message_rate = group_message_rate
+        self.private_message_rate = private_message_rate
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.api_bucket = TokenBucket(api_rate) if api_rate else None
+        self.calls: Counter = Counter()
+        self.flood: Counter = Counter()
+        self.member_counts: Dict[int, int] = {}
+        self.approvals: Dict[tuple, float] = {}  # (chat_id, user_id) -> время одобрения
+        self.on_approve: Optional[Callable[[int, int], None]] = None
+        self.webhook_set = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self.server: Optional[HTTPServer] = None
+
+    def start(self, port: int):
+        app = tornado.web.Application([(r'/bot[^/]+/(\w+)', _FakeApiHandler, {'api': self})],
+                                      log_function=lambda handler: None)
+        self.server = HTTPServer(app)
+        self.server.listen(port, '127.0.0.1')
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            await self.server.close_all_connections()
+            self.server = None
+
+    def _flood_wait(self, method: str, params: Dict) -> float:
+        """Пауза для ответа 429 или 0, если запрос укладывается в лимиты"""
+        buckets = []
+        if method in MESSAGE_METHODS:
+            if self.message_bucket is not None:
+                buckets.append(self.message_bucket)
+            chat_id = int(params.get('chat_id', 0))
+            rate = self.private_message_rate if chat_id > 0 else self.group_message_rate
+            if rate:
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(rate, 1)
+                buckets.append(bucket)
+        elif self.api_bucket is not None:
+            buckets.append(self.api_bucket)
+
+        wait = max((bucket.wait_time() for bucket in buckets), default=0.0)
+        if wait > 0:
+            return wait
+        for bucket in buckets:
+            bucket.try_acquire()
+        return 0.0
+
+    async def call(self, method: str, params: Dict) -> Dict:
+        self.calls[method] += 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter) if self.jitter else self.latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        wait = self._flood_wait(method, params)
+        if wait > 0:
+            self.flood[method] += 1
+            retry_after = max(1, math.ceil(wait))
+            return {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {retry_after}",
+                    'parameters': {'retry_after': retry_after}}
+
+        handler = getattr(self, f"_{method}", None)
+        if handler is None:
+            return {'ok': False, 'error_code': 400, 'description': f"Bad Request: method {method} is not emulated"}
+        return {'ok': True, 'result': handler(params)}
+
+    def _getMe(self, params: Dict):
+        return {**_user(BOT_ID, is_bot=True), 'username': 'benchmark_bot', 'can_join_groups': True}
+
+    def _setWebhook(self, params: Dict):
+        self.webhook_set.set()
+        return True
+
+    def _deleteWebhook(self, params: Dict):
+        return True
+
+    def _getChat(self, params: Dict):
+        chat_id = int(params['chat_id'])
+        return {**_chat(chat_id), 'accent_color_id': 0, 'max_reaction_count': 11,
+                'accepted_gift_types': {'unlimited_gifts': False, 'limited_gifts': False,
+                                        'unique_gifts': False, 'premium_subscription': False,
+                                        'gifts_from_channels': False}}
+
+    def _getChatMemberCount(self, params: Dict):
+        return self.member_counts.setdefault(int(params['chat_id']), 100)
+
+    def _getChatAdministrators(self, params: Dict):
+        return [{'status': 'creator', 'user': _user(1), 'is_anonymous': False}]
+
+    def _getChatMember(self, params: Dict):
+        user_id = int(params['user_id'])
+        if user_id == BOT_ID:
+            return _member(_user(BOT_ID, is_bot=True), 'administrator')
+        return _member(_user(user_id), 'member')
+
+    def _sendMessage(self, params: Dict):
+        chat_id = int(params['chat_id'])
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+                'text': params.get('text', '')}
+
+    def _approveChatJoinRequest(self, params: Dict):
+        chat_id, user_id = int(params['chat_id']), int(params['user_id'])
+        self.approvals.setdefault((chat_id, user_id), time.monotonic())
+        self.member_counts[chat_id] = self.member_counts.get(chat_id, 100) + 1
+        if self.on_approve is not None:
+            self.on_approve(chat_id, user_id)
+        return True
+
+
+class _FakeApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api: FakeBotApi):
+        self.api = api
+
+    async def post(self, method: str):
+        params = {}
+        for name, values in self.request.body_arguments.items():
+            value = values[-1].decode()
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        response = await self.api.call(method, params)
+        self.set_status(response.get('error_code', 200))
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(response))
+
+
+class UpdateGenerator:
+    """Отправляет в webhook синтетические обновления так, как это делает Telegram.
+
+    Одновременно открыто не больше connections запросов (max_connections
+    webhook в Telegram, по умолчанию 40), поэтому медленный webhook снижает
+    фактическую частоту - так же, как в production.
+    """
+
+    def __init__(self, url: str, secret_token: Optional[str], connections: int = 40):
+        self.url = url
+        self.headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=connections), timeout=60)
+        self.slots = asyncio.Semaphore(connections)
+        self.update_ids = itertools.count(1)
+        self.sent: Dict[tuple, float] = {}  # (chat_id, user_id) -> время отправки заявки
+        self.accepted = 0
+        self.failed = 0
+        self.post_latencies: List[float] = []
+        self._tasks = set()
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.client.aclose()
+
+    async def _post(self, payload: Dict) -> bool:
+        async with self.slots:
+            started = time.monotonic()
+            try:
+                response = await self.client.post(self.url, json=payload, headers=self.headers)
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            self.post_latencies.append(time.monotonic() - started)
+            return ok
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_join_request(self, chat_id: int, user_id: int):
+        user = _user(user_id)
+        payload = {'update_id': next(self.update_ids), 'chat_join_request': {
+            'chat': _chat(chat_id), 'from': user, 'date': int(time.time()), 'user_chat_id': user_id,
+        }}
+        self.sent[(chat_id, user_id)] = time.monotonic()
+        if await self._post(payload):
+            self.accepted += 1
+        else:
+            self.failed += 1
+
+    def member_joined(self, chat_id: int, user_id: int):
+        """Обновление chat_member, которое Telegram присылает после одобрения"""
+        user = _user(user_id)
+        payload = {'update_id': next(self.update_ids), 'chat_member': {
+            'chat': _chat(chat_id), 'from': _user(1), 'date': int(time.time()),
+            'old_chat_member': _member(user, 'left'), 'new_chat_member': _member(user, 'member'),
+        }}
+        self._spawn(self._post(payload))
+
+    async def run(self, rate_per_minute: float, chats: int, duration: float):
+        """Отправляет заявки с частотой rate_per_minute в случайные из chats чатов"""
+        interval = 60.0 / rate_per_minute
+        users = itertools.count(FIRST_USER_ID)
+        started = time.monotonic()
+        sent = 0
+        while True:
+            due = started + sent * interval
+            if due - started >= duration:
+                break
+            now = time.monotonic()
+            if due > now:
+                await asyncio.sleep(due - now)
+            # Запрос ждет свободного соединения здесь, а не в фоне: так видно отставание от заданной частоты
+            await self.slots.acquire()
+            self.slots.release()
+            chat_id = FIRST_CHAT_ID - random.randrange(chats)
+            self._spawn(self._send_join_request(chat_id, next(users)))
+            sent += 1
+        return time.monotonic() - started
+
+
+def _max_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss в Linux - в килобайтах, в macOS - в байтах
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+async def run_benchmark(args) -> Dict:
+    """Запускает бота против заглушки и возвращает результаты сценария"""
+    workdir = tempfile.mkdtemp(prefix='minibot-bench-')
+    os.chdir(workdir)
+    config = {
+        'auto_approve_delay': args.delay,
+        'welcome_message': "🎉 Добро пожаловать!",
+        'admin_notification': True,
+        'diagnostics_sample_rate': 0,
+    }
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+
+    secret_token = secrets.token_hex(16)
+    os.environ['WEBHOOK_SECRET'] = secret_token
+    api_port, webhook_port = _free_port(), _free_port()
+    webhook_path = f"/{BOT_TOKEN}"
+    webhook_url = f"http://127.0.0.1:{webhook_port}{webhook_path}"
+
+    api = FakeBotApi(args.latency, args.jitter, args.message_rate, args.group_message_rate,
+                     args.private_message_rate, args.api_rate)
+    api.start(api_port)
+    generator = UpdateGenerator(webhook_url, secret_token, args.connections)
+    api.on_approve = generator.member_joined
+
+    rss_before = _max_rss_mb()
+    bot = TelegramBot(BOT_TOKEN)
+    application = bot.build_application(base_url=f"http://127.0.0.1:{api_port}/bot")
+    stop_event = asyncio.Event()
+    serving = asyncio.create_task(
+        bot.serve_webhook(application, webhook_port, webhook_path, webhook_url, stop_event)
+    )
+    try:
+        await asyncio.wait_for(api.webhook_set.wait(), 30)
+        logger.info(f"🚀 Сценарий: {args.rate:.0f} заявок/мин в {args.chats} чатов, {args.duration:.0f} с")
+        send_time = await generator.run(args.rate, args.chats, args.duration)
+
+        # Ждем одобрения всех принятых заявок
+        deadline = time.monotonic() + args.delay + args.drain_timeout
+        while len(api.approvals) < generator.accepted and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+    finally:
+        stop_event.set()
+        await serving
+        await generator.close()
+        await api.stop()
+
+    first_sent = min(generator.sent.values(), default=0.0)
+    approve_time = max(api.approvals.values(), default=first_sent) - first_sent
+    latencies = sorted(api.approvals[key] - generator.sent[key] for key in api.approvals if key in generator.sent)
+    webhook_latencies = sorted(generator.post_latencies)
+    return {
+        'workdir': workdir,
+        'requests_sent': len(generator.sent),
+        'requests_accepted': generator.accepted,
+        'requests_failed': generator.failed,
+        'send_time': send_time,
+        'send_rate_per_minute': len(generator.sent) / send_time * 60 if send_time else 0.0,
+        'webhook_p50': percentile(webhook_latencies, 0.5),
+        'webhook_p99': percentile(webhook_latencies, 0.99),
+        'approved': len(api.approvals),
+        'approvals_per_second': len(api.approvals) / approve_time if approve_time else 0.0,
+        'approval_p50': percentile(latencies, 0.5),
+        'approval_p99': percentile(latencies, 0.99),
+        'approval_delay': args.delay,
+        'updates_processed': bot.ingress.processed,
+        'updates_shed': bot.ingress.shed,
+        'api_calls': dict(api.calls),
+        'api_flood': dict(api.flood),
+        'outbox_left': len(bot.outbox),
+        'max_rss_mb_before': rss_before,
+        'max_rss_mb': _max_rss_mb(),
+    }
+
+
+def format_report(result: Dict) -> str:
+    delay = result['approval_delay']
+    lines = [
+        "📊 Результаты нагрузочного теста",
+        f"📨 Заявки: отправлено {result['requests_sent']}, принято webhook {result['requests_accepted']}, "
+        f"ошибок {result['requests_failed']} ({result['send_rate_per_minute']:.0f}/мин за {result['send_time']:.1f} с)",
+        f"🌐 Ответ webhook: p50 {result['webhook_p50'] * 1000:.0f} мс, p99 {result['webhook_p99'] * 1000:.0f} мс",
+        f"✅ Одобрено: {result['approved']} ({result['approvals_per_second']:.1f}/с)",
+        f"⏱️ Задержка одобрения: p50 {result['approval_p50']:.2f} с, p99 {result['approval_p99']:.2f} с "
+        f"(сверх auto_approve_delay={delay} с: p50 {result['approval_p50'] - delay:.2f} с, "
+        f"p99 {result['approval_p99'] - delay:.2f} с)",
+        f"⚙️ Обработано обновлений: {result['updates_processed']}, отброшено: {result['updates_shed']}, "
+        f"в очереди отправки осталось: {result['outbox_left']}",
+        "📡 Вызовы API: " + ", ".join(f"{method} {count}" for method, count in
+                                      sorted(result['api_calls'].items(), key=lambda item: -item[1])),
+    ]
+    if result['api_flood']:
+        lines.append("🚦 Ответы 429: " + ", ".join(f"{method} {count}" for method, count in result['api_flood'].items()))
+    if result['max_rss_mb'] is not None:
+        lines.append(f"💾 Пиковая память процесса: {result['max_rss_mb']:.1f} МБ "
+                     f"(до запуска бота {result['max_rss_mb_before']:.1f} МБ)")
+    lines.append(f"📁 Файлы бота: {result['workdir']}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота против локальной заглушки Bot API")
+    parser.add_argument('--rate', type=float, default=10000, help="заявок в минуту (по умолчанию 10000)")
+    parser.add_argument('--chats', type=int, default=1000, help="количество чатов (по умолчанию 1000)")
+    parser.add_argument('--duration', type=float, default=60, help="длительность отправки, с (по умолчанию 60)")
+    parser.add_argument('--delay', type=int, default=5, help="auto_approve_delay бота, с (по умолчанию 5)")
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка ответа Bot API, с (по умолчанию 0.05)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="разброс задержки Bot API, с (по умолчанию 0)")
+    parser.add_argument('--message-rate', type=float, default=30,
+                        help="лимит sendMessage в секунду на бота, 0 - без лимита (по умолчанию 30)")
+    parser.add_argument('--group-message-rate', type=float, default=20 / 60,
+                        help="лимит sendMessage в секунду на группу, 0 - без лимита (по умолчанию 20 в минуту)")
+    parser.add_argument('--private-message-rate', type=float, default=1,
+                        help="лимит sendMessage в секунду на личный чат, 0 - без лимита (по умолчанию 1)")
+    parser.add_argument('--api-rate', type=float, default=0,
+                        help="лимит остальных методов в секунду, 0 - без лимита (по умолчанию 0)")
+    parser.add_argument('--connections', type=int, default=40,
+                        help="одновременных запросов к webhook, как max_connections (по умолчанию 40)")
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help="сколько ждать одобрения оставшихся заявок, с (по умолчанию 60)")
+    parser.add_argument('--config', help="JSON с дополнительными настройками бота")
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    parser.add_argument('--log-level', default='WARNING', help="уровень логов бота (по умолчанию WARNING)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cwd = os.getcwd()
+    logging.getLogger().setLevel(args.log_level.upper())
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        os.chdir(cwd)
+    print(json.dumps(result, ensure_ascii=False, indent=2) if args.json else format_report(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
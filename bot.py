@@ -1,17 +1,36 @@
 import asyncio
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, Set
+from typing import Dict, List, Optional, Set, Tuple
 import json
 import os
+import time
 
 from telegram import Update, ChatMemberUpdated, ChatMember, Chat
 from telegram.ext import Application, ChatJoinRequestHandler, ChatMemberHandler, ContextTypes, CommandHandler
 from telegram.constants import ChatAction, ParseMode, ChatType
-from telegram.error import BadRequest, Forbidden, TimedOut, NetworkError, Conflict
+from telegram.error import BadRequest, Forbidden, TimedOut, NetworkError, Conflict, RetryAfter
 import signal
 import sys
 
+from api_client import ApiCallMonitor, api_feature
+from approvals import ApprovalScheduler, ApprovalWorker, PendingRequests
+from chat_cache import AdminRosterCache, BotPermissionCache, ChatInfoCache, is_admin_change
+from diagnostics import UpdateDiagnostics, default_sample_rate
+from event_log import EventLog, EVENT_REQUEST, EVENT_APPROVED, EVENT_JOINED, EVENT_LEFT
+from ingress import ALLOWED_UPDATES, UpdateIngress
+from member_counts import MemberCountTracker
+from metrics import MetricsRegistry
+from notifications import NotificationDigest
+from outbox import Outbox, PRIORITY_WELCOME, PRIORITY_ADMIN_NOTICE, PRIORITY_STATS
+from rate_limit import TokenBucket
+from reports import ReportRenderer
+from storage import WriteBehind, create_storage
+from webserver import WebhookServer
+from stats import (
+    ChannelStats, StatsTable, TOTAL_REQUESTS, TOTAL_APPROVED, TOTAL_LEFT, CURRENT_MEMBERS
+)
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -22,29 +41,133 @@ logger = logging.getLogger(__name__)
 class TelegramBot:
     def __init__(self, token: str):
         self.token = token
-        self.pending_requests: Dict[str, Dict] = {}  # user_id -> {chat_id, request_time, user_data}
-        self.approved_users: Set[str] = set()  # множество одобренных пользователей
+        self.pending_requests = PendingRequests()  # (chat_id, user_id) -> (request_time, first_name)
+        self.approved_users: Set[Tuple[str, str]] = set()  # одобренные пары (chat_id, user_id)
         self.config = self.load_config()
         
-        # Статистика по каналам/группам
-        self.channel_stats = {}  # chat_id -> статистика канала
+        # Статистика по каналам/группам (глобальные суммы - в self.channel_stats.totals)
+        self.channel_stats = StatsTable()  # chat_id -> ChannelStats
         self.tracked_groups = set()  # множество отслеживаемых групп
         
-        # Глобальная статистика (сумма по всем каналам)
-        self.global_stats = {
-            'hourly_requests': 0,
-            'hourly_left': 0,
-            'daily_requests': 0,
-            'daily_left': 0,
-            'total_requests': 0,
-            'total_approved': 0,
-            'total_left': 0,
-            'current_members': 0  # Текущее количество участников
-        }
+        # Кэш администраторов чатов (user_id -> чаты, где он админ)
+        self.admin_roster = AdminRosterCache(self.config.get("admin_cache_ttl", 900))
+        
+        # Права бота в чатах (обновляются из my_chat_member)
+        self.bot_permissions = BotPermissionCache(self.config.get("bot_permissions_ttl", 3600))
+        
+        # Отчеты о статистике: фрагменты каналов кэшируются до изменения их счетчиков
+        self.reports = ReportRenderer(self.config.get("report_format", "text") == "html")
+        
+        # Тип и название чатов (из входящих обновлений, get_chat - только для устаревших)
+        self.chat_info = ChatInfoCache(self.config.get("chat_info_ttl", 21600))
+        
+        # Счетчики участников ведутся по chat_member, API - только для сверки
+        self.member_counts = MemberCountTracker(
+            max_age=self.config.get("member_count_max_age", 21600),
+            drift_min=self.config.get("member_count_drift", 20),
+            interval=self.config.get("member_count_reconcile_interval", 1800),
+            tick=self.config.get("member_count_reconcile_tick", 60)
+        )
+        
+        # Все исходящие сообщения идут через общую очередь с лимитами Telegram
+        self.outbox = Outbox(
+            global_rate=self.config.get("outbox_global_rate", 30),
+            per_chat_rate=self.config.get("outbox_per_chat_rate", 1),
+            group_rate=self.config.get("outbox_group_rate", 20 / 60),
+            max_size=self.config.get("outbox_max_size", 10000)
+        )
+        
+        # Уведомления админам о заявках объединяются в дайджесты при всплесках
+        self.admin_digest = NotificationDigest(
+            self.send_admin_notification,
+            window=self.config.get("admin_digest_window", 60),
+            max_users=self.config.get("admin_digest_max_users", 10)
+        )
+        
+        # Очередь входящих обновлений с параллельной обработкой и защитой от перегрузки
+        self.ingress = UpdateIngress(
+            concurrency=self.config.get("update_concurrency", 16),
+            max_queue=self.config.get("update_queue_size", 1000),
+            shutdown_timeout=self.config.get("update_shutdown_timeout", 30)
+        )
+        
+        # Диагностика потока обновлений: счетчики по типам, выборка в лог и периодическая сводка
+        is_production = os.getenv('RENDER') == 'true' or os.getenv('PRODUCTION') == 'true'
+        self.diagnostics = UpdateDiagnostics(
+            default_sample_rate(is_production, self.config.get("diagnostics_sample_rate"))
+        )
+        
+        # Журнал событий с агрегатами по минутам/часам/дням - источник отчетов за период
+        self.event_log = EventLog(self.config.get("event_log_file", "bot_events.log"))
+        self.event_log.load()
         
-        # Загружаем сохраненную статистику
+        # Начало периода следующего отчета (время последнего доставленного отчета)
+        now = int(time.time())
+        self.report_windows = {'hourly': now, 'daily': now}
+        
+        # Загружаем сохраненную статистику (SQLite или JSON, см. storage_backend)
+        self.storage = create_storage(self.config)
         self.load_stats_from_file()
         
+        # Изменения сохраняются раз в stats_flush_interval секунд или после stats_flush_events изменений
+        # (по умолчанию - в зависимости от хранилища: JSON переписывается целиком и сохраняется реже)
+        self.write_behind = WriteBehind(
+            self.save_stats,
+            interval=self.config.get("stats_flush_interval", self.storage.FLUSH_INTERVAL),
+            max_events=self.config.get("stats_flush_events", self.storage.FLUSH_EVENTS)
+        )
+        self.channel_stats.on_change = self.write_behind.notify
+        
+        # Планировщик автоматического одобрения (переживает перезапуск благодаря журналу)
+        self.application = None
+        self.approval_scheduler = ApprovalScheduler(
+            self.config.get("pending_journal_file", "pending_approvals.journal")
+        )
+        self.approval_scheduler.load()
+        for pending_chat_id, pending_user_id in self.approval_scheduler.keys():
+            self.pending_requests.add(pending_chat_id, pending_user_id)
+        
+        # Одобрение пачками с ограничением частоты запросов к API
+        self.approval_worker = ApprovalWorker(
+            approve=self.approve_due_request,
+            on_chat_done=self.finish_chat_approvals,
+            bucket=TokenBucket(self.config.get("approve_rate_per_second", 20)),
+            reschedule=self.approval_scheduler.schedule
+        )
+        
+        # Метрики для /metrics (Prometheus) и учет всех запросов к Bot API
+        self.metrics = MetricsRegistry()
+        self.api_monitor = ApiCallMonitor(self.metrics)
+        self.register_metrics()
+        
+    def register_metrics(self):
+        """Регистрирует метрики бота: счетчики статистики, одобрения, очереди"""
+        m = self.metrics
+        totals = self.channel_stats.totals
+        m.callback('bot_join_requests_total', 'Заявки на вступление', lambda: totals[TOTAL_REQUESTS], kind='counter')
+        m.callback('bot_approved_total', 'Одобренные заявки', lambda: totals[TOTAL_APPROVED], kind='counter')
+        m.callback('bot_left_total', 'Вышедшие участники', lambda: totals[TOTAL_LEFT], kind='counter')
+        # Ряд на каждый чат раскрывает, какие чаты обслуживает бот, и растет вместе с их числом
+        if self.config.get("metrics_per_chat", False):
+            m.callback('bot_channel_members', 'Участники по чатам', lambda: {
+                (stats.chat_id,): stats.current_members for stats in self.channel_stats.values()
+            }, labelnames=('chat_id',))
+        else:
+            m.callback('bot_channel_members', 'Участники во всех чатах', lambda: totals[CURRENT_MEMBERS])
+        m.callback('bot_tracked_chats', 'Отслеживаемые чаты', lambda: len(self.tracked_groups))
+        
+        self.approval_latency = m.histogram('bot_approval_latency_seconds', 'Время от заявки до одобрения')
+        self.approval_results = m.counter('bot_approvals_total', 'Попытки одобрения по результату', ('result',))
+        m.callback('bot_pending_approvals', 'Заявки, ожидающие одобрения', lambda: len(self.approval_scheduler))
+        m.callback('bot_approval_lag_seconds', 'Опоздание самой старой наступившей заявки', self.approval_scheduler.lag)
+        
+        m.callback('bot_update_queue', 'Входящие обновления в очереди и в обработке', lambda: {
+            ('queued',): self.ingress.queued, ('running',): self.ingress.running
+        }, labelnames=('state',))
+        m.callback('bot_updates_processed_total', 'Обработанные обновления', lambda: self.ingress.processed, kind='counter')
+        m.callback('bot_updates_shed_total', 'Сообщения, отброшенные при перегрузке', lambda: self.ingress.shed, kind='counter')
+        m.callback('bot_outbox_size', 'Сообщения в очереди отправки', lambda: len(self.outbox))
+    
     def load_config(self) -> Dict:
         """Загружает конфигурацию из файла config.json"""
         try:
@@ -58,6 +181,7 @@ class TelegramBot:
                 "admin_notification": True
             }
     
+    @api_feature('join_requests')
     async def handle_chat_join_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает заявки на вступление в группу"""
         if not update.chat_join_request:
@@ -78,54 +202,56 @@ class TelegramBot:
         
         # Обновляем статистику для конкретного канала
         self.get_or_create_channel_stats(chat_id, chat_title)
-        self.update_channel_stats(chat_id, 'hourly_requests')
-        self.update_channel_stats(chat_id, 'daily_requests')
-        self.update_channel_stats(chat_id, 'total_requests')
+        self.update_channel_stats(chat_id, TOTAL_REQUESTS)
+        self.event_log.append(EVENT_REQUEST, int(chat_id))
         
         # Добавляем группу в отслеживаемые
-        self.tracked_groups.add(chat_id)
+        self.track_group(chat_id)
         
         # Сохраняем информацию о заявке
-        self.pending_requests[user_id] = {
-            'chat_id': chat_id,
-            'request_time': datetime.now(),
-            'user_data': {
-                'id': request.from_user.id,
-                'first_name': request.from_user.first_name,
-                'last_name': request.from_user.last_name,
-                'username': request.from_user.username
-            }
-        }
+        self.pending_requests.add(int(chat_id), int(user_id), request.from_user.first_name)
         
         # Планируем автоматическое одобрение через 10 минут
         delay = self.config.get("auto_approve_delay", 600)
-        
-        if context.job_queue is not None:
-            context.job_queue.run_once(
-                self.auto_approve_request,
-                delay,
-                data={'user_id': user_id, 'chat_id': chat_id},
-                name=f"approve_{user_id}_{chat_id}"
-            )
-            logger.info(f"Запланировано автоматическое одобрение через {delay} секунд")
-        else:
-            logger.error("JobQueue не настроен! Автоматическое одобрение не будет работать.")
+        self.approval_scheduler.schedule(int(chat_id), int(user_id), delay)
+        logger.info(f"Запланировано автоматическое одобрение через {delay} секунд")
         
         # Уведомляем администраторов (если включено в настройках)
         if self.config.get("admin_notification", True):
             await self.notify_admins(context, request)
     
-    async def auto_approve_request(self, context: ContextTypes.DEFAULT_TYPE):
-        """Автоматически одобряет заявку через указанный время"""
-        job_data = context.job.data
-        user_id = job_data['user_id']
-        chat_id = job_data['chat_id']
-        
-        # Проверяем, что заявка все еще актуальна
-        if user_id not in self.pending_requests:
-            logger.info(f"Заявка пользователя {user_id} уже обработана")
+    async def remember_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обновляет кэш чатов и название канала в статистике по входящему обновлению"""
+        chat = update.effective_chat
+        if chat is None or chat.type == ChatType.PRIVATE:
             return
-        
+        self.chat_info.remember(chat)
+        stats = self.channel_stats.get(str(chat.id))
+        if stats is not None and chat.title and stats.title != chat.title:
+            logger.info(f"🏷️ Чат {chat.id} переименован: '{stats.title}' → '{chat.title}'")
+            stats.title = chat.title
+            self.channel_stats.mark_dirty(stats)
+    
+    def make_context(self) -> ContextTypes.DEFAULT_TYPE:
+        """Создает контекст для вызовов вне обработчиков обновлений"""
+        return self.application.context_types.context(self.application)
+    
+    @api_feature('approvals')
+    async def approve_due_request(self, chat_id: int, user_id: int) -> bool:
+        """Одобряет заявку, срок которой наступил (вызывается ApprovalWorker)"""
+        return await self.auto_approve_request(self.make_context(), str(chat_id), str(user_id))
+    
+    @api_feature('member_counts')
+    async def finish_chat_approvals(self, chat_id: int, approved: int):
+        """После пачки одобрений в чате ждет вступлений (счетчик из API - только если он еще неизвестен)"""
+        stats = self.channel_stats.get(str(chat_id))
+        if stats is None or stats.current_members <= 0:
+            await self.update_members_count(self.make_context(), str(chat_id))
+        else:
+            self.member_counts.expect_joins(str(chat_id), approved)
+    
+    async def auto_approve_request(self, context: ContextTypes.DEFAULT_TYPE, chat_id: str, user_id: str) -> bool:
+        """Автоматически одобряет заявку через указанный время"""
         try:
             # Одобряем заявку
             await context.bot.approve_chat_join_request(
@@ -134,24 +260,34 @@ class TelegramBot:
             )
             
             # Добавляем пользователя в список одобренных
-            self.approved_users.add(user_id)
+            self.approved_users.add((chat_id, user_id))
             
-            # Удаляем из ожидающих
-            user_data = self.pending_requests.pop(user_id)
+            # Удаляем из ожидающих (после перезапуска имени пользователя может не быть)
+            pending = self.pending_requests.pop(int(chat_id), int(user_id))
+            first_name = pending[1] if pending and pending[1] else user_id
+            self.approval_results.inc('approved')
+            if pending:
+                self.approval_latency.observe(time.time() - pending[0])
             
-            logger.info(f"Автоматически одобрена заявка пользователя {user_data['user_data']['first_name']} ({user_id})")
+            logger.info(f"Автоматически одобрена заявка пользователя {first_name} ({user_id})")
             
             # Обновляем статистику одобренных для конкретного канала
-            self.update_channel_stats(chat_id, 'total_approved')
-            
-            # Обновляем счетчик участников
-            await self.update_members_count(context, chat_id)
+            self.update_channel_stats(chat_id, TOTAL_APPROVED)
+            self.event_log.append(EVENT_APPROVED, int(chat_id))
+            return True
             
+        except RetryAfter:
+            # Повтор после паузы выполняет ApprovalWorker, заявка остается ожидающей
+            self.approval_results.inc('retry_after')
+            raise
         except Exception as e:
+            self.approval_results.inc('failed')
             logger.error(f"Ошибка при автоматическом одобрении заявки: {e}")
             # Удаляем из ожидающих в случае ошибки
-            self.pending_requests.pop(user_id, None)
+            self.pending_requests.pop(int(chat_id), int(user_id))
+            return False
     
+    @api_feature('member_updates')
     async def handle_chat_member_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отслеживает изменения участников чата для отправки приветственного сообщения и статистики"""
         if not update.chat_member:
@@ -165,46 +301,71 @@ class TelegramBot:
         chat_id = str(update.effective_chat.id)
         
         # Добавляем чат в отслеживаемые если его еще нет
-        self.tracked_groups.add(chat_id)
+        self.track_group(chat_id)
+        
+        # Назначение или снятие администратора делает кэш админов чата устаревшим
+        if is_admin_change(old_status, new_status):
+            self.admin_roster.invalidate(int(chat_id))
         
         # Проверяем, что пользователь стал участником группы
-        if (old_status in [ChatMember.LEFT, ChatMember.KICKED] and 
+        if (old_status in [ChatMember.LEFT, ChatMember.BANNED] and 
             new_status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER]):
             
-            # Проверяем, что это пользователь, которого мы одобрили
-            if user_id in self.approved_users:
+            self.event_log.append(EVENT_JOINED, int(chat_id))
+            self.apply_member_delta(chat_id, 1)
+            
+            # Проверяем, что это пользователь, которого мы одобрили (приветствие - один раз)
+            if (chat_id, user_id) in self.approved_users:
+                self.approved_users.discard((chat_id, user_id))
                 await self.send_welcome_message(update, context, chat_member_update.new_chat_member.user)
-                self.approved_users.remove(user_id)  # Удаляем из списка после отправки приветствия
-                
-                # Обновляем счетчик участников при успешном вступлении
-                await self.update_members_count(context, chat_id)
         
         # Отслеживаем людей, покидающих группу
         elif (old_status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR] and 
-              new_status in [ChatMember.LEFT, ChatMember.KICKED]):
+              new_status in [ChatMember.LEFT, ChatMember.BANNED]):
             
             # Обновляем статистику покинувших для конкретного канала
             chat_title = update.effective_chat.title or f"Чат {chat_id}"
             self.get_or_create_channel_stats(chat_id, chat_title)
-            self.update_channel_stats(chat_id, 'hourly_left')
-            self.update_channel_stats(chat_id, 'daily_left')
-            self.update_channel_stats(chat_id, 'total_left')
+            self.update_channel_stats(chat_id, TOTAL_LEFT)
+            self.event_log.append(EVENT_LEFT, int(chat_id))
             
             # Обновляем счетчик участников
-            await self.update_members_count(context, chat_id)
+            self.apply_member_delta(chat_id, -1)
             
             logger.info(f"Пользователь {chat_member_update.new_chat_member.user.first_name} ({user_id}) покинул чат '{chat_title}' ({chat_type})")
     
+    @api_feature('member_updates')
+    async def handle_my_chat_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отслеживает изменения статуса самого бота в чатах (добавление, права, удаление)"""
+        if not update.my_chat_member:
+            return
+        
+        member_update = update.my_chat_member
+        chat = member_update.chat
+        old_status = member_update.old_chat_member.status
+        new_status = member_update.new_chat_member.status
+        
+        can_send = self.bot_permissions.update_from_member(chat.id, member_update.new_chat_member, chat.type)
+        logger.info(f"🤖 Статус бота в чате '{chat.title or chat.id}' ({chat.id}): {old_status} → {new_status}, может писать: {'да' if can_send else 'нет'}")
+        
+        # Бот тоже входит в список админов чата
+        if is_admin_change(old_status, new_status):
+            self.admin_roster.invalidate(chat.id)
+        
+        if new_status in [ChatMember.LEFT, ChatMember.BANNED]:
+            # Бота удалили из чата - больше не отслеживаем его
+            self.untrack_group(str(chat.id))
+    
+    @api_feature('welcome')
     async def send_welcome_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user):
         """Отправляет приветственное сообщение новому участнику"""
         chat_id = update.effective_chat.id
         chat_type = update.effective_chat.type
         welcome_text = self.config.get("welcome_message", "🎉 Добро пожаловать в нашу группу!")
         
-        # Проверяем права бота на отправку сообщений
+        # Проверяем права бота на отправку сообщений (из кэша, API - только если кэш устарел)
         try:
-            bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-            if not bot_member.can_send_messages:
+            if not await self.bot_permissions.can_send(context.bot, chat_id, chat_type):
                 logger.warning(f"Бот не может отправлять сообщения в чат {chat_id}")
                 return
         except (BadRequest, Forbidden) as e:
@@ -220,25 +381,38 @@ class TelegramBot:
             user_mention = f"[{user.first_name}](tg://user?id={user.id})"
             personalized_message = f"{user_mention}, {welcome_text}"
         
-        try:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=personalized_message,
-                parse_mode=ParseMode.MARKDOWN
-            )
+        # Только ставим в очередь: обновления чата не должны ждать лимитов отправки
+        future = self.outbox.submit(chat_id, PRIORITY_WELCOME, text=personalized_message, parse_mode=ParseMode.MARKDOWN)
+        future.add_done_callback(lambda sent: self.welcome_sent(sent, chat_id, chat_type, user, welcome_text))
+    
+    def welcome_sent(self, future: asyncio.Future, chat_id: int, chat_type: str, user, welcome_text: str):
+        """Итог отправки приветствия (если не прошла разметка - повтор простым текстом)"""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
             logger.info(f"Отправлено приветственное сообщение пользователю {user.first_name} ({user.id}) в {chat_type}")
-        except (BadRequest, Forbidden) as e:
-            logger.error(f"Ошибка при отправке приветственного сообщения: {e}")
+        elif isinstance(error, (BadRequest, Forbidden)):
+            logger.error(f"Ошибка при отправке приветственного сообщения: {error}")
             # Пробуем отправить без форматирования
-            try:
-                simple_message = f"Добро пожаловать, {user.first_name}! {welcome_text}"
-                await context.bot.send_message(chat_id=chat_id, text=simple_message)
-                logger.info(f"Отправлено упрощенное приветственное сообщение")
-            except Exception as e2:
-                logger.error(f"Не удалось отправить даже упрощенное сообщение: {e2}")
+            simple_message = f"Добро пожаловать, {user.first_name}! {welcome_text}"
+            self.outbox.submit(chat_id, PRIORITY_WELCOME, text=simple_message).add_done_callback(self.simple_welcome_sent)
+        else:
+            logger.warning(f"⚠️ Приветственное сообщение не отправлено: {error}")
     
+    @staticmethod
+    def simple_welcome_sent(future: asyncio.Future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            logger.info(f"Отправлено упрощенное приветственное сообщение")
+        else:
+            logger.error(f"Не удалось отправить даже упрощенное сообщение: {error}")
+    
+    @api_feature('admin_notifications')
     async def notify_admins(self, context: ContextTypes.DEFAULT_TYPE, request):
-        """Уведомляет администраторов о новой заявке"""
+        """Уведомляет администраторов о новой заявке (при всплесках - дайджестом)"""
         try:
             # Безопасное форматирование без специальных символов
             username = request.from_user.username if request.from_user.username else 'не указан'
@@ -252,59 +426,75 @@ class TelegramBot:
                 f"👤 Username: {username}\n"
                 f"⏰ Автоматическое одобрение через {delay_minutes} минут"
             )
+            user_line = f"{request.from_user.first_name}{last_name} (ID: {request.from_user.id}, username: {username})"
+            chat_title = request.chat.title or f"Чат {request.chat.id}"
             
-            # Получаем список администраторов
-            chat_admins = await context.bot.get_chat_administrators(request.chat.id)
+            # Получаем список администраторов (из кэша, если он актуален)
+            chat_admins = await self.admin_roster.get(context.bot, request.chat.id)
             
             for admin in chat_admins:
                 if not admin.user.is_bot:  # Не отправляем ботам
-                    try:
-                        await context.bot.send_message(
-                            chat_id=admin.user.id,
-                            text=admin_message
-                        )
-                        logger.info(f"✅ Уведомление отправлено админу {admin.user.first_name} ({admin.user.id})")
-                    except Forbidden:
-                        logger.info(f"ℹ️ Админ {admin.user.first_name} ({admin.user.id}) не начал диалог с ботом - уведомление пропущено")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Ошибка отправки уведомления админу {admin.user.id}: {e}")
+                    await self.admin_digest.add(admin.user.id, request.chat.id, chat_title, user_line, admin_message)
                         
         except Exception as e:
             logger.error(f"Ошибка при уведомлении администраторов: {e}")
     
-    def get_or_create_channel_stats(self, chat_id: str, chat_title: str):
+    async def send_admin_notification(self, admin_id: int, text: str):
+        """Ставит уведомление (или дайджест) о заявках одному админу в очередь, не дожидаясь доставки"""
+        future = self.outbox.submit(admin_id, PRIORITY_ADMIN_NOTICE, text=text)
+        future.add_done_callback(lambda sent: self.admin_notification_sent(sent, admin_id))
+    
+    @staticmethod
+    def admin_notification_sent(future: asyncio.Future, admin_id: int):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            logger.info(f"✅ Уведомление отправлено админу {admin_id}")
+        elif isinstance(error, Forbidden):
+            logger.info(f"ℹ️ Админ {admin_id} не начал диалог с ботом - уведомление пропущено")
+        else:
+            logger.warning(f"⚠️ Ошибка отправки уведомления админу {admin_id}: {error}")
+    
+    def track_group(self, chat_id: str):
+        if chat_id not in self.tracked_groups:
+            self.tracked_groups.add(chat_id)
+            self.write_behind.notify()
+    
+    def untrack_group(self, chat_id: str):
+        if chat_id in self.tracked_groups:
+            self.tracked_groups.discard(chat_id)
+            self.member_counts.forget(chat_id)
+            self.reports.forget(chat_id)
+            self.write_behind.notify()
+    
+    def get_or_create_channel_stats(self, chat_id: str, chat_title: str) -> ChannelStats:
         """Создает или возвращает статистику для канала"""
-        if chat_id not in self.channel_stats:
-            self.channel_stats[chat_id] = {
-                'title': chat_title,
-                'hourly_requests': 0,
-                'hourly_left': 0,
-                'daily_requests': 0,
-                'daily_left': 0,
-                'total_requests': 0,
-                'total_approved': 0,
-                'total_left': 0,
-                'current_members': 0,  # Текущее количество участников
-                'initial_members': 0,  # Количество участников при первом запуске
-                'last_activity': datetime.now()
-            }
+        stats = self.channel_stats.get(chat_id)
+        if stats is None:
+            stats = self.channel_stats.create(chat_id, chat_title)
             logger.info(f"Создана статистика для канала '{chat_title}' ({chat_id})")
-        return self.channel_stats[chat_id]
+        return stats
     
-    def update_channel_stats(self, chat_id: str, stat_type: str):
-        """Обновляет статистику канала"""
-        if chat_id in self.channel_stats:
-            self.channel_stats[chat_id][stat_type] += 1
-            self.channel_stats[chat_id]['last_activity'] = datetime.now()
-            
-            # Обновляем глобальную статистику
-            if stat_type in self.global_stats:
-                self.global_stats[stat_type] += 1
+    def update_channel_stats(self, chat_id: str, metric: int):
+        """Обновляет статистику канала (metric - id счетчика из stats.py)"""
+        stats = self.channel_stats.get(chat_id)
+        if stats is not None:
+            # Счетчик канала и глобальная сумма обновляются в общем массиве
+            self.channel_stats.increment(stats, metric)
 
+    def apply_member_delta(self, chat_id: str, delta: int):
+        """Меняет счетчик участников по обновлению chat_member без запроса к API"""
+        stats = self.channel_stats.get(chat_id)
+        if stats is None or stats.current_members <= 0:
+            return  # Счетчик еще неизвестен - его получит сверка
+        self.channel_stats.increment(stats, CURRENT_MEMBERS, delta)
+        self.member_counts.record_change(chat_id, delta)
+    
     async def update_members_count(self, context: ContextTypes.DEFAULT_TYPE, chat_id: str):
-        """Обновляет количество участников в канале/группе"""
+        """Сверяет количество участников в канале/группе с API"""
         try:
-            chat = await context.bot.get_chat(int(chat_id))
+            chat = await self.chat_info.get(context.bot, int(chat_id))
             
             # Получаем количество участников
             if chat.type == ChatType.CHANNEL:
@@ -324,250 +514,260 @@ class TelegramBot:
                 return
             
             # Обновляем статистику
-            if chat_id in self.channel_stats:
-                old_count = self.channel_stats[chat_id]['current_members']
-                self.channel_stats[chat_id]['current_members'] = member_count
+            self.member_counts.reconciled(chat_id)
+            stats = self.channel_stats.get(chat_id)
+            if stats is not None:
+                old_count = stats.current_members
+                stats.current_members = member_count
                 
                 # Устанавливаем начальное количество если это первый раз
-                if self.channel_stats[chat_id]['initial_members'] == 0:
-                    self.channel_stats[chat_id]['initial_members'] = member_count
+                if stats.initial_members == 0:
+                    stats.initial_members = member_count
                     logger.info(f"📊 Установлено начальное количество участников для '{chat.title}': {member_count}")
                 elif old_count != member_count:
                     change = member_count - old_count
                     change_emoji = "📈" if change > 0 else "📉" if change < 0 else "➖"
-                    logger.info(f"👥 Обновлено количество участников '{chat.title}': {old_count} → {member_count} ({change_emoji}{change:+d})")
+                    logger.info(f"👥 Сверено количество участников '{chat.title}': {old_count} → {member_count} ({change_emoji}{change:+d})")
                     
         except Exception as e:
             logger.warning(f"⚠️ Не удалось обновить количество участников для {chat_id}: {e}")
 
 
 
+    def query_window(self, start: int, end: int):
+        """Счетчики событий за период: (суммы по типам событий, [(ChannelStats или None, chat_id, счетчики)])"""
+        counts_by_chat = self.event_log.query(start, end)
+        channels = []
+        for chat_id, counts in counts_by_chat.items():
+            channels.append((self.channel_stats.get(str(chat_id)), chat_id, counts))
+        # Порядок каналов - как в общей статистике (по порядку добавления)
+        channels.sort(key=lambda item: item[0].slot if item[0] is not None else len(self.channel_stats))
+        return EventLog.totals(counts_by_chat), channels
+
+    @api_feature('stats_reports')
     async def send_hourly_stats(self, context: ContextTypes.DEFAULT_TYPE):
-        """Отправляет почасовую статистику администраторам"""
-        # Проверяем есть ли активность
-        total_requests = sum(stats['hourly_requests'] for stats in self.channel_stats.values())
-        total_left = sum(stats['hourly_left'] for stats in self.channel_stats.values())
+        """Отправляет почасовую статистику администраторам.
+
+        Отчет строится по журналу событий за период с прошлого доставленного отчета,
+        поэтому пропущенный час (перезапуск, ошибка отправки, перегрузка) попадает в следующий отчет.
+        """
+        if self.ingress.overloaded:
+            logger.warning("⏳ Очередь обновлений перегружена, почасовой отчет отложен")
+            return
         
+        window_start = self.report_windows['hourly']
+        window_end = int(time.time())
+        totals, channels = self.query_window(window_start, window_end)
+        total_requests = totals[EVENT_REQUEST]
+        total_left = totals[EVENT_LEFT]
+        
+        # Проверяем есть ли активность
         if total_requests == 0 and total_left == 0:
+            self.report_windows['hourly'] = window_end
+            self.write_behind.notify()
             return  # Не отправляем пустую статистику
         
-        current_time = datetime.now().strftime("%H:%M")
-        
-        # Глобальная статистика
-        global_message = (
-            f"📊 Общая статистика за час ({current_time}):\n"
-            f"📈 Новых заявок: {total_requests}\n"
-            f"📉 Покинули: {total_left}\n"
-            f"🔄 Чистый прирост: {total_requests - total_left}\n\n"
-        )
-        
-        # Статистика по каналам
-        channel_details = []
-        for chat_id, stats in self.channel_stats.items():
-            if stats['hourly_requests'] > 0 or stats['hourly_left'] > 0:
-                channel_growth = stats['hourly_requests'] - stats['hourly_left']
-                growth_emoji = "📈" if channel_growth > 0 else "📉" if channel_growth < 0 else "➖"
-                
-                members_info = ""
-                if stats.get('current_members', 0) > 0:
-                    members_info = f"\n  👥 Участников: {stats['current_members']}"
-                
-                channel_details.append(
-                    f"🏷️ {stats['title'][:30]}:\n"
-                    f"  📝 Заявок: {stats['hourly_requests']}\n"
-                    f"  👋 Покинули: {stats['hourly_left']}\n"
-                    f"  {growth_emoji} Прирост: {channel_growth}{members_info}"
-                )
-        
-        if channel_details:
-            stats_message = global_message + "📋 По каналам:\n" + "\n\n".join(channel_details)
+        if window_end - window_start <= 2 * 3600:
+            period = f"за час ({datetime.fromtimestamp(window_end).strftime('%H:%M')})"
         else:
-            stats_message = global_message.rstrip()
+            period = f"с {datetime.fromtimestamp(window_start).strftime('%d.%m %H:%M')} по {datetime.fromtimestamp(window_end).strftime('%d.%m %H:%M')}"
         
-        await self.send_stats_to_admins(context, stats_message)
+        pages = self.reports.hourly(period, totals, channels)
         
-        # Сбрасываем почасовую статистику
-        for stats in self.channel_stats.values():
-            stats['hourly_requests'] = 0
-            stats['hourly_left'] = 0
-        self.global_stats['hourly_requests'] = 0
-        self.global_stats['hourly_left'] = 0
+        # Период закрывается только если отчет кто-то получил
+        if await self.send_stats_to_admins(context, pages):
+            self.report_windows['hourly'] = window_end
+            self.write_behind.notify()
     
+    @api_feature('stats_reports')
     async def send_daily_stats(self, context: ContextTypes.DEFAULT_TYPE):
         """Отправляет статистику за 8 часов администраторам"""
+        if self.ingress.overloaded:
+            logger.warning("⏳ Очередь обновлений перегружена, отчет за 8 часов отложен")
+            return
+        
         current_time = datetime.now().strftime("%d.%m.%Y %H:%M")
+        window_end = int(time.time())
+        window_totals, channels = self.query_window(self.report_windows['daily'], window_end)
+        window_counts = {chat_id: counts for _, chat_id, counts in channels}
         
-        # Глобальная статистика за 8 часов
-        total_daily_requests = sum(stats['daily_requests'] for stats in self.channel_stats.values())
-        total_daily_left = sum(stats['daily_left'] for stats in self.channel_stats.values())
-        total_approved = sum(stats['total_approved'] for stats in self.channel_stats.values())
-        total_requests = sum(stats['total_requests'] for stats in self.channel_stats.values())
-        total_left = sum(stats['total_left'] for stats in self.channel_stats.values())
-        
-        global_message = (
-            f"📈 Общий отчет за 8 часов ({current_time}):\n\n"
-            f"📝 Новых заявок: {total_daily_requests}\n"
-            f"✅ Одобрено: {total_approved}\n"
-            f"👋 Покинули: {total_daily_left}\n"
-            f"🔄 Чистый прирост: {total_daily_requests - total_daily_left}\n\n"
-            f"📊 Общая статистика с запуска:\n"
-            f"📋 Всего заявок: {total_requests}\n"
-            f"✅ Всего одобрено: {total_approved}\n"
-            f"👋 Всего покинуло: {total_left}\n\n"
+        pages = self.reports.daily(
+            current_time, window_totals, self.channel_stats.totals,
+            self.channel_stats.active_channels(TOTAL_REQUESTS, TOTAL_LEFT), window_counts
         )
         
-        # Детальная статистика по каналам
-        channel_details = []
-        for chat_id, stats in self.channel_stats.items():
-            if stats['total_requests'] > 0 or stats['total_left'] > 0:
-                daily_growth = stats['daily_requests'] - stats['daily_left']
-                total_growth = stats['total_requests'] - stats['total_left']
-                
-                daily_emoji = "📈" if daily_growth > 0 else "📉" if daily_growth < 0 else "➖"
-                total_emoji = "📈" if total_growth > 0 else "📉" if total_growth < 0 else "➖"
-                
-                # Информация о подписчиках
-                members_info = ""
-                if stats.get('current_members', 0) > 0:
-                    initial = stats.get('initial_members', 0)
-                    current = stats['current_members']
-                    if initial > 0:
-                        growth_from_start = current - initial
-                        growth_emoji_total = "📈" if growth_from_start > 0 else "📉" if growth_from_start < 0 else "➖"
-                        members_info = f"\n  👥 Участников: {current} (старт: {initial}, {growth_emoji_total}{growth_from_start:+d})"
-                    else:
-                        members_info = f"\n  👥 Участников: {current}"
-                
-                channel_details.append(
-                    f"🏷️ {stats['title'][:35]}:\n"
-                    f"  📝 За 8 часов: {stats['daily_requests']} заявок, {stats['daily_left']} покинули\n"
-                    f"  {daily_emoji} Прирост за 8ч: {daily_growth}\n"
-                    f"  📊 Всего: {stats['total_requests']} заявок, {stats['total_approved']} одобрено\n"
-                    f"  {total_emoji} Общий прирост: {total_growth}{members_info}"
-                )
-        
-        if channel_details:
-            stats_message = global_message + "📋 Детализация по каналам:\n\n" + "\n\n".join(channel_details)
-        else:
-            stats_message = global_message.rstrip()
-        
-        await self.send_stats_to_admins(context, stats_message)
-        
-        # Сбрасываем дневную статистику
-        for stats in self.channel_stats.values():
-            stats['daily_requests'] = 0
-            stats['daily_left'] = 0
-        self.global_stats['daily_requests'] = 0
-        self.global_stats['daily_left'] = 0
+        # Период закрывается только если отчет кто-то получил
+        if await self.send_stats_to_admins(context, pages):
+            self.report_windows['daily'] = window_end
+            self.write_behind.notify()
     
-    async def send_stats_to_admins(self, context: ContextTypes.DEFAULT_TYPE, message: str):
-        """Отправляет статистику всем администраторам всех отслеживаемых групп"""
-        sent_to_admins = set()  # Чтобы не отправлять дубли одному админу
-        
+    async def send_stats_to_admins(self, context: ContextTypes.DEFAULT_TYPE, pages: List[str]) -> int:
+        """Отправляет статистику всем администраторам всех отслеживаемых групп.
+
+        Работает в три этапа: параллельно получает админов всех чатов, убирает дубли
+        и параллельно отправляет каждому админу отчет (одно или несколько сообщений).
+        Возвращает количество админов, получивших сообщение.
+        """
         # Используем отслеживаемые группы
         if not self.tracked_groups:
             logger.warning("Нет отслеживаемых групп для отправки статистики")
-            return
+            return 0
         
-        for chat_id in list(self.tracked_groups):  # Создаем копию для безопасной итерации
+        semaphore = asyncio.Semaphore(self.config.get("stats_fanout_concurrency", 16))
+        started = time.monotonic()
+        
+        # 1. Получаем админов всех чатов параллельно
+        chat_ids = list(self.tracked_groups)  # Создаем копию для безопасной итерации
+        rosters = await asyncio.gather(*(self.resolve_stats_recipients(context, chat_id, semaphore) for chat_id in chat_ids))
+        resolved_at = time.monotonic()
+        
+        # 2. Убираем дубли: админ нескольких чатов получает одно сообщение
+        recipients = {}
+        for chat_admins in rosters:
+            for admin in chat_admins:
+                if not admin.user.is_bot:
+                    recipients.setdefault(admin.user.id, admin.user)
+        
+        # 3. Отправляем параллельно (темп отправки задает очередь исходящих сообщений)
+        results = await asyncio.gather(*(self.send_stats_to_admin(user, pages, semaphore) for user in recipients.values()))
+        finished = time.monotonic()
+        
+        logger.info(
+            f"📤 Рассылка статистики: чатов {len(chat_ids)} (доступно {sum(1 for r in rosters if r)}), "
+            f"админов {len(recipients)}, доставлено {sum(results)}; "
+            f"админы за {resolved_at - started:.1f} с, отправка за {finished - resolved_at:.1f} с"
+        )
+        return sum(results)
+    
+    async def resolve_stats_recipients(self, context: ContextTypes.DEFAULT_TYPE, chat_id: str, semaphore: asyncio.Semaphore):
+        """Возвращает администраторов чата, которым нужно отправить статистику"""
+        async with semaphore:
             try:
-                # Получаем информацию о чате
-                chat = await context.bot.get_chat(int(chat_id))
+                # Получаем информацию о чате (из кэша, если она актуальна)
+                chat = await self.chat_info.get(context.bot, int(chat_id))
                 chat_type = chat.type
                 
                 # Пропускаем каналы, если бот не админ
                 if chat_type == ChatType.CHANNEL:
                     try:
-                        bot_member = await context.bot.get_chat_member(int(chat_id), context.bot.id)
-                        if bot_member.status not in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]:
-                            continue
+                        if not await self.bot_permissions.is_admin(context.bot, int(chat_id), chat_type):
+                            return ()
                     except (BadRequest, Forbidden):
-                        continue
-                
-                chat_admins = await context.bot.get_chat_administrators(int(chat_id))
+                        return ()
                 
-                for admin in chat_admins:
-                    if not admin.user.is_bot and admin.user.id not in sent_to_admins:
-                        try:
-                            await context.bot.send_message(
-                                chat_id=admin.user.id,
-                                text=message  
-                            )
-                            sent_to_admins.add(admin.user.id)
-                            logger.info(f"✅ Статистика отправлена админу {admin.user.first_name} ({admin.user.id})")
-                        except Forbidden:
-                            logger.info(f"ℹ️ Админ {admin.user.first_name} ({admin.user.id}) не начал диалог с ботом - статистика пропущена")
-                        except BadRequest as e:
-                            logger.warning(f"⚠️ BadRequest при отправке статистики админу {admin.user.id}: {e}")
-                        except Exception as e:
-                            logger.error(f"❌ Неожиданная ошибка при отправке статистики админу {admin.user.id}: {e}")
+                return await self.admin_roster.get(context.bot, int(chat_id))
                             
             except (BadRequest, Forbidden) as e:
                 logger.warning(f"Нет доступа к чату {chat_id}: {e}")
                 # Удаляем недоступный чат из отслеживаемых
-                self.tracked_groups.discard(chat_id)
+                self.untrack_group(chat_id)
+                self.admin_roster.invalidate(int(chat_id))
             except Exception as e:
                 logger.error(f"Ошибка при получении админов для чата {chat_id}: {e}")
+            return ()
+    
+    async def send_stats_to_admin(self, user, pages: List[str], semaphore: asyncio.Semaphore) -> bool:
+        """Отправляет статистику одному админу, возвращает True при успехе"""
+        async with semaphore:
+            try:
+                for page in pages:
+                    await self.outbox.send_message(user.id, page, PRIORITY_STATS, parse_mode=self.reports.parse_mode)
+                logger.info(f"✅ Статистика отправлена админу {user.first_name} ({user.id})")
+                return True
+            except Forbidden:
+                logger.info(f"ℹ️ Админ {user.first_name} ({user.id}) не начал диалог с ботом - статистика пропущена")
+            except BadRequest as e:
+                logger.warning(f"⚠️ BadRequest при отправке статистики админу {user.id}: {e}")
+            except Exception as e:
+                logger.error(f"❌ Неожиданная ошибка при отправке статистики админу {user.id}: {e}")
+            return False
+    
+    def stats_state(self) -> Dict:
+        """Состояние бота, которое сохраняется вместе со статистикой каналов"""
+        return {
+            'tracked_groups': list(self.tracked_groups),
+            'report_windows': self.report_windows,
+        }
+    
+    async def save_stats(self):
+        """Сохраняет измененную статистику в хранилище (запись идет в отдельном потоке)"""
+        self.event_log.flush()
+        changed = self.channel_stats.take_dirty()
+        try:
+            await self.storage.save_async(self.channel_stats, changed, self.stats_state())
+            logger.debug(f"Статистика сохранена (изменено каналов: {len(changed)})")
+        except Exception as e:
+            self.restore_dirty(changed)
+            logger.error(f"Ошибка при сохранении статистики: {e}")
     
     def save_stats_to_file(self):
-        """Сохраняет статистику в файл"""
+        """Синхронно сохраняет измененную статистику (при завершении по сигналу)"""
+        changed = self.channel_stats.take_dirty()
         try:
-            stats_data = {
-                'channel_stats': {},
-                'global_stats': self.global_stats,
-                'tracked_groups': list(self.tracked_groups),
-                'last_saved': datetime.now().isoformat()
-            }
-            
-            # Конвертируем datetime в строки для JSON
-            for chat_id, stats in self.channel_stats.items():
-                stats_copy = stats.copy()
-                if 'last_activity' in stats_copy:
-                    stats_copy['last_activity'] = stats_copy['last_activity'].isoformat()
-                stats_data['channel_stats'][chat_id] = stats_copy
-            
-            with open('bot_stats.json', 'w', encoding='utf-8') as f:
-                json.dump(stats_data, f, ensure_ascii=False, indent=2)
-            
-            logger.info("Статистика сохранена в файл")
+            self.storage.save(self.channel_stats, changed, self.stats_state())
+            logger.info(f"Статистика сохранена (изменено каналов: {len(changed)})")
         except Exception as e:
+            self.restore_dirty(changed)
             logger.error(f"Ошибка при сохранении статистики: {e}")
     
+    def restore_dirty(self, changed):
+        """Каналы остаются измененными до следующей успешной записи"""
+        for stats in changed:
+            self.channel_stats.mark_dirty(stats)
+    
     def load_stats_from_file(self):
-        """Загружает статистику из файла"""
+        """Загружает статистику из хранилища"""
         try:
-            with open('bot_stats.json', 'r', encoding='utf-8') as f:
-                stats_data = json.load(f)
+            state = self.storage.load(self.channel_stats)
+            self.channel_stats.take_dirty()  # загруженные каналы уже сохранены
             
             # Загружаем данные
-            self.global_stats = stats_data.get('global_stats', self.global_stats)
-            self.tracked_groups = set(stats_data.get('tracked_groups', []))
+            self.tracked_groups = set(state.get('tracked_groups', []))
+            self.report_windows.update(state.get('report_windows', {}))
             
-            # Загружаем статистику каналов
-            for chat_id, stats in stats_data.get('channel_stats', {}).items():
-                if 'last_activity' in stats and isinstance(stats['last_activity'], str):
-                    try:
-                        stats['last_activity'] = datetime.fromisoformat(stats['last_activity'])
-                    except:
-                        stats['last_activity'] = datetime.now()
-                self.channel_stats[chat_id] = stats
-            
-            logger.info(f"Загружена статистика для {len(self.channel_stats)} каналов")
-        except FileNotFoundError:
-            logger.info("Файл статистики не найден, начинаем с пустой статистики")
+            if len(self.channel_stats) or self.tracked_groups:
+                logger.info(f"Загружена статистика для {len(self.channel_stats)} каналов")
+            else:
+                logger.info("Сохраненной статистики нет, начинаем с пустой статистики")
         except Exception as e:
-            logger.error(f"Ошибка при загрузке статистики: {e}")
+            logger.error(f"❌ Ошибка при загрузке статистики, бот начнет с пустой статистики: {e}")
     
+    def check_stats_consistency(self):
+        """Проверяет, что глобальные суммы совпадают с суммами по каналам"""
+        mismatches = self.channel_stats.verify_totals()
+        for name, (expected, actual) in mismatches.items():
+            logger.warning(f"⚠️ Расхождение глобальной статистики '{name}': {expected} → {actual} (исправлено)")
+
     async def periodic_save_stats(self, context: ContextTypes.DEFAULT_TYPE):
-        """Периодически сохраняет статистику"""
-        self.save_stats_to_file()
+        """Периодически проверяет статистику и сжимает журнал событий (сохранение - в WriteBehind)"""
+        self.check_stats_consistency()
+        try:
+            # Снимок агрегатов и перезапись журнала - в потоке хранилища
+            compaction = self.event_log.compaction()
+            if compaction is not None:
+                await self.storage.run_async(compaction)
+        except OSError as e:
+            logger.error(f"Ошибка при сжатии журнала событий: {e}")
 
+    @api_feature('member_counts')
     async def update_all_members_count(self, context: ContextTypes.DEFAULT_TYPE):
-        """Периодически обновляет счетчики участников для всех отслеживаемых каналов"""
-        logger.info("🔄 Обновление счетчиков участников...")
+        """Периодически сверяет с API счетчики участников, которым уже нельзя доверять"""
+        if self.ingress.overloaded:
+            logger.warning("⏳ Очередь обновлений перегружена, сверка счетчиков пропущена")
+            return
+        
+        # Чаты без статистики не сверяем: их счетчик все равно негде хранить
+        chats = [(chat_id, stats.current_members, self.channel_stats.activity[stats.slot])
+                 for chat_id in list(self.tracked_groups)
+                 if (stats := self.channel_stats.get(chat_id)) is not None]
+        due = self.member_counts.due(chats, self.config.get("member_count_reconcile_limit", 20))
+        if not due:
+            return
+        
+        logger.info(f"🔄 Сверка счетчиков участников: {len(due)} из {len(chats)} чатов...")
         
         updated_count = 0
-        for chat_id in list(self.tracked_groups):
+        for chat_id in due:
             try:
                 await self.update_members_count(context, chat_id)
                 updated_count += 1
@@ -575,10 +775,41 @@ class TelegramBot:
                 logger.warning(f"⚠️ Ошибка обновления счетчика для {chat_id}: {e}")
         
         if updated_count > 0:
-            logger.info(f"✅ Обновлены счетчики для {updated_count} каналов")
-        
-        # Сохраняем обновленную статистику
-        self.save_stats_to_file()
+            logger.info(f"✅ Сверены счетчики для {updated_count} каналов")
+
+    async def post_init(self, application: Application):
+        """Запускает фоновые службы после инициализации приложения"""
+        self.outbox.start(application.bot)
+        self.approval_scheduler.start(self.approval_worker.process)
+        self.write_behind.start()
+        logger.info(f"Планировщик одобрений запущен, ожидающих заявок: {len(self.approval_scheduler)}")
+
+    async def post_stop(self, application: Application):
+        """Досылает очередь сообщений, пока клиент Bot API еще не закрыт"""
+        # Сначала дорабатываются принятые обновления - они еще ставят сообщения в очередь
+        await self.ingress.drain()
+        await self.admin_digest.flush_all()
+        await self.outbox.stop()
+        await self.approval_scheduler.stop()
+
+    async def post_shutdown(self, application: Application):
+        """Сохраняет данные и закрывает хранилища при завершении приложения"""
+        await self.write_behind.stop()
+        self.event_log.close()
+        self.storage.close()
+
+    async def log_diagnostics_summary(self, context: ContextTypes.DEFAULT_TYPE):
+        """Пишет в лог сводку по обновлениям и состояние очереди обработки"""
+        self.diagnostics.log_summary(
+            queued=self.ingress.queued,
+            running=self.ingress.running,
+            processed=self.ingress.processed,
+            shed=self.ingress.shed
+        )
+
+    async def log_api_summary(self, context: ContextTypes.DEFAULT_TYPE):
+        """Пишет в лог сводку запросов к Bot API за прошедший интервал"""
+        self.api_monitor.log_summary()
 
     async def setup_periodic_tasks(self, context: ContextTypes.DEFAULT_TYPE):
         """Настраивает периодические задачи для статистики"""
@@ -599,7 +830,7 @@ class TelegramBot:
                 name="daily_stats"
             )
             
-            # Периодическое сохранение статистики
+            # Периодическая проверка статистики и сжатие журнала событий
             context.job_queue.run_repeating(
                 self.periodic_save_stats,
                 interval=3600,  # каждые 60 минут
@@ -607,18 +838,58 @@ class TelegramBot:
                 name="save_stats"
             )
             
-            # Периодическое обновление счетчиков участников
+            # Периодическая сверка счетчиков участников с API
+            # Каждый тик сверяются чаты своего слота, полный круг - member_count_reconcile_interval
             context.job_queue.run_repeating(
                 self.update_all_members_count,
-                interval=1800,  # каждые 30 минут
-                first=600,      # первое обновление через 10 минут после запуска
+                interval=self.member_counts.tick,
+                first=self.member_counts.tick,
                 name="update_members"
             )
             
+            # Сводка запросов к Bot API по методам и функциям бота
+            api_summary_interval = self.config.get("api_stats_log_interval", 900)
+            if api_summary_interval:
+                context.job_queue.run_repeating(
+                    self.log_api_summary,
+                    interval=api_summary_interval,
+                    first=api_summary_interval,
+                    name="api_summary"
+                )
+            
+            # Сводка диагностики по типам обновлений
+            summary_interval = self.config.get("diagnostics_summary_interval", 300)
+            if summary_interval:
+                context.job_queue.run_repeating(
+                    self.log_diagnostics_summary,
+                    interval=summary_interval,
+                    first=summary_interval,
+                    name="diagnostics_summary"
+                )
+            
             logger.info("Настроены периодические задачи для статистики")
         else:
             logger.error("JobQueue не настроен для периодических задач!")
 
+    async def is_stats_admin(self, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+        """Является ли пользователь администратором хотя бы одного отслеживаемого чата"""
+        return await self.admin_roster.is_admin_of_any(
+            context.bot, user_id, [int(chat_id) for chat_id in self.tracked_groups]
+        )
+    
+    @api_feature('stats_command')
+    async def handle_apistats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обрабатывает команду /apistats: запросы к Bot API по методам и функциям бота"""
+        if not update.message:
+            return
+        
+        if not await self.is_stats_admin(context, update.effective_user.id):
+            await update.message.reply_text("❌ У вас нет прав для просмотра статистики")
+            return
+        
+        await update.message.reply_text(self.api_monitor.format_report())
+    
+    @api_feature('stats_command')
     async def handle_stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает команду /stats для получения текущей статистики"""
         if not update.message:
@@ -627,17 +898,7 @@ class TelegramBot:
         user_id = update.effective_user.id
         
         # Проверяем, является ли пользователь администратором хотя бы одного канала
-        is_admin = False
-        for chat_id in self.tracked_groups:
-            try:
-                chat_admins = await context.bot.get_chat_administrators(int(chat_id))
-                if any(admin.user.id == user_id and not admin.user.is_bot for admin in chat_admins):
-                    is_admin = True
-                    break
-            except Exception:
-                continue
-        
-        if not is_admin:
+        if not await self.is_stats_admin(context, user_id):
             await update.message.reply_text("❌ У вас нет прав для просмотра статистики")
             return
         
@@ -648,114 +909,73 @@ class TelegramBot:
             await update.message.reply_text("📊 Статистика пуста - бот еще не обрабатывал заявки")
             return
         
-        # Общая статистика
-        total_requests = sum(stats['total_requests'] for stats in self.channel_stats.values())
-        total_approved = sum(stats['total_approved'] for stats in self.channel_stats.values())
-        total_left = sum(stats['total_left'] for stats in self.channel_stats.values())
-        total_members = sum(stats.get('current_members', 0) for stats in self.channel_stats.values())
-        
-        message = (
-            f"📊 Текущая статистика ({current_time}):\n\n"
-            f"🌐 ОБЩАЯ СТАТИСТИКА:\n"
-            f"📋 Всего заявок: {total_requests}\n"
-            f"✅ Одобрено: {total_approved}\n"
-            f"👋 Покинули: {total_left}\n"
-            f"🔄 Общий прирост: {total_requests - total_left}\n"
+        pages = self.reports.current(
+            current_time, self.channel_stats.totals, len(self.pending_requests),
+            self.channel_stats.active_channels(TOTAL_REQUESTS, TOTAL_LEFT), self.pending_requests.count_for_chat
         )
         
-        if total_members > 0:
-            message += f"👥 Всего участников: {total_members}\n"
-        
-        message += "\n"
-        
-        # Статистика по каналам
-        active_channels = [(chat_id, stats) for chat_id, stats in self.channel_stats.items() 
-                          if stats['total_requests'] > 0 or stats['total_left'] > 0]
-        
-        if active_channels:
-            message += "📋 ПО КАНАЛАМ:\n"
-            for i, (chat_id, stats) in enumerate(active_channels, 1):
-                growth = stats['total_requests'] - stats['total_left']
-                growth_emoji = "📈" if growth > 0 else "📉" if growth < 0 else "➖"
-                
-                # Информация о участниках
-                members_line = ""
-                if stats.get('current_members', 0) > 0:
-                    current = stats['current_members']
-                    initial = stats.get('initial_members', 0)
-                    if initial > 0 and initial != current:
-                        change = current - initial
-                        change_emoji = "📈" if change > 0 else "📉" if change < 0 else "➖"
-                        members_line = f"   👥 Участников: {current} ({change_emoji}{change:+d} от старта)\n"
-                    else:
-                        members_line = f"   👥 Участников: {current}\n"
-                
-                message += (
-                    f"\n{i}. 🏷️ {stats['title'][:30]}:\n"
-                    f"   📥 Заявок: {stats['total_requests']}\n"
-                    f"   ✅ Одобрено: {stats['total_approved']}\n"
-                    f"   👋 Покинули: {stats['total_left']}\n"
-                    f"   {growth_emoji} Прирост: {growth}\n"
-                    f"{members_line}"
-                )
-        
         try:
-            await update.message.reply_text(message)
+            for page in pages:
+                await update.message.reply_text(page, parse_mode=self.reports.parse_mode)
         except Exception as e:
             logger.error(f"Ошибка при отправке статистики: {e}")
             await update.message.reply_text("❌ Ошибка при получении статистики")
 
-    async def handle_any_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обрабатывает любые входящие обновления для диагностики"""
-        try:
-            update_info = []
-            
-            if update.message:
-                update_info.append(f"📨 Сообщение от {update.message.from_user.first_name}")
-            if update.chat_join_request:
-                update_info.append(f"📝 Заявка на вступление от {update.chat_join_request.from_user.first_name}")
-            if update.chat_member:
-                update_info.append(f"👥 Изменение участника: {update.chat_member.new_chat_member.user.first_name}")
-            
-            if update_info:
-                logger.info(f"🔔 Получено обновление: {', '.join(update_info)}")
-            else:
-                logger.info(f"🔔 Получено обновление типа: {type(update)}")
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка в handle_any_update: {e}")
-
-    def run(self):
-        """Запускает бота"""
+    def build_application(self, base_url: Optional[str] = None) -> Application:
+        """Создает приложение PTB с обработчиками и задачами бота.
+        
+        base_url позволяет направить запросы к Bot API на другой сервер
+        (например, на локальную заглушку из benchmark.py).
+        """
         # Создаем приложение с JobQueue
         from telegram.ext import JobQueue
         
-        application = (
+        builder = (
             Application.builder()
             .token(self.token)
             .job_queue(JobQueue())
-            .build()
+            .concurrent_updates(self.ingress)
+            .rate_limiter(self.api_monitor)
+            # Небольшой буфер между webhook и очередью обработки: когда он полон, webhook ждет
+            .update_queue(asyncio.Queue(maxsize=self.ingress.concurrency))
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
         )
+        if base_url:
+            builder = builder.base_url(base_url)
+        application = builder.build()
+        self.application = application
         
         # Регистрируем обработчики
         application.add_handler(CommandHandler("stats", self.handle_stats_command))
+        application.add_handler(CommandHandler("apistats", self.handle_apistats_command))
         application.add_handler(ChatJoinRequestHandler(self.handle_chat_join_request))
-        application.add_handler(ChatMemberHandler(self.handle_chat_member_update))
+        application.add_handler(ChatMemberHandler(self.handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+        application.add_handler(ChatMemberHandler(self.handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
         
-        # Добавляем простой обработчик для проверки работы webhook
-        from telegram.ext import MessageHandler, filters
-        application.add_handler(MessageHandler(filters.ALL, self.handle_any_update))
+        # Кэш чатов и диагностика видят все обновления до основных обработчиков (группы -2 и -1)
+        from telegram.ext import TypeHandler
+        application.add_handler(TypeHandler(Update, self.remember_chat), group=-2)
+        application.add_handler(TypeHandler(Update, self.diagnostics.record), group=-1)
         
         # Настраиваем периодические задачи для статистики
         application.job_queue.run_once(
             self.setup_periodic_tasks,
             0  # Запускаем сразу
         )
+        return application
+    
+    def run(self):
+        """Запускает бота"""
+        application = self.build_application()
         
         # Настраиваем graceful shutdown
         def signal_handler(signum, frame):
             logger.info("Получен сигнал завершения, сохраняем статистику...")
             self.save_stats_to_file()
+            self.storage.close()
+            self.event_log.close()
             logger.info("Останавливаем бота...")
             application.stop()
             sys.exit(0)
@@ -802,22 +1022,52 @@ class TelegramBot:
         
         logger.info(f"🌐 Запуск бота в webhook режиме")
         logger.info(f"🔗 Webhook URL: {full_webhook_url}")
-        logger.info(f"🔌 Port: {port}")
+        logger.info(f"🔌 Port: {port} (метрики: {'/metrics' if os.getenv('METRICS_TOKEN') else 'отключены, задайте METRICS_TOKEN'})")
         logger.info(f"📡 Ожидание входящих обновлений от Telegram...")
         
         try:
-            application.run_webhook(
-                listen="0.0.0.0",
-                port=port,
-                url_path=webhook_path,
-                webhook_url=full_webhook_url,
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
-            )
+            asyncio.run(self.serve_webhook(application, port, webhook_path, full_webhook_url))
         except Exception as e:
             logger.error(f"💥 Ошибка webhook: {e}")
             raise
     
+    async def serve_webhook(self, application, port: int, webhook_path: str, webhook_url: str,
+                            stop_event: Optional[asyncio.Event] = None):
+        """Webhook и /metrics на одном порту; повторяет порядок запуска и остановки run_webhook.
+        
+        Без stop_event бот работает до SIGINT/SIGTERM.
+        """
+        secret_token = os.getenv('WEBHOOK_SECRET') or None
+        metrics_token = os.getenv('METRICS_TOKEN') or None
+        server = WebhookServer(application, webhook_path, self.metrics, secret_token, metrics_token)
+        
+        if stop_event is None:
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop_event.set)
+        
+        await application.initialize()
+        try:
+            await self.post_init(application)
+            await application.start()
+            server.start("0.0.0.0", port)
+            await application.bot.set_webhook(
+                url=webhook_url,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True,
+                secret_token=secret_token
+            )
+            await stop_event.wait()
+            logger.info("Получен сигнал завершения, останавливаем бота...")
+        finally:
+            await server.stop()
+            if application.running:
+                await application.stop()
+            await self.post_stop(application)
+            await application.shutdown()
+            await self.post_shutdown(application)
+    
     def run_polling(self, application):
         """Запуск через polling (для development)"""
         logger.info("🔄 Запуск бота в polling режиме (для разработки)")
@@ -828,7 +1078,7 @@ class TelegramBot:
         while retry_count < max_retries:
             try:
                 application.run_polling(
-                    allowed_updates=Update.ALL_TYPES,
+                    allowed_updates=ALLOWED_UPDATES,
                     drop_pending_updates=True  # Игнорируем старые обновления при перезапуске
                 )
                 break  # Если polling запустился успешно, выходим из цикла
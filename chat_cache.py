@@ -0,0 +1,175 @@
+import logging
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+from telegram import Chat, ChatMember
+from telegram.constants import ChatType
+
+logger = logging.getLogger(__name__)
+
+
+class AdminRosterCache:
+    """Кэш списков администраторов чатов.
+
+    Списки из get_chat_administrators хранятся ttl секунд и сбрасываются раньше,
+    если из chat_member обновления видно, что у кого-то изменились права.
+    Обратный индекс user_id -> чаты позволяет проверять права без запросов к API.
+    """
+
+    def __init__(self, ttl: float = 900):
+        self.ttl = ttl
+        self._rosters: Dict[int, Tuple[float, Tuple[ChatMember, ...]]] = {}  # chat_id -> (время загрузки, админы)
+        self._admin_chats: Dict[int, Set[int]] = {}  # user_id -> чаты, где пользователь админ
+
+    def _is_fresh(self, chat_id: int) -> bool:
+        entry = self._rosters.get(chat_id)
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    async def get(self, bot, chat_id: int) -> Tuple[ChatMember, ...]:
+        """Возвращает администраторов чата, загружая их из API только при необходимости"""
+        if self._is_fresh(chat_id):
+            return self._rosters[chat_id][1]
+
+        admins = tuple(await bot.get_chat_administrators(chat_id))
+        self._store(chat_id, admins)
+        return admins
+
+    def _store(self, chat_id: int, admins: Tuple[ChatMember, ...]):
+        self._drop_from_index(chat_id)
+        self._rosters[chat_id] = (time.monotonic(), admins)
+        for admin in admins:
+            if not admin.user.is_bot:
+                self._admin_chats.setdefault(admin.user.id, set()).add(chat_id)
+
+    def _drop_from_index(self, chat_id: int):
+        entry = self._rosters.get(chat_id)
+        if entry is None:
+            return
+        for admin in entry[1]:
+            chats = self._admin_chats.get(admin.user.id)
+            if chats is not None:
+                chats.discard(chat_id)
+                if not chats:
+                    del self._admin_chats[admin.user.id]
+
+    def invalidate(self, chat_id: int):
+        """Сбрасывает кэш чата (например, после назначения или снятия админа)"""
+        self._drop_from_index(chat_id)
+        self._rosters.pop(chat_id, None)
+
+    async def is_admin_of_any(self, bot, user_id: int, chat_ids: Iterable[int]) -> bool:
+        """Проверяет, админ ли пользователь хотя бы одного из чатов.
+
+        Сначала смотрит в обратный индекс, и только для чатов без актуального кэша
+        обращается к API.
+        """
+        chat_ids = list(chat_ids)
+        wanted = set(chat_ids)
+        if any(chat_id in wanted and self._is_fresh(chat_id) for chat_id in self._admin_chats.get(user_id, ())):
+            return True
+
+        for chat_id in chat_ids:
+            if self._is_fresh(chat_id):
+                continue
+            try:
+                await self.get(bot, chat_id)
+            except Exception as e:
+                logger.debug(f"Не удалось получить админов чата {chat_id}: {e}")
+                continue
+            if chat_id in self._admin_chats.get(user_id, ()):
+                return True
+        return False
+
+
+def is_admin_change(old_status: str, new_status: str) -> bool:
+    """Меняет ли переход статусов состав администраторов чата"""
+    admin_statuses = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+    return (old_status in admin_statuses) or (new_status in admin_statuses)
+
+
+def bot_can_send(member: ChatMember, chat_type: str) -> bool:
+    """Может ли бот с таким статусом писать в чат"""
+    if member.status in (ChatMember.LEFT, ChatMember.BANNED):
+        return False
+    if member.status == ChatMember.RESTRICTED:
+        return bool(getattr(member, 'can_send_messages', False))
+    if chat_type == ChatType.CHANNEL:
+        # В канале пишут только владелец и админы с правом публикации
+        if member.status == ChatMember.OWNER:
+            return True
+        return member.status == ChatMember.ADMINISTRATOR and bool(getattr(member, 'can_post_messages', False))
+    return True
+
+
+class BotPermissionCache:
+    """Кэш прав бота в чатах.
+
+    Основной источник - обновления my_chat_member, которые Telegram присылает
+    при любом изменении статуса бота, поэтому отзыв прав виден сразу. Если
+    обновлений по чату давно не было, через ttl секунд права перепроверяются
+    запросом get_chat_member.
+    """
+
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self._entries: Dict[int, Tuple[float, bool, bool]] = {}  # chat_id -> (время, может писать, админ)
+
+    def update_from_member(self, chat_id: int, member: ChatMember, chat_type: str) -> bool:
+        """Запоминает права бота из обновления my_chat_member или ответа API"""
+        can_send = bot_can_send(member, chat_type)
+        is_admin = member.status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+        self._entries[chat_id] = (time.monotonic(), can_send, is_admin)
+        return can_send
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+
+    async def _entry(self, bot, chat_id: int, chat_type: str) -> Tuple[float, bool, bool]:
+        entry = self._entries.get(chat_id)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            member = await bot.get_chat_member(chat_id, bot.id)
+            self.update_from_member(chat_id, member, chat_type)
+            entry = self._entries[chat_id]
+        return entry
+
+    async def can_send(self, bot, chat_id: int, chat_type: str) -> bool:
+        """Может ли бот писать в чат (запрос к API только если кэш устарел)"""
+        return (await self._entry(bot, chat_id, chat_type))[1]
+
+    async def is_admin(self, bot, chat_id: int, chat_type: str) -> bool:
+        """Является ли бот администратором чата (запрос к API только если кэш устарел)"""
+        return (await self._entry(bot, chat_id, chat_type))[2]
+
+
+class ChatInfo(NamedTuple):
+    type: str
+    title: Optional[str]
+
+
+class ChatInfoCache:
+    """Кэш типа и названия чатов.
+
+    Заполняется из чатов во входящих обновлениях и из ответов get_chat, поэтому
+    запрос к API нужен только для чатов, о которых бот давно ничего не получал
+    (дольше ttl секунд). Одновременные get_chat одного чата объединяет ApiCallMonitor.
+    """
+
+    def __init__(self, ttl: float = 21600):
+        self.ttl = ttl
+        self._entries: Dict[int, Tuple[float, ChatInfo]] = {}  # chat_id -> (время, данные)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def remember(self, chat: Chat) -> ChatInfo:
+        """Запоминает чат из обновления или ответа API"""
+        info = ChatInfo(chat.type, chat.title)
+        self._entries[chat.id] = (time.monotonic(), info)
+        return info
+
+    async def get(self, bot, chat_id: int) -> ChatInfo:
+        """Тип и название чата, get_chat - только если кэш устарел"""
+        entry = self._entries.get(chat_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        return self.remember(await bot.get_chat(chat_id))
@@ -0,0 +1,91 @@
+import json
+import logging
+import random
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from telegram import Update
+
+logger = logging.getLogger('diagnostics')
+
+
+def update_type(update: object) -> str:
+    """Тип обновления Telegram (message, chat_join_request, ...)"""
+    if isinstance(update, Update):
+        for name in Update.ALL_TYPES:
+            if getattr(update, name, None) is not None:
+                return name
+    return type(update).__name__
+
+
+class _JsonRecord:
+    """Строка лога в JSON, собирается только если запись действительно пишется"""
+
+    __slots__ = ('fields',)
+
+    def __init__(self, fields: Dict):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return json.dumps(self.fields, ensure_ascii=False, default=str)
+
+
+class UpdateDiagnostics:
+    """Диагностика потока обновлений.
+
+    Каждое обновление только увеличивает счетчик своего типа. В лог попадает
+    случайная выборка обновлений (доля sample_rate) в виде JSON без персональных
+    данных и периодическая сводка по типам за прошедший интервал.
+    """
+
+    def __init__(self, sample_rate: float = 0.0):
+        self.sample_rate = sample_rate
+        self.counters: Counter = Counter()
+        self.sampled = 0
+        self._since = time.time()
+
+    async def record(self, update: object, context=None):
+        """Обработчик для TypeHandler: учитывает обновление"""
+        kind = update_type(update)
+        self.counters[kind] += 1
+        if self.sample_rate and random.random() < self.sample_rate and logger.isEnabledFor(logging.INFO):
+            self.sampled += 1
+            logger.info("%s", _JsonRecord(self.describe(update, kind)))
+
+    @staticmethod
+    def describe(update: object, kind: str) -> Dict:
+        fields = {'event': 'update', 'type': kind}
+        if isinstance(update, Update):
+            fields['update_id'] = update.update_id
+            if update.effective_chat is not None:
+                fields['chat_id'] = update.effective_chat.id
+                fields['chat_type'] = update.effective_chat.type
+            if update.effective_user is not None:
+                fields['user_id'] = update.effective_user.id
+            if update.message is not None and update.message.text and update.message.text.startswith('/'):
+                fields['command'] = update.message.text.split()[0]
+        return fields
+
+    def log_summary(self, **extra):
+        """Пишет сводку по типам обновлений за интервал и сбрасывает счетчики"""
+        now = time.time()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("%s", _JsonRecord({
+                'event': 'updates_summary',
+                'interval': round(now - self._since, 1),
+                'total': sum(self.counters.values()),
+                'by_type': dict(self.counters),
+                'sampled': self.sampled,
+                **extra,
+            }))
+        self.counters.clear()
+        self.sampled = 0
+        self._since = now
+
+
+def default_sample_rate(is_production: bool, configured: Optional[float] = None) -> float:
+    """Доля обновлений в логе: в production по умолчанию только сводки, при разработке - все"""
+    if configured is not None:
+        return float(configured)
+    return 0.0 if is_production else 1.0
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Типы событий
+EVENT_REQUEST = 0
+EVENT_APPROVED = 1
+EVENT_JOINED = 2
+EVENT_LEFT = 3
+NUM_EVENTS = 4
+
+# Запись журнала: время (unix, секунды), chat_id, тип события - 13 байт
+_RECORD = struct.Struct('<IqB')
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+
+# Сколько хранить минутные, часовые и дневные агрегаты
+MINUTE_RETENTION = 3 * HOUR
+HOUR_RETENTION = 30 * DAY
+DAY_RETENTION = 366 * DAY
+
+_ZERO_COUNTS = array('q', bytes(8 * NUM_EVENTS))
+
+# bucket_start -> chat_id -> счетчики по типам событий
+Rollup = Dict[int, Dict[int, array]]
+
+
+class EventLog:
+    """Журнал событий статистики с агрегатами по минутам, часам и дням.
+
+    Каждое событие (заявка, одобрение, вступление, выход) дописывается в бинарный
+    файл и сразу учитывается в агрегатах трех уровней. Запрос за произвольный
+    период складывается из самых крупных агрегатов, целиком попадающих в период,
+    без перечитывания событий.
+
+    Минутные агрегаты хранятся MINUTE_RETENTION секунд, часовые - HOUR_RETENTION,
+    дневные - DAY_RETENTION. Если для края периода минутных данных уже нет,
+    используется часовой агрегат целиком, и результат на этом краю приблизительный.
+
+    Файл периодически сжимается (compaction): старые события переносятся в снимок
+    часовых и дневных агрегатов, а в журнале остаются только недавние. Запись в
+    файл защищена блокировкой, поэтому сжатие можно выполнять в другом потоке.
+    """
+
+    def __init__(self, path: str = 'bot_events.log'):
+        self.path = path
+        self.snapshot_path = f"{path}.snapshot.json"
+        self.minutes: Rollup = {}
+        self.hours: Rollup = {}
+        self.days: Rollup = {}
+        self._cutoff = 0  # события раньше этого времени уже учтены в снимке
+        self._minute_floor = 0  # минутные агрегаты с этого времени полные (нет бакета - нет событий)
+        self._file = None
+        self._lock = threading.Lock()  # файл журнала (сжатие идет в потоке хранилища)
+
+    def load(self):
+        """Восстанавливает агрегаты из снимка и журнала"""
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            for level, rollup in (('hour', self.hours), ('day', self.days)):
+                for bucket, chats in snapshot.get(level, {}).items():
+                    rollup[int(bucket)] = {int(chat_id): array('q', counts) for chat_id, counts in chats.items()}
+            self._cutoff = int(snapshot.get('cutoff', 0))
+            self._minute_floor = self._cutoff
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as e:
+            logger.error(f"Не удалось загрузить снимок агрегатов событий: {e}")
+
+        records = 0
+        for ts, chat_id, event_type in self._read_records():
+            # Если сжатие прервалось после записи снимка, старые записи еще в журнале
+            if ts < self._cutoff or event_type >= NUM_EVENTS:
+                continue
+            self._account(ts, chat_id, event_type)
+            records += 1
+        self._prune(int(time.time()))
+
+        if records:
+            logger.info(f"Из журнала событий восстановлено {records} записей")
+
+    def _read_records(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # Оборванная последняя запись после аварийного завершения отбрасывается и
+        # обрезается в файле, иначе новые записи встанут за ней со сдвигом
+        usable = len(data) - len(data) % _RECORD.size
+        if usable < len(data):
+            logger.warning(f"В журнале событий оборванная запись ({len(data) - usable} байт), отбрасываем")
+            os.truncate(self.path, usable)
+        yield from _RECORD.iter_unpack(data[:usable])
+
+    def append(self, event_type: int, chat_id: int, ts: Optional[int] = None):
+        """Записывает событие в журнал и учитывает его в агрегатах"""
+        ts = int(time.time()) if ts is None else ts
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(_RECORD.pack(ts, chat_id, event_type))
+        self._account(ts, chat_id, event_type)
+
+    def _account(self, ts: int, chat_id: int, event_type: int):
+        for rollup, size in ((self.minutes, MINUTE), (self.hours, HOUR), (self.days, DAY)):
+            bucket = ts - ts % size
+            chats = rollup.get(bucket)
+            if chats is None:
+                chats = rollup[bucket] = {}
+                if rollup is self.minutes:
+                    self._prune(ts)
+            counts = chats.get(chat_id)
+            if counts is None:
+                counts = chats[chat_id] = array('q', _ZERO_COUNTS)
+            counts[event_type] += 1
+
+    def _prune(self, now: int):
+        """Удаляет агрегаты старше срока хранения"""
+        for rollup, retention in ((self.minutes, MINUTE_RETENTION), (self.hours, HOUR_RETENTION),
+                                  (self.days, DAY_RETENTION)):
+            cutoff = now - retention
+            for bucket in [bucket for bucket in rollup if bucket < cutoff]:
+                del rollup[bucket]
+        cutoff = now - MINUTE_RETENTION
+        self._minute_floor = max(self._minute_floor, cutoff + -cutoff % MINUTE)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def query(self, start: int, end: int) -> Dict[int, array]:
+        """Счетчики событий по чатам за период [start, end).
+
+        Границы выравниваются по минутам вниз.
+        """
+        start -= start % MINUTE
+        end -= end % MINUTE
+        result: Dict[int, array] = {}
+        t = start
+        while t < end:
+            if t % DAY == 0 and t + DAY <= end:
+                self._add_bucket(result, self.days, t)
+                t += DAY
+            elif t % HOUR == 0 and t + HOUR <= end:
+                self._add_bucket(result, self.hours, t)
+                t += HOUR
+            elif t >= self._minute_floor:
+                self._add_bucket(result, self.minutes, t)
+                t += MINUTE
+            else:
+                # Минутных данных уже нет - берем час целиком (его минуты еще не учитывались)
+                hour = t - t % HOUR
+                self._add_bucket(result, self.hours, hour)
+                t = hour + HOUR
+        return result
+
+    @staticmethod
+    def _add_bucket(result: Dict[int, array], rollup: Rollup, bucket: int):
+        for chat_id, counts in rollup.get(bucket, {}).items():
+            total = result.get(chat_id)
+            if total is None:
+                result[chat_id] = array('q', counts)
+            else:
+                for event_type in range(NUM_EVENTS):
+                    total[event_type] += counts[event_type]
+
+    @staticmethod
+    def totals(counts_by_chat: Dict[int, array]) -> List[int]:
+        """Сумма счетчиков по всем чатам результата query()"""
+        totals = [0] * NUM_EVENTS
+        for counts in counts_by_chat.values():
+            for event_type in range(NUM_EVENTS):
+                totals[event_type] += counts[event_type]
+        return totals
+
+    def compaction(self, now: Optional[int] = None) -> Optional[Callable[[], None]]:
+        """Готовит перенос событий старше срока хранения минутных агрегатов в снимок.
+
+        В потоке бота только копируются словари агрегатов до границы (сами
+        агрегаты прошлых часов и дней уже не меняются). Возвращает функцию,
+        которая записывает снимок и переписывает журнал - ее можно выполнить
+        в потоке хранилища. None - переносить нечего.
+        """
+        now = int(time.time()) if now is None else now
+        cutoff = now - MINUTE_RETENTION
+        cutoff -= cutoff % HOUR
+        if cutoff <= self._cutoff:
+            return None
+        self._prune(now)
+        hours = {bucket: chats for bucket, chats in self.hours.items() if bucket < cutoff}
+        days = {bucket: chats for bucket, chats in self.days.items() if bucket + DAY <= cutoff}
+        return partial(self._compact, cutoff, hours, days)
+
+    def _compact(self, cutoff: int, hours: Rollup, days: Rollup):
+        """Записывает снимок агрегатов до cutoff и оставляет в журнале только события после него"""
+        # День, в котором проходит граница, попадает в снимок частично - по его часам до границы
+        day_start = cutoff - cutoff % DAY
+        partial_day: Dict[int, array] = {}
+        for bucket in range(day_start, cutoff, HOUR):
+            self._add_bucket(partial_day, hours, bucket)
+        if partial_day:
+            days[day_start] = partial_day
+
+        snapshot = {
+            'cutoff': cutoff,
+            'hour': {str(bucket): {str(chat_id): list(counts) for chat_id, counts in chats.items()}
+                     for bucket, chats in hours.items()},
+            'day': {str(bucket): {str(chat_id): list(counts) for chat_id, counts in chats.items()}
+                    for bucket, chats in days.items()},
+        }
+        _atomic_write(self.snapshot_path, json.dumps(snapshot).encode('utf-8'))
+        self._cutoff = cutoff
+
+        # Снимок записан - теперь можно переписать журнал. События пишутся по
+        # возрастанию времени, поэтому граница в файле ищется двоичным поиском
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        usable = len(data) - len(data) % _RECORD.size
+        low, high = 0, usable // _RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            if _RECORD.unpack_from(data, middle * _RECORD.size)[0] < cutoff:
+                low = middle + 1
+            else:
+                high = middle
+        offset = low * _RECORD.size
+
+        with self._lock:
+            # События, дописанные во время сжатия, переносятся в новый файл
+            if self._file is not None:
+                self._file.flush()
+            with open(self.path, 'rb') as f:
+                f.seek(usable)
+                tail = f.read()
+            recent = data[offset:usable] + tail
+            recent = recent[:len(recent) - len(recent) % _RECORD.size]
+            _atomic_write(self.path, recent)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logger.info(f"Журнал событий сжат: {low} записей перенесено в снимок, осталось {len(recent) // _RECORD.size}")
+
+
+def _atomic_write(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
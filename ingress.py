@@ -0,0 +1,185 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Бот обрабатывает только эти типы обновлений (сообщения - ради команды /stats)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CHAT_JOIN_REQUEST, Update.CHAT_MEMBER, Update.MY_CHAT_MEMBER]
+
+# Приоритет обработки: заявки и изменения участников, затем команды, затем прочие сообщения
+PRIORITY_HIGH = 0
+PRIORITY_COMMAND = 1
+PRIORITY_LOW = 2
+
+
+def update_priority(update: object) -> int:
+    if not isinstance(update, Update) or update.message is None:
+        return PRIORITY_HIGH
+    text = update.message.text
+    if text and text.startswith('/'):
+        return PRIORITY_COMMAND
+    return PRIORITY_LOW
+
+
+def update_chat_id(update: object) -> Optional[int]:
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class UpdateIngress(BaseUpdateProcessor):
+    """Ограниченная очередь входящих обновлений с параллельной обработкой.
+
+    Одновременно обрабатывается не больше concurrency обновлений, в очереди
+    ждут не больше max_queue. Пока очередь полна, PTB не забирает новые обновления
+    из update_queue, а webhook не отвечает Telegram - так нагрузка передается
+    отправителю, а не копится в памяти.
+
+    Свободные места получают сначала заявки и изменения участников, затем команды.
+    Когда в очереди больше shed_threshold обновлений, прочие сообщения
+    отбрасываются (overloaded можно использовать, чтобы откладывать фоновую работу).
+
+    Обновления разных чатов обрабатываются параллельно, а одного чата - строго
+    по очереди в порядке поступления: каждое обновление ждет завершения
+    предыдущего обновления своего чата и только потом занимает место обработки.
+    Поэтому обработчики не ждут доставки исходящих сообщений, а только ставят
+    их в очередь отправки - иначе очередь чата стояла бы на лимитах Telegram.
+
+    При остановке принятые обновления дорабатываются не дольше shutdown_timeout
+    секунд, оставшиеся отменяются.
+    """
+
+    def __init__(self, concurrency: int = 16, max_queue: int = 1000, shed_threshold: Optional[int] = None,
+                 shutdown_timeout: float = 30):
+        # Для PTB процессор последовательный: do_process_update только ставит
+        # обновление в очередь, поэтому PTB ждет, пока в ней освободится место
+        super().__init__(1)
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.shed_threshold = shed_threshold if shed_threshold is not None else max_queue * 3 // 4
+        self.shutdown_timeout = shutdown_timeout
+        self.running = 0
+        self.processed = 0
+        self.shed = 0
+        self._seq = itertools.count()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []  # (приоритет, порядок, future)
+        self._lanes: Dict[int, asyncio.Future] = {}  # chat_id -> завершение последнего обновления чата
+        self._space: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+        self._was_overloaded = False
+
+    @property
+    def queued(self) -> int:
+        return len(self._tasks) - self.running
+
+    @property
+    def depth(self) -> int:
+        """Обновления в очереди и в обработке"""
+        return len(self._tasks)
+
+    @property
+    def overloaded(self) -> bool:
+        return self.queued >= self.shed_threshold
+
+    async def initialize(self):
+        self._space = asyncio.Semaphore(self.max_queue + self.concurrency)
+
+    async def drain(self):
+        """Дожидается обработки уже принятых обновлений (не дольше shutdown_timeout секунд).
+
+        Бот вызывает drain() в post_stop до остановки очереди отправки, чтобы
+        обработчики успели поставить в нее свои сообщения.
+        """
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=self.shutdown_timeout)
+        if pending:
+            logger.warning(f"⚠️ При остановке прервана обработка {len(pending)} обновлений")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def shutdown(self):
+        """Вызывается PTB при завершении; обычно обновления уже обработаны в drain()"""
+        await self.drain()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        priority = update_priority(update)
+        self._check_load()
+        if priority == PRIORITY_LOW and self.overloaded:
+            coroutine.close()
+            self.shed += 1
+            return
+
+        await self._space.acquire()
+
+        # Очередь чата продлевается сразу, до создания задачи, чтобы сохранить порядок
+        chat_id = update_chat_id(update)
+        previous = done = None
+        if chat_id is not None:
+            previous = self._lanes.get(chat_id)
+            done = self._lanes[chat_id] = asyncio.get_running_loop().create_future()
+
+        task = asyncio.create_task(self._process(priority, coroutine, chat_id, previous, done))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, priority: int, coroutine: Awaitable[Any], chat_id: Optional[int],
+                       previous: Optional[asyncio.Future], done: Optional[asyncio.Future]):
+        try:
+            try:
+                if previous is not None:
+                    await asyncio.shield(previous)
+                await self._acquire_slot(priority)
+            except BaseException:
+                coroutine.close()
+                raise
+            try:
+                await coroutine
+                self.processed += 1
+            finally:
+                self._release_slot()
+        finally:
+            self._space.release()
+            if done is not None:
+                done.set_result(None)
+                if self._lanes.get(chat_id) is done:
+                    del self._lanes[chat_id]
+
+    async def _acquire_slot(self, priority: int):
+        if self.running < self.concurrency and not self._waiters:
+            self.running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Место уже передано этой задаче - возвращаем его
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+
+    def _release_slot(self):
+        # Место сразу передается самому приоритетному ожидающему
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def _check_load(self):
+        overloaded = self.overloaded
+        if overloaded != self._was_overloaded:
+            self._was_overloaded = overloaded
+            if overloaded:
+                logger.warning(f"⚠️ Очередь обновлений перегружена: {self.queued} в очереди, {self.running} в обработке")
+            else:
+                logger.info(f"✅ Очередь обновлений разгружена (отброшено сообщений: {self.shed})")
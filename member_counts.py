@@ -0,0 +1,116 @@
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Чем дольше в чате не было событий, тем реже он сверяется по сроку: (простой до, во сколько раз реже)
+ACTIVITY_TIERS = ((3600, 1), (86400, 4))
+DORMANT_FACTOR = 16
+
+
+class MemberCountTracker:
+    """Учет точности локальных счетчиков участников.
+
+    Счетчик чата ведется по обновлениям chat_member (+1 за вступление, -1 за
+    выход) без запросов к API. get_chat_member_count нужен только для сверки
+    чатов, оценке которых уже нельзя доверять:
+    - счетчик чата еще ни разу не получали из API;
+    - с прошлой сверки накопилось не меньше max(drift_min, drift_ratio * счетчик)
+      изменений или одобренных заявок, о вступлении по которым Telegram не сообщил;
+    - счетчик не сверялся дольше max_age секунд (для чатов без событий дольше
+      часа - в 4 раза дольше, без событий дольше суток - в 16 раз).
+
+    Чтобы сверка не шла одной пачкой, интервал interval делится на слоты по
+    tick секунд, и каждый чат по хэшу своего id навсегда закреплен за одним
+    слотом. За тик проверяются только чаты наступивших слотов, поэтому запросы
+    к API равномерно распределены по интервалу, а каждый чат рассматривается
+    раз в interval секунд.
+    """
+
+    def __init__(self, max_age: float = 21600, drift_min: int = 20, drift_ratio: float = 0.02,
+                 interval: float = 1800, tick: float = 60):
+        self.max_age = max_age
+        self.drift_min = drift_min
+        self.drift_ratio = drift_ratio
+        self.tick = tick
+        self.slots = max(1, int(interval // tick))
+        self._last_tick: Optional[int] = None
+        self._checked: Dict[str, float] = {}  # chat_id -> время последней сверки с API
+        self._changes: Dict[str, int] = {}  # chat_id -> изменений счетчика после сверки
+        self._expected: Dict[str, int] = {}  # chat_id -> одобрено, но вступление еще не пришло
+        # Сохраненные счетчики считаются сверенными при запуске, иначе после рестарта все чаты сверялись бы разом
+        self._started = time.time()
+
+    def record_change(self, chat_id: str, delta: int):
+        """Счетчик чата изменен локально по обновлению chat_member"""
+        self._changes[chat_id] = self._changes.get(chat_id, 0) + abs(delta)
+        if delta > 0 and chat_id in self._expected:
+            left = self._expected[chat_id] - delta
+            if left > 0:
+                self._expected[chat_id] = left
+            else:
+                del self._expected[chat_id]
+
+    def expect_joins(self, chat_id: str, count: int):
+        """Одобрено count заявок - Telegram должен прислать столько же вступлений"""
+        self._expected[chat_id] = self._expected.get(chat_id, 0) + count
+
+    def reconciled(self, chat_id: str, now: Optional[float] = None):
+        """Счетчик чата только что получен из API"""
+        self._checked[chat_id] = time.time() if now is None else now
+        self._changes.pop(chat_id, None)
+        self._expected.pop(chat_id, None)
+
+    def forget(self, chat_id: str):
+        self._checked.pop(chat_id, None)
+        self._changes.pop(chat_id, None)
+        self._expected.pop(chat_id, None)
+
+    def drift(self, chat_id: str) -> int:
+        """Сколько изменений могло разойтись с реальным счетчиком после сверки"""
+        return self._changes.get(chat_id, 0) + self._expected.get(chat_id, 0)
+
+    def age(self, chat_id: str, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        return now - self._checked.get(chat_id, self._started)
+
+    @staticmethod
+    def activity_factor(idle: float) -> int:
+        """Во сколько раз реже сверять по сроку чат, где idle секунд не было событий"""
+        for threshold, factor in ACTIVITY_TIERS:
+            if idle < threshold:
+                return factor
+        return DORMANT_FACTOR
+
+    def needs_check(self, chat_id: str, count: int, now: Optional[float] = None, idle: float = 0) -> bool:
+        if count <= 0:
+            return True
+        if self.age(chat_id, now) >= self.max_age * self.activity_factor(idle):
+            return True
+        return self.drift(chat_id) >= max(self.drift_min, count * self.drift_ratio)
+
+    def slot(self, chat_id: str) -> int:
+        """Слот чата в интервале сверки (не зависит от перезапусков и состава чатов)"""
+        return zlib.crc32(chat_id.encode()) % self.slots
+
+    def take_slots(self, now: Optional[float] = None) -> Set[int]:
+        """Слоты, наступившие с прошлого вызова (пропущенные тики догоняются)"""
+        now = time.time() if now is None else now
+        current = int(now // self.tick)
+        first = current if self._last_tick is None else max(self._last_tick + 1, current - self.slots + 1)
+        self._last_tick = current
+        return {index % self.slots for index in range(first, current + 1)}
+
+    def due(self, chats: Iterable[Tuple[str, int, float]], limit: Optional[int] = None,
+            now: Optional[float] = None) -> List[str]:
+        """Чаты наступивших слотов из (chat_id, счетчик, время последней активности),
+        которые пора сверить: сначала неизвестные, затем с наибольшим расхождением,
+        затем самые давно сверенные"""
+        now = time.time() if now is None else now
+        slots = self.take_slots(now)
+        due = [
+            (count > 0, -self.drift(chat_id) / max(count, 1), -self.age(chat_id, now), chat_id)
+            for chat_id, count, last_activity in chats
+            if self.slot(chat_id) in slots and self.needs_check(chat_id, count, now, now - last_activity)
+        ]
+        due.sort()
+        return [chat_id for *_, chat_id in due[:limit]]
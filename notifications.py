@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (admin_id, chat_id)
+DigestKey = Tuple[int, int]
+SendCallback = Callable[[int, str], Awaitable[None]]
+
+
+class _PendingDigest:
+    __slots__ = ('chat_title', 'count', 'users', 'timer')
+
+    def __init__(self, chat_title: str):
+        self.chat_title = chat_title
+        self.count = 0
+        self.users: List[str] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class NotificationDigest:
+    """Объединяет уведомления о заявках для админа в дайджесты.
+
+    Первая заявка в чат после паузы отправляется админу сразу. Следующие заявки
+    в течение window секунд копятся по ключу (админ, чат) и уходят одним сообщением
+    с количеством и первыми max_users пользователями. Таким образом ни одно
+    уведомление не задерживается дольше window секунд.
+
+    add() вызывается из обработчика заявки, поэтому send должен только ставить
+    сообщение в очередь отправки, не дожидаясь доставки.
+    """
+
+    def __init__(self, send: SendCallback, window: float = 60, max_users: int = 10):
+        self.send = send
+        self.window = window
+        self.max_users = max_users
+        self._pending: Dict[DigestKey, _PendingDigest] = {}
+        self._last_sent: Dict[DigestKey, float] = {}
+        self._tasks = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def add(self, admin_id: int, chat_id: int, chat_title: str, user_line: str, single_message: str):
+        """Добавляет заявку в дайджест админа (или отправляет сразу, если чат был тихим)"""
+        key = (admin_id, chat_id)
+        now = time.monotonic()
+        last_sent = self._last_sent.get(key)
+
+        if key not in self._pending and (last_sent is None or now - last_sent >= self.window):
+            self._last_sent[key] = now
+            await self.send(admin_id, single_message)
+            return
+
+        digest = self._pending.get(key)
+        if digest is None:
+            digest = self._pending[key] = _PendingDigest(chat_title)
+            delay = self.window - (now - last_sent) if last_sent is not None else self.window
+            loop = asyncio.get_running_loop()
+            digest.timer = loop.call_later(max(0.0, delay), self._schedule_flush, key)
+
+        digest.count += 1
+        if len(digest.users) < self.max_users:
+            digest.users.append(user_line)
+
+    def _schedule_flush(self, key: DigestKey):
+        task = asyncio.ensure_future(self.flush(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, key: DigestKey):
+        """Отправляет накопленный дайджест для (админ, чат)"""
+        digest = self._pending.pop(key, None)
+        if digest is None:
+            return
+        if digest.timer is not None:
+            digest.timer.cancel()
+
+        admin_id, _ = key
+        now = time.monotonic()
+        self._last_sent[key] = now
+        if len(self._last_sent) > 10000:
+            # Забываем давно затихшие пары, для них следующая заявка уйдет сразу
+            self._last_sent = {k: t for k, t in self._last_sent.items() if now - t < self.window}
+        await self.send(admin_id, self.format_digest(digest))
+
+    async def flush_all(self):
+        """Отправляет все накопленные дайджесты (при остановке бота)"""
+        for key in list(self._pending):
+            try:
+                await self.flush(key)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось отправить дайджест админу {key[0]}: {e}")
+
+    def format_digest(self, digest: _PendingDigest) -> str:
+        lines = [f"📝 Новых заявок в '{digest.chat_title}': {digest.count}"]
+        lines.extend(f"👤 {user}" for user in digest.users)
+        if digest.count > len(digest.users):
+            lines.append(f"… и еще {digest.count - len(digest.users)}")
+        return "\n".join(lines)
@@ -0,0 +1,249 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+from rate_limit import TokenBucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: чем меньше число, тем раньше отправляется сообщение
+PRIORITY_WELCOME = 0
+PRIORITY_ADMIN_NOTICE = 1
+PRIORITY_STATS = 2
+
+
+class OutboxFull(Exception):
+    """Очередь исходящих сообщений переполнена, сообщение не принято"""
+
+
+class OutboxClosed(Exception):
+    """Очередь исходящих сообщений остановлена, сообщение не отправлено"""
+
+
+class _OutgoingMessage:
+    __slots__ = ('priority', 'seq', 'chat_id', 'kwargs', 'future', 'attempts', 'context')
+
+    def __init__(self, priority: int, seq: int, chat_id: int, kwargs: Dict[str, Any], future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+        # Отправка выполняется в контексте отправителя (например, для учета запросов по функциям бота)
+        self.context = contextvars.copy_context()
+
+    def __lt__(self, other: '_OutgoingMessage') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Outbox:
+    """Общая очередь исходящих сообщений бота.
+
+    Сообщения отправляются в порядке приоритета (приветствия, затем уведомления
+    админам, затем отчеты) с соблюдением общего лимита Telegram (global_rate в секунду)
+    и лимита на один чат: per_chat_rate в секунду для личных чатов и group_rate
+    для групп и каналов (chat_id < 0). При RetryAfter отправка
+    приостанавливается и сообщение возвращается в очередь. Размер очереди ограничен
+    max_size сообщениями. После stop() неотправленные сообщения завершаются
+    ошибкой OutboxClosed, а новые не принимаются.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, global_rate: float = 30, per_chat_rate: float = 1, group_rate: float = 20 / 60,
+                 max_size: int = 10000, max_in_flight: int = 32):
+        self.bucket = TokenBucket(global_rate)
+        self.chat_interval = 1.0 / per_chat_rate
+        self.group_interval = 1.0 / group_rate
+        self.max_size = max_size
+        self.bot = None
+        self._seq = itertools.count()
+        self._size = 0
+        self._chats: Dict[int, List[_OutgoingMessage]] = {}  # chat_id -> куча сообщений чата
+        self._chat_next: Dict[int, float] = {}  # chat_id -> когда можно писать в чат снова
+        self._generation: Dict[int, int] = {}  # chat_id -> поколение актуальной записи чата
+        self._ready: List[Tuple[int, int, int, int]] = []  # (priority, seq, поколение, chat_id) готовых чатов
+        self._waiting: List[Tuple[float, int, int]] = []  # (время, поколение, chat_id) чатов, ждущих лимита
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending = set()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def start(self, bot):
+        """Запускает фоновую отправку через указанного бота"""
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Дожидается отправки очереди (не дольше timeout секунд) и останавливает отправку.
+
+        Сообщения, которые не успели уйти, завершаются ошибкой OutboxClosed,
+        чтобы ожидающие их отправители не зависли.
+        """
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        while (self._size or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._sending):
+            task.cancel()
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+        dropped = 0
+        for chat_queue in self._chats.values():
+            for message in chat_queue:
+                if not message.future.done():
+                    message.future.set_exception(OutboxClosed("Очередь исходящих сообщений остановлена"))
+                dropped += 1
+        self._chats.clear()
+        self._generation.clear()
+        self._ready.clear()
+        self._waiting.clear()
+        self._size = 0
+        if dropped:
+            logger.warning(f"⚠️ При остановке не отправлено {dropped} сообщений из очереди")
+
+    def submit(self, chat_id: int, priority: int = PRIORITY_STATS, **kwargs) -> asyncio.Future:
+        """Ставит сообщение в очередь и возвращает future с результатом send_message"""
+        future = asyncio.get_running_loop().create_future()
+        if self._closed:
+            future.set_exception(OutboxClosed("Очередь исходящих сообщений остановлена"))
+            return future
+        if self._size >= self.max_size:
+            future.set_exception(OutboxFull(f"Очередь исходящих сообщений переполнена ({self.max_size})"))
+            return future
+
+        message = _OutgoingMessage(priority, next(self._seq), chat_id, kwargs, future)
+        self._push(message)
+        return future
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_STATS, **kwargs):
+        """Отправляет сообщение через очередь и ждет результата (ошибки API пробрасываются)"""
+        return await self.submit(chat_id, priority, text=text, **kwargs)
+
+    def _push(self, message: _OutgoingMessage):
+        chat_queue = self._chats.get(message.chat_id)
+        if chat_queue is None:
+            chat_queue = self._chats[message.chat_id] = []
+        heapq.heappush(chat_queue, message)
+        self._size += 1
+        # Перепланируем чат, если он еще не в очереди или новое сообщение стало первым
+        if message.chat_id not in self._generation or chat_queue[0] is message:
+            self._schedule_chat(message.chat_id)
+
+    def _schedule_chat(self, chat_id: int):
+        """Ставит чат в очередь готовых или ожидающих по его первому сообщению.
+
+        У каждого чата ровно одна актуальная запись: новая запись получает новое
+        поколение, а старые записи с другим поколением пропускаются при извлечении.
+        """
+        chat_queue = self._chats.get(chat_id)
+        if not chat_queue:
+            self._generation.pop(chat_id, None)
+            return
+        generation = next(self._seq)
+        self._generation[chat_id] = generation
+        head = chat_queue[0]
+        ready_at = self._chat_next.get(chat_id, 0.0)
+        if ready_at <= time.monotonic():
+            heapq.heappush(self._ready, (head.priority, head.seq, generation, chat_id))
+        else:
+            heapq.heappush(self._waiting, (ready_at, generation, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _pop_ready(self) -> Optional[_OutgoingMessage]:
+        """Извлекает самое приоритетное сообщение среди чатов, в которые уже можно писать"""
+        now = time.monotonic()
+        while self._waiting and self._waiting[0][0] <= now:
+            _, generation, chat_id = heapq.heappop(self._waiting)
+            if self._generation.get(chat_id) == generation:
+                self._schedule_chat(chat_id)
+
+        while self._ready:
+            _, _, generation, chat_id = heapq.heappop(self._ready)
+            if self._generation.get(chat_id) != generation:
+                continue
+            if self._chat_next.get(chat_id, 0.0) > now:
+                self._schedule_chat(chat_id)
+                continue
+            chat_queue = self._chats[chat_id]
+            message = heapq.heappop(chat_queue)
+            if not chat_queue:
+                del self._chats[chat_id]
+            self._size -= 1
+            self._chat_next[chat_id] = now + (self.group_interval if chat_id < 0 else self.chat_interval)
+            self._schedule_chat(chat_id)
+            return message
+        return None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            await self.bucket.acquire()
+            message = self._pop_ready()
+            if message is None:
+                # Токен не израсходован - возвращаем его
+                self.bucket.refund()
+                timeout = None
+                if self._waiting:
+                    timeout = max(0.0, self._waiting[0][0] - time.monotonic())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._in_flight.acquire()
+            task = asyncio.create_task(self._deliver(message), context=message.context)
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+            if len(self._chat_next) > 10 * self.max_size:
+                now = time.monotonic()
+                self._chat_next = {chat_id: t for chat_id, t in self._chat_next.items() if t > now}
+
+    async def _deliver(self, message: _OutgoingMessage):
+        try:
+            message.attempts += 1
+            result = await self.bot.send_message(chat_id=message.chat_id, **message.kwargs)
+            if not message.future.done():
+                message.future.set_result(result)
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            self.bucket.pause(delay)
+            self._chat_next[message.chat_id] = time.monotonic() + delay
+            if message.attempts < self.MAX_ATTEMPTS:
+                logger.warning(f"⏳ RetryAfter при отправке в чат {message.chat_id}: пауза {delay} с")
+                self._push(message)
+            elif not message.future.done():
+                message.future.set_exception(e)
+        except asyncio.CancelledError:
+            # Отправку прервала остановка очереди
+            if not message.future.done():
+                message.future.set_exception(OutboxClosed("Очередь исходящих сообщений остановлена"))
+            raise
+        except Exception as e:
+            if not message.future.done():
+                message.future.set_exception(e)
+        finally:
+            self._in_flight.release()
@@ -0,0 +1,72 @@
+import asyncio
+import time
+from datetime import timedelta
+from typing import Optional
+
+from telegram.error import RetryAfter
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Возвращает паузу из RetryAfter в секундах (int или timedelta в зависимости от версии PTB)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """Асинхронное ведро токенов для ограничения частоты запросов к Bot API.
+
+    Токены пополняются со скоростью rate в секунду до capacity. Ожидающие вызовы
+    acquire() обслуживаются по очереди. pause() блокирует ведро на время из RetryAfter.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Забирает токены без ожидания, если они есть"""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Сколько секунд осталось до появления нужного количества токенов"""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        """Ожидает, пока в ведре появятся токены, и забирает их"""
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep(self.wait_time(tokens))
+
+    def refund(self, tokens: float = 1):
+        """Возвращает неиспользованные токены"""
+        self._tokens = min(self.capacity, self._tokens + tokens)
+
+    def pause(self, seconds: float):
+        """Блокирует ведро на seconds секунд (ответ Telegram RetryAfter)"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        # Токены начинают копиться только после паузы, иначе по ее окончании уйдет целый залп
+        self._tokens = 0.0
+        self._updated = self._blocked_until
@@ -0,0 +1,230 @@
+import html
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from event_log import EVENT_APPROVED, EVENT_LEFT, EVENT_REQUEST
+from stats import ChannelStats, CURRENT_MEMBERS, TOTAL_APPROVED, TOTAL_LEFT, TOTAL_REQUESTS
+
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+# Место под номер страницы в конце сообщения
+_PAGE_RESERVE = 16
+
+# Строка канала в отчете за период: (ChannelStats или None, chat_id, счетчики событий)
+WindowChannel = Tuple[Optional[ChannelStats], int, Sequence[int]]
+
+
+def trend(value: int) -> str:
+    return "📈" if value > 0 else "📉" if value < 0 else "➖"
+
+
+def paginate(header: str, blocks: Sequence[str], separator: str = "\n\n",
+             limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Раскладывает заголовок и блоки по сообщениям не длиннее limit.
+
+    Блок не разрывается между сообщениями (кроме блока длиннее сообщения).
+    Если сообщений несколько, в конце каждого ставится номер страницы.
+    """
+    limit -= _PAGE_RESERVE
+    pages: List[str] = []
+    current: List[str] = [header] if header else []
+    size = len(header)
+    for block in blocks:
+        if len(block) > limit:
+            if current:
+                pages.append(separator.join(current))
+                current, size = [], 0
+            while len(block) > limit:
+                pages.append(block[:limit])
+                block = block[limit:]
+        extra = len(block) + (len(separator) if current else 0)
+        if current and size + extra > limit:
+            pages.append(separator.join(current))
+            current, size, extra = [], 0, len(block)
+        current.append(block)
+        size += extra
+    if current:
+        pages.append(separator.join(current))
+    if len(pages) > 1:
+        pages = [f"{page}\n\n📄 {number}/{len(pages)}" for number, page in enumerate(pages, 1)]
+    return pages
+
+
+class ReportRenderer:
+    """Отчеты о статистике в виде готовых к отправке сообщений.
+
+    Фрагмент каждого канала запоминается вместе с версией его строки в StatsTable
+    и прочими входными данными (счетчиками за период, ожидающими заявками) и
+    собирается заново только когда они изменились. Отчет раскладывается по
+    сообщениям не длиннее лимита Telegram. Формат - обычный текст или HTML
+    (жирные заголовки, экранированные названия каналов); parse_mode подходит
+    для передачи в send_message.
+    """
+
+    def __init__(self, html_format: bool = False, limit: int = MESSAGE_LIMIT):
+        self.html = html_format
+        self.limit = limit
+        self.parse_mode = 'HTML' if html_format else None
+        self._fragments: Dict[Tuple[str, Hashable], Tuple[Hashable, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bold(self, text: str) -> str:
+        return f"<b>{text}</b>" if self.html else text
+
+    def title(self, title: str, width: int) -> str:
+        return html.escape(title[:width]) if self.html else title[:width]
+
+    def fragment(self, kind: str, key: Hashable, signature: Hashable, build: Callable[[], str]) -> str:
+        """Фрагмент отчета из кэша, если его входные данные (signature) не изменились"""
+        cached = self._fragments.get((kind, key))
+        if cached is not None and cached[0] == signature:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        text = build()
+        self._fragments[(kind, key)] = (signature, text)
+        return text
+
+    def forget(self, key: Hashable):
+        for kind in ('hourly', 'daily', 'current'):
+            self._fragments.pop((kind, key), None)
+
+    def hourly(self, period: str, totals: Sequence[int], channels: Sequence[WindowChannel]) -> List[str]:
+        """Почасовой отчет по счетчикам событий за период"""
+        total_requests, total_left = totals[EVENT_REQUEST], totals[EVENT_LEFT]
+        header = (
+            f"{self.bold(f'📊 Общая статистика {period}:')}\n"
+            f"📈 Новых заявок: {total_requests}\n"
+            f"📉 Покинули: {total_left}\n"
+            f"🔄 Чистый прирост: {total_requests - total_left}"
+        )
+
+        blocks = []
+        for stats, chat_id, counts in channels:
+            requests, left = counts[EVENT_REQUEST], counts[EVENT_LEFT]
+            if requests == 0 and left == 0:
+                continue
+            signature = (stats.version if stats is not None else None, requests, left)
+            blocks.append(self.fragment('hourly', str(chat_id), signature,
+                                        lambda: self._hourly_channel(stats, chat_id, requests, left)))
+
+        if blocks:
+            blocks[0] = f"{self.bold('📋 По каналам:')}\n{blocks[0]}"
+        return paginate(header, blocks, limit=self.limit)
+
+    def _hourly_channel(self, stats: Optional[ChannelStats], chat_id: int, requests: int, left: int) -> str:
+        growth = requests - left
+        members_info = ""
+        if stats is not None and stats.current_members > 0:
+            members_info = f"\n  👥 Участников: {stats.current_members}"
+        title = stats.title if stats is not None else f"Чат {chat_id}"
+        return (
+            f"🏷️ {self.title(title, 30)}:\n"
+            f"  📝 Заявок: {requests}\n"
+            f"  👋 Покинули: {left}\n"
+            f"  {trend(growth)} Прирост: {growth}{members_info}"
+        )
+
+    def daily(self, current_time: str, window_totals: Sequence[int], totals: Sequence[int],
+              channels: Sequence[ChannelStats], window_counts: Dict[int, Sequence[int]]) -> List[str]:
+        """Отчет за 8 часов: счетчики за период и с запуска по каждому активному каналу"""
+        daily_requests = window_totals[EVENT_REQUEST]
+        daily_left = window_totals[EVENT_LEFT]
+        header = (
+            f"{self.bold(f'📈 Общий отчет за 8 часов ({current_time}):')}\n\n"
+            f"📝 Новых заявок: {daily_requests}\n"
+            f"✅ Одобрено: {window_totals[EVENT_APPROVED]}\n"
+            f"👋 Покинули: {daily_left}\n"
+            f"🔄 Чистый прирост: {daily_requests - daily_left}\n\n"
+            f"{self.bold('📊 Общая статистика с запуска:')}\n"
+            f"📋 Всего заявок: {totals[TOTAL_REQUESTS]}\n"
+            f"✅ Всего одобрено: {totals[TOTAL_APPROVED]}\n"
+            f"👋 Всего покинуло: {totals[TOTAL_LEFT]}"
+        )
+
+        blocks = []
+        for stats in channels:
+            counts = window_counts.get(int(stats.chat_id))
+            requests = counts[EVENT_REQUEST] if counts else 0
+            left = counts[EVENT_LEFT] if counts else 0
+            blocks.append(self.fragment('daily', stats.chat_id, (stats.version, requests, left),
+                                        lambda: self._daily_channel(stats, requests, left)))
+
+        if blocks:
+            blocks[0] = f"{self.bold('📋 Детализация по каналам:')}\n\n{blocks[0]}"
+        return paginate(header, blocks, limit=self.limit)
+
+    def _daily_channel(self, stats: ChannelStats, requests: int, left: int) -> str:
+        daily_growth = requests - left
+        total_growth = stats.total_requests - stats.total_left
+
+        # Информация о подписчиках
+        members_info = ""
+        if stats.current_members > 0:
+            initial = stats.initial_members
+            current = stats.current_members
+            if initial > 0:
+                growth_from_start = current - initial
+                members_info = f"\n  👥 Участников: {current} (старт: {initial}, {trend(growth_from_start)}{growth_from_start:+d})"
+            else:
+                members_info = f"\n  👥 Участников: {current}"
+
+        return (
+            f"🏷️ {self.title(stats.title, 35)}:\n"
+            f"  📝 За 8 часов: {requests} заявок, {left} покинули\n"
+            f"  {trend(daily_growth)} Прирост за 8ч: {daily_growth}\n"
+            f"  📊 Всего: {stats.total_requests} заявок, {stats.total_approved} одобрено\n"
+            f"  {trend(total_growth)} Общий прирост: {total_growth}{members_info}"
+        )
+
+    def current(self, current_time: str, totals: Sequence[int], pending_total: int,
+                channels: Sequence[ChannelStats], pending_for_chat: Callable[[int], int]) -> List[str]:
+        """Текущая статистика для команды /stats"""
+        total_requests, total_left = totals[TOTAL_REQUESTS], totals[TOTAL_LEFT]
+        lines = [
+            f"📊 Текущая статистика ({current_time}):\n",
+            self.bold("🌐 ОБЩАЯ СТАТИСТИКА:"),
+            f"📋 Всего заявок: {total_requests}",
+            f"✅ Одобрено: {totals[TOTAL_APPROVED]}",
+            f"👋 Покинули: {total_left}",
+            f"🔄 Общий прирост: {total_requests - total_left}",
+        ]
+        if totals[CURRENT_MEMBERS] > 0:
+            lines.append(f"👥 Всего участников: {totals[CURRENT_MEMBERS]}")
+        if pending_total > 0:
+            lines.append(f"⏳ Ожидают одобрения: {pending_total}")
+        header = "\n".join(lines)
+
+        blocks = []
+        for number, stats in enumerate(channels, 1):
+            pending = pending_for_chat(int(stats.chat_id))
+            fragment = self.fragment('current', stats.chat_id, (stats.version, pending),
+                                     lambda: self._current_channel(stats, pending))
+            blocks.append(f"{number}. {fragment}")
+
+        if blocks:
+            blocks[0] = f"{self.bold('📋 ПО КАНАЛАМ:')}\n\n{blocks[0]}"
+        return paginate(header, blocks, limit=self.limit)
+
+    def _current_channel(self, stats: ChannelStats, pending: int) -> str:
+        growth = stats.total_requests - stats.total_left
+        lines = [
+            f"🏷️ {self.title(stats.title, 30)}:",
+            f"   📥 Заявок: {stats.total_requests}",
+            f"   ✅ Одобрено: {stats.total_approved}",
+            f"   👋 Покинули: {stats.total_left}",
+            f"   {trend(growth)} Прирост: {growth}",
+        ]
+
+        # Информация о участниках
+        if stats.current_members > 0:
+            current = stats.current_members
+            initial = stats.initial_members
+            if initial > 0 and initial != current:
+                change = current - initial
+                lines.append(f"   👥 Участников: {current} ({trend(change)}{change:+d} от старта)")
+            else:
+                lines.append(f"   👥 Участников: {current}")
+        if pending > 0:
+            lines.append(f"   ⏳ Ожидают одобрения: {pending}")
+        return "\n".join(lines)
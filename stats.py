@@ -0,0 +1,227 @@
+import time
+from array import array
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Идентификаторы счетчиков (столбцы общей таблицы)
+# Счетчики за час/8 часов считаются по журналу событий (event_log.py)
+METRIC_NAMES = (
+    'total_requests',
+    'total_approved',
+    'total_left',
+    'current_members',  # Текущее количество участников
+    'initial_members',  # Количество участников при первом запуске
+)
+(
+    TOTAL_REQUESTS,
+    TOTAL_APPROVED,
+    TOTAL_LEFT,
+    CURRENT_MEMBERS,
+    INITIAL_MEMBERS,
+) = range(len(METRIC_NAMES))
+METRIC_IDS = {name: metric for metric, name in enumerate(METRIC_NAMES)}
+NUM_METRICS = len(METRIC_NAMES)
+
+_ZERO_ROW = array('q', bytes(8 * NUM_METRICS))
+
+
+class ChannelStats:
+    """Статистика одного канала/группы - строка в общем массиве StatsTable.
+
+    Сам объект хранит только заголовок и номер строки, счетчики лежат в StatsTable.
+    Счетчики доступны как атрибуты (stats.total_requests) и по id метрики (stats[TOTAL_REQUESTS]).
+    """
+
+    __slots__ = ('chat_id', 'title', 'slot', '_table')
+
+    def __init__(self, table: 'StatsTable', chat_id: str, title: str, slot: int):
+        self._table = table
+        self.chat_id = chat_id
+        self.title = title
+        self.slot = slot
+
+    def __getitem__(self, metric: int) -> int:
+        return self._table.counters[self.slot * NUM_METRICS + metric]
+
+    def __setitem__(self, metric: int, value: int):
+        self._table.set(self, metric, value)
+
+    @property
+    def version(self) -> int:
+        """Растет при каждом изменении строки (для кэширования фрагментов отчетов)"""
+        return self._table.versions[self.slot]
+
+    @property
+    def last_activity(self) -> datetime:
+        return datetime.fromtimestamp(self._table.activity[self.slot])
+
+    @last_activity.setter
+    def last_activity(self, value: datetime):
+        self._table.activity[self.slot] = value.timestamp()
+        self._table.mark_dirty(self)
+
+    def to_dict(self) -> Dict:
+        """Представление для сохранения в JSON"""
+        data = {'title': self.title}
+        for metric, name in enumerate(METRIC_NAMES):
+            data[name] = self[metric]
+        data['last_activity'] = self.last_activity.isoformat()
+        return data
+
+
+def _metric_property(metric: int) -> property:
+    def getter(self: ChannelStats) -> int:
+        return self._table.counters[self.slot * NUM_METRICS + metric]
+
+    def setter(self: ChannelStats, value: int):
+        self._table.set(self, metric, value)
+
+    return property(getter, setter)
+
+
+for _metric, _name in enumerate(METRIC_NAMES):
+    setattr(ChannelStats, _name, _metric_property(_metric))
+
+
+class StatsTable:
+    """Статистика всех каналов в одном массиве int64: строка на чат, столбец на метрику.
+
+    Инкремент счетчика не создает объектов. Общие суммы (totals) поддерживаются
+    при каждом изменении счетчика и являются основным источником итогов для отчетов;
+    column_sum и verify_totals используются для проверки их согласованности.
+    Для каждой метрики запоминаются каналы с ненулевым значением, чтобы отчеты
+    перебирали только активные каналы. Измененные каналы копятся до take_dirty(),
+    чтобы хранилище записывало только их; on_change вызывается при каждом изменении
+    счетчика (для политики сохранения). Версия строки растет при каждом изменении
+    канала, поэтому по ней можно понять, что готовый фрагмент отчета устарел.
+    """
+
+    def __init__(self):
+        self.counters = array('q')
+        self.activity = array('d')  # время последней активности (unix time) по строкам
+        self.versions = array('q')  # версия строки, растет при каждом изменении канала
+        self.totals = array('q', _ZERO_ROW)  # суммы по всем каналам
+        self._channels: Dict[str, ChannelStats] = {}
+        self._active: List[Dict[str, ChannelStats]] = [{} for _ in range(NUM_METRICS)]
+        self._dirty: Dict[str, ChannelStats] = {}  # каналы, измененные после последнего сохранения
+        self.on_change: Optional[Callable[[], None]] = None
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def __contains__(self, chat_id: str) -> bool:
+        return chat_id in self._channels
+
+    def __getitem__(self, chat_id: str) -> ChannelStats:
+        return self._channels[chat_id]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._channels)
+
+    def get(self, chat_id: str) -> Optional[ChannelStats]:
+        return self._channels.get(chat_id)
+
+    def items(self) -> Iterator[Tuple[str, ChannelStats]]:
+        return iter(self._channels.items())
+
+    def values(self) -> Iterator[ChannelStats]:
+        return iter(self._channels.values())
+
+    def create(self, chat_id: str, title: str) -> ChannelStats:
+        """Добавляет строку для нового канала"""
+        slot = len(self.activity)
+        self.counters.extend(_ZERO_ROW)
+        self.activity.append(time.time())
+        self.versions.append(0)
+        stats = ChannelStats(self, chat_id, title, slot)
+        self._channels[chat_id] = stats
+        self._dirty[chat_id] = stats
+        return stats
+
+    def increment(self, stats: ChannelStats, metric: int, value: int = 1):
+        """Увеличивает счетчик канала и общую сумму, отмечает активность"""
+        self.counters[stats.slot * NUM_METRICS + metric] += value
+        self.totals[metric] += value
+        self.activity[stats.slot] = time.time()
+        self.versions[stats.slot] += 1
+        self._active[metric][stats.chat_id] = stats
+        self._dirty[stats.chat_id] = stats
+        if self.on_change is not None:
+            self.on_change()
+
+    def set(self, stats: ChannelStats, metric: int, value: int):
+        """Устанавливает значение счетчика канала, поддерживая общую сумму"""
+        index = stats.slot * NUM_METRICS + metric
+        self.totals[metric] += value - self.counters[index]
+        self.counters[index] = value
+        self.versions[stats.slot] += 1
+        if value:
+            self._active[metric][stats.chat_id] = stats
+        self._dirty[stats.chat_id] = stats
+        if self.on_change is not None:
+            self.on_change()
+
+    def mark_dirty(self, stats: ChannelStats):
+        self.versions[stats.slot] += 1
+        self._dirty[stats.chat_id] = stats
+
+    def take_dirty(self) -> List[ChannelStats]:
+        """Возвращает каналы, измененные после прошлого вызова, и сбрасывает отметки"""
+        dirty = list(self._dirty.values())
+        self._dirty.clear()
+        return dirty
+
+    def active_channels(self, *metrics: int) -> List[ChannelStats]:
+        """Каналы с ненулевым значением хотя бы одной из метрик (в порядке добавления)"""
+        candidates: Dict[str, ChannelStats] = {}
+        for metric in metrics:
+            candidates.update(self._active[metric])
+        active = [stats for stats in candidates.values() if any(stats[metric] for metric in metrics)]
+        active.sort(key=lambda stats: stats.slot)
+        return active
+
+    def copy(self) -> 'StatsTable':
+        """Независимая копия таблицы (снимок для записи в другом потоке)"""
+        table = StatsTable()
+        table.counters = array('q', self.counters)
+        table.activity = array('d', self.activity)
+        table.versions = array('q', self.versions)
+        table.totals = array('q', self.totals)
+        for chat_id, stats in self._channels.items():
+            table._channels[chat_id] = ChannelStats(table, chat_id, stats.title, stats.slot)
+        return table
+
+    def column_sum(self, metric: int) -> int:
+        """Сумма метрики по всем каналам"""
+        return sum(self.counters[metric::NUM_METRICS])
+
+    def load_channel(self, chat_id: str, data: Dict) -> ChannelStats:
+        """Восстанавливает канал из словаря, сохраненного to_dict()"""
+        stats = self.create(chat_id, data.get('title') or f"Чат {chat_id}")
+        for metric, name in enumerate(METRIC_NAMES):
+            stats[metric] = int(data.get(name, 0) or 0)
+
+        last_activity = data.get('last_activity')
+        if isinstance(last_activity, str):
+            try:
+                stats.last_activity = datetime.fromisoformat(last_activity)
+            except ValueError:
+                pass
+        return stats
+
+    def verify_totals(self) -> Dict[str, Tuple[int, int]]:
+        """Сверяет общие суммы с суммами по каналам и исправляет расхождения.
+
+        Возвращает {метрика: (было, стало)} для исправленных сумм.
+        """
+        mismatches = {}
+        for metric, name in enumerate(METRIC_NAMES):
+            actual = self.column_sum(metric)
+            if self.totals[metric] != actual:
+                mismatches[name] = (self.totals[metric], actual)
+                self.totals[metric] = actual
+        return mismatches
+
+    def totals_dict(self) -> Dict[str, int]:
+        """Общие суммы в виде словаря (формат global_stats в bot_stats.json)"""
+        return {name: self.totals[metric] for metric, name in enumerate(METRIC_NAMES)}
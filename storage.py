@@ -0,0 +1,401 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from stats import METRIC_NAMES, ChannelStats, StatsTable
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(Exception):
+    """Снимок статистики поврежден или не читается"""
+
+
+class StatsStorage:
+    """Хранилище статистики каналов и состояния бота.
+
+    load() заполняет StatsTable и возвращает состояние бота (tracked_groups,
+    report_windows и т.п.). Запись делится на две части: snapshot() быстро
+    копирует нужные данные в потоке бота, write() записывает копию в отдельном
+    потоке хранилища, поэтому файловые операции не блокируют обработку обновлений.
+    Все записи выполняются по очереди в одном потоке.
+
+    FLUSH_INTERVAL и FLUSH_EVENTS - настройки WriteBehind по умолчанию для хранилища.
+    """
+
+    FLUSH_INTERVAL = 5
+    FLUSH_EVENTS = 1000
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stats-writer')
+
+    def load(self, table: StatsTable) -> Dict:
+        raise NotImplementedError
+
+    def snapshot(self, table: StatsTable, changed: Iterable[ChannelStats], state: Dict) -> Any:
+        raise NotImplementedError
+
+    def write(self, payload: Any):
+        raise NotImplementedError
+
+    async def save_async(self, table: StatsTable, changed: Iterable[ChannelStats], state: Dict):
+        """Сохраняет изменения в потоке хранилища, не блокируя цикл событий"""
+        payload = self.snapshot(table, changed, state)
+        await self.run_async(self.write, payload)
+
+    async def run_async(self, func: Callable[..., Any], *args) -> Any:
+        """Выполняет func в потоке хранилища (по очереди с записями статистики)"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def save(self, table: StatsTable, changed: Iterable[ChannelStats], state: Dict):
+        """Синхронное сохранение (обработчик сигнала, утилиты) - в том же потоке записи"""
+        payload = self.snapshot(table, changed, state)
+        self._executor.submit(self.write, payload).result()
+
+    def close(self):
+        """Дожидается завершения записей"""
+        self._executor.shutdown(wait=True)
+
+
+def _checksum(stats_data: Dict) -> str:
+    body = json.dumps(stats_data, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def write_snapshot(path: str, stats_data: Dict, generations: int = 0):
+    """Атомарно записывает JSON-снимок с контрольной суммой.
+
+    Данные пишутся во временный файл, сбрасываются на диск (fsync) и
+    переименовываются поверх основного файла. Предыдущие версии сохраняются
+    как path.1 ... path.N (N = generations).
+    """
+    stats_data = dict(stats_data, checksum=_checksum(stats_data))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(stats_data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if generations > 0 and os.path.exists(path):
+        for generation in range(generations - 1, 0, -1):
+            older = f"{path}.{generation}"
+            if os.path.exists(older):
+                os.replace(older, f"{path}.{generation + 1}")
+        os.replace(path, f"{path}.1")
+    os.replace(tmp_path, path)
+
+    # Переименование тоже должно попасть на диск
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def read_snapshot(path: str) -> Dict:
+    """Читает JSON-снимок и проверяет контрольную сумму (если она есть)"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            stats_data = json.load(f)
+    except ValueError as e:
+        raise SnapshotError(f"{path}: {e}") from e
+    if not isinstance(stats_data, dict):
+        raise SnapshotError(f"{path}: неожиданный формат")
+
+    checksum = stats_data.pop('checksum', None)
+    # Файлы старого формата без контрольной суммы принимаются как есть
+    if checksum is not None and checksum != _checksum(stats_data):
+        raise SnapshotError(f"{path}: контрольная сумма не совпадает")
+    return stats_data
+
+
+def read_latest_snapshot(path: str, generations: int = 0) -> Optional[Dict]:
+    """Читает самый свежий целый снимок: основной файл, затем path.1 ... path.N.
+
+    Возвращает None, если снимков нет. Если снимки есть, но все повреждены,
+    выбрасывает SnapshotError.
+    """
+    errors = []
+    for candidate in [path] + [f"{path}.{generation}" for generation in range(1, generations + 1)]:
+        try:
+            stats_data = read_snapshot(candidate)
+        except FileNotFoundError:
+            continue
+        except (OSError, SnapshotError) as e:
+            logger.error(f"❌ Снимок статистики поврежден: {e}")
+            errors.append(str(e))
+            continue
+        if errors:
+            logger.warning(f"⚠️ Статистика восстановлена из предыдущей версии {candidate}")
+        return stats_data
+    if errors:
+        raise SnapshotError("; ".join(errors))
+    return None
+
+
+def export_json(table: StatsTable, state: Dict, path: str, generations: int = 0):
+    """Выгружает статистику в JSON (формат bot_stats.json)"""
+    stats_data = {
+        'channel_stats': {chat_id: stats.to_dict() for chat_id, stats in table.items()},
+        'global_stats': table.totals_dict(),
+        **state,
+        'last_saved': datetime.now().isoformat()
+    }
+    write_snapshot(path, stats_data, generations)
+
+
+def load_json_data(table: StatsTable, stats_data: Dict) -> Dict:
+    """Загружает каналы из словаря формата bot_stats.json, возвращает остальное состояние бота.
+
+    Глобальные суммы не читаются - они пересчитываются по каналам.
+    """
+    stats_data = dict(stats_data)
+    for chat_id, stats in stats_data.pop('channel_stats', {}).items():
+        table.load_channel(chat_id, stats)
+    stats_data.pop('global_stats', None)
+    stats_data.pop('last_saved', None)
+    return stats_data
+
+
+def import_json(table: StatsTable, path: str, generations: int = 0) -> Dict:
+    """Загружает статистику из JSON в таблицу, возвращает остальное состояние бота"""
+    stats_data = read_latest_snapshot(path, generations)
+    if stats_data is None:
+        raise FileNotFoundError(path)
+    return load_json_data(table, stats_data)
+
+
+class JsonStorage(StatsStorage):
+    """Прежний формат: весь файл перезаписывается при каждом сохранении.
+
+    Файл пишется атомарно, generations предыдущих версий хранятся рядом и
+    используются при загрузке, если основной файл поврежден. Версии сдвигаются
+    не чаще раза в rotate_interval секунд, поэтому они охватывают часы, а не
+    несколько последних сохранений. Так как каждое сохранение переписывает
+    весь файл, сохранять его приходится реже, чем SQLite.
+    """
+
+    FLUSH_INTERVAL = 300
+    FLUSH_EVENTS = 50000
+
+    def __init__(self, path: str = 'bot_stats.json', generations: int = 3, rotate_interval: float = 3600):
+        super().__init__()
+        self.path = path
+        self.generations = generations
+        self.rotate_interval = rotate_interval
+        self._rotated_at: Optional[float] = None
+
+    def load(self, table: StatsTable) -> Dict:
+        try:
+            return import_json(table, self.path, self.generations)
+        except FileNotFoundError:
+            return {}
+
+    def snapshot(self, table: StatsTable, changed: Iterable[ChannelStats], state: Dict):
+        # Копия таблицы, сериализация в JSON - уже в потоке записи
+        return table.copy(), json.loads(json.dumps(state))
+
+    def write(self, payload):
+        table, state = payload
+        # Между сдвигами версий перезаписывается только основной файл
+        now = time.monotonic()
+        generations = 0
+        if self._rotated_at is None or now - self._rotated_at >= self.rotate_interval:
+            generations = self.generations
+            self._rotated_at = now
+        export_json(table, state, self.path, generations)
+
+
+class SqliteStorage(StatsStorage):
+    """SQLite в режиме WAL: строка на канал, сохраняются только измененные каналы.
+
+    Все изменения одного сохранения записываются одной транзакцией. Если база
+    пустая, а рядом лежит bot_stats.json, статистика из него импортируется.
+    """
+
+    def __init__(self, path: str = 'bot_stats.db', legacy_json: Optional[str] = 'bot_stats.json'):
+        super().__init__()
+        self.path = path
+        self.legacy_json = legacy_json
+        # Соединение используется потоком бота при загрузке и потоком записи после нее
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+        columns = ', '.join(METRIC_NAMES)
+        placeholders = ', '.join('?' for _ in METRIC_NAMES)
+        updates = ', '.join(f"{name} = excluded.{name}" for name in METRIC_NAMES)
+        self._upsert_channel = (
+            f"INSERT INTO channels (chat_id, title, {columns}, last_activity) VALUES (?, ?, {placeholders}, ?) "
+            f"ON CONFLICT(chat_id) DO UPDATE SET title = excluded.title, {updates}, last_activity = excluded.last_activity"
+        )
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS channels (chat_id TEXT PRIMARY KEY, title TEXT NOT NULL, last_activity REAL)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            # Новые метрики добавляются столбцами к существующей таблице
+            existing = {row[1] for row in self.conn.execute("PRAGMA table_info(channels)")}
+            for name in METRIC_NAMES:
+                if name not in existing:
+                    self.conn.execute(f"ALTER TABLE channels ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0")
+
+    def load(self, table: StatsTable) -> Dict:
+        check = self.conn.execute("PRAGMA quick_check").fetchone()[0]
+        if check != 'ok':
+            logger.error(f"❌ База статистики {self.path} повреждена: {check}")
+
+        has_rows = self.conn.execute("SELECT 1 FROM channels LIMIT 1").fetchone() is not None
+        has_state = self.conn.execute("SELECT 1 FROM state LIMIT 1").fetchone() is not None
+        if not has_rows and not has_state:
+            return self._import_legacy(table)
+
+        columns = ', '.join(METRIC_NAMES)
+        cursor = self.conn.execute(f"SELECT chat_id, title, last_activity, {columns} FROM channels ORDER BY rowid")
+        for row in cursor:
+            stats = table.create(row[0], row[1])
+            for metric, value in enumerate(row[3:]):
+                if value:
+                    stats[metric] = value
+            if row[2] is not None:
+                table.activity[stats.slot] = row[2]
+
+        return {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM state")}
+
+    def _import_legacy(self, table: StatsTable) -> Dict:
+        if not self.legacy_json or not os.path.exists(self.legacy_json):
+            return {}
+        state = import_json(table, self.legacy_json)
+        self.save(table, table.values(), state)
+        logger.info(f"Статистика импортирована из {self.legacy_json} в {self.path}: {len(table)} каналов")
+        return state
+
+    def snapshot(self, table: StatsTable, changed: Iterable[ChannelStats], state: Dict):
+        rows = [
+            (stats.chat_id, stats.title, *(stats[metric] for metric in range(len(METRIC_NAMES))),
+             table.activity[stats.slot])
+            for stats in changed
+        ]
+        return rows, [(key, json.dumps(value, ensure_ascii=False)) for key, value in state.items()]
+
+    def write(self, payload):
+        rows, state_rows = payload
+        with self.conn:
+            if rows:
+                self.conn.executemany(self._upsert_channel, rows)
+            self.conn.executemany(
+                "INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                state_rows
+            )
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+
+class WriteBehind:
+    """Отложенное сохранение статистики.
+
+    Изменения копятся в памяти и сохраняются не реже чем раз в interval секунд
+    или сразу после max_events изменений - что наступит раньше. Если изменений
+    не было, сохранение пропускается.
+    """
+
+    def __init__(self, flush: Callable[[], Awaitable[None]], interval: float = 5, max_events: int = 1000):
+        self.flush = flush
+        self.interval = interval
+        self.max_events = max_events
+        self.pending_events = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def notify(self, events: int = 1):
+        """Отмечает изменения; при достижении max_events сохранение запускается сразу"""
+        self.pending_events += events
+        if self.pending_events >= self.max_events and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self.pending_events:
+                continue
+            self.pending_events = 0
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка отложенного сохранения статистики: {e}")
+
+    async def stop(self):
+        """Останавливает фоновое сохранение и сохраняет оставшиеся изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.pending_events = 0
+        await self.flush()
+
+
+def create_storage(config: Dict) -> StatsStorage:
+    """Создает хранилище по настройке storage_backend ("sqlite" или "json")"""
+    backend = config.get("storage_backend", "sqlite")
+    stats_file = config.get("stats_file", "bot_stats.json")
+    if backend == "json":
+        return JsonStorage(stats_file, config.get("stats_snapshot_generations", 3),
+                           config.get("stats_snapshot_rotate_interval", 3600))
+    if backend == "sqlite":
+        return SqliteStorage(config.get("stats_db_file", "bot_stats.db"), legacy_json=stats_file)
+    raise ValueError(f"Неизвестное хранилище статистики: {backend}")
+
+
+def main():
+    """Импорт/экспорт: python storage.py export|import bot_stats.db bot_stats.json"""
+    if len(sys.argv) != 4 or sys.argv[1] not in ('export', 'import'):
+        print(main.__doc__)
+        return 1
+
+    command, db_path, json_path = sys.argv[1:]
+    table = StatsTable()
+    storage = SqliteStorage(db_path, legacy_json=None)
+    if command == 'export':
+        state = storage.load(table)
+        export_json(table, state, json_path)
+        print(f"✅ Выгружено {len(table)} каналов в {json_path}")
+    else:
+        state = import_json(table, json_path)
+        storage.save(table, table.values(), state)
+        print(f"✅ Загружено {len(table)} каналов в {db_path}")
+    storage.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
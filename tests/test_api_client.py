@@ -0,0 +1,91 @@
+import asyncio
+from typing import Optional
+
+import pytest
+
+from api_client import ApiCallMonitor, api_feature
+from metrics import MetricsRegistry
+
+
+class FakeEndpoint:
+    """Отвечает через delay секунд и считает вызовы"""
+
+    def __init__(self, delay: float = 0.02, error: Optional[Exception] = None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self, chat_id):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return {'id': chat_id, 'call': self.calls}
+
+
+def request(monitor, endpoint, method, chat_id):
+    return monitor.process_request(endpoint, (chat_id,), {}, method, {'chat_id': chat_id}, None)
+
+
+def test_identical_read_requests_share_one_call():
+    monitor = ApiCallMonitor(MetricsRegistry())
+    endpoint = FakeEndpoint()
+
+    @api_feature('stats')
+    async def read(chat_id):
+        return await request(monitor, endpoint, 'getChat', chat_id)
+
+    async def main():
+        return await asyncio.gather(read(-1), read(-1), read(-1), read(-2))
+
+    results = asyncio.run(main())
+    assert endpoint.calls == 2
+    assert results[0] is results[1] is results[2]
+    assert results[3]['id'] == -2
+    rows = {row['method']: row for row in monitor.summary()}
+    assert rows['getChat']['calls'] == 2
+    assert rows['getChat']['shared'] == 2
+    assert rows['getChat']['feature'] == 'stats'
+
+
+def test_write_requests_are_not_shared():
+    monitor = ApiCallMonitor(MetricsRegistry())
+    endpoint = FakeEndpoint()
+
+    async def main():
+        await asyncio.gather(*(request(monitor, endpoint, 'sendMessage', -1) for _ in range(3)))
+
+    asyncio.run(main())
+    assert endpoint.calls == 3
+
+
+def test_cancelled_caller_does_not_cancel_shared_request():
+    monitor = ApiCallMonitor(MetricsRegistry())
+    endpoint = FakeEndpoint(delay=0.05)
+
+    async def main():
+        first = asyncio.ensure_future(request(monitor, endpoint, 'getChat', -1))
+        second = asyncio.ensure_future(request(monitor, endpoint, 'getChat', -1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main())['id'] == -1
+    assert endpoint.calls == 1
+
+
+def test_shared_error_reaches_every_caller():
+    monitor = ApiCallMonitor(MetricsRegistry())
+    endpoint = FakeEndpoint(error=ValueError('boom'))
+
+    async def main():
+        results = await asyncio.gather(*(request(monitor, endpoint, 'getChat', -1) for _ in range(2)),
+                                       return_exceptions=True)
+        # Следующий запрос после ошибки снова идет в API
+        with pytest.raises(ValueError):
+            await request(monitor, endpoint, 'getChat', -1)
+        return results
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert endpoint.calls == 2
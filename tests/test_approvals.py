@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from approvals import ApprovalScheduler, ApprovalWorker, PendingRequests
+from rate_limit import TokenBucket
+
+
+def reload(path) -> ApprovalScheduler:
+    scheduler = ApprovalScheduler(str(path))
+    scheduler.load()
+    return scheduler
+
+
+def test_journal_replay_skips_truncated_record(tmp_path):
+    path = tmp_path / 'journal'
+    scheduler = reload(path)
+    scheduler.schedule(-1, 1, 100)
+    scheduler.schedule(-2, 3, 100)
+    scheduler.schedule(-1, 2, 0)
+    scheduler.complete(scheduler.pop_due(time.time() + 1))
+    asyncio.run(scheduler.stop())
+
+    # Аварийное завершение посреди записи
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('A 17000')
+
+    restored = reload(path)
+    assert sorted(restored.keys()) == [(-2, 3), (-1, 1)]
+    # После загрузки журнал переписан без мусора
+    assert sorted(reload(path).keys()) == [(-2, 3), (-1, 1)]
+
+
+def test_journal_replay_keeps_latest_schedule(tmp_path):
+    path = tmp_path / 'journal'
+    scheduler = reload(path)
+    scheduler.schedule(-1, 1, 100)
+    scheduler.schedule(-1, 1, 1000)
+    asyncio.run(scheduler.stop())
+
+    restored = reload(path)
+    assert restored.keys() == [(-1, 1)]
+    now = time.time()
+    assert restored.pop_due(now + 500) == []
+    assert restored.pop_due(now + 1500) == [(-1, 1)]
+
+
+def test_pop_due_skips_stale_heap_entries(tmp_path):
+    scheduler = reload(tmp_path / 'journal')
+    scheduler.schedule(-1, 1, 10)
+    scheduler.schedule(-1, 1, 0)
+    scheduler.schedule(-1, 2, 5)
+
+    due = scheduler.pop_due(time.time() + 20)
+    assert sorted(due) == [(-1, 1), (-1, 2)]
+    assert scheduler.pop_due(time.time() + 20) == []
+    assert len(scheduler) == 0
+
+
+def test_rescheduled_in_flight_request_survives_complete(tmp_path):
+    path = tmp_path / 'journal'
+    scheduler = reload(path)
+    scheduler.schedule(-1, 1, 0)
+    due = scheduler.pop_due(time.time() + 1)
+    scheduler.schedule(-1, 1, 60)
+    scheduler.complete(due)
+    asyncio.run(scheduler.stop())
+
+    assert reload(path).keys() == [(-1, 1)]
+
+
+def test_compaction_keeps_pending_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(ApprovalScheduler, 'COMPACT_THRESHOLD', 10)
+    path = tmp_path / 'journal'
+    scheduler = reload(path)
+    scheduler.schedule(-1, 0, 100)
+    for user_id in range(1, 30):
+        scheduler.schedule(-1, user_id, 0)
+        scheduler.complete(scheduler.pop_due(time.time() + 1))
+    asyncio.run(scheduler.stop())
+
+    with open(path, encoding='utf-8') as f:
+        assert len(f.readlines()) < 20
+    assert reload(path).keys() == [(-1, 0)]
+
+
+def test_worker_reschedules_after_repeated_retry_after(tmp_path):
+    path = tmp_path / 'journal'
+    scheduler = reload(path)
+    approved = []
+
+    async def approve(chat_id, user_id):
+        if user_id == 2:
+            raise RetryAfter(0)
+        approved.append((chat_id, user_id))
+        return True
+
+    async def chat_done(chat_id, count):
+        approved.append(('done', chat_id, count))
+
+    async def main():
+        worker = ApprovalWorker(approve, chat_done, TokenBucket(1000), scheduler.schedule)
+        scheduler.schedule(-1, 1, 0)
+        scheduler.schedule(-1, 2, 0)
+        due = scheduler.pop_due(time.time() + 1)
+        await worker.process(due)
+        scheduler.complete(due)
+        await scheduler.stop()
+
+    asyncio.run(main())
+    assert approved == [(-1, 1), ('done', -1, 1)]
+    assert reload(path).keys() == [(-1, 2)]
+
+
+def test_pending_requests_indexes():
+    pending = PendingRequests()
+    pending.add(-1, 1, 'a')
+    pending.add(-1, 2, 'b')
+    pending.add(-2, 1, 'c')
+
+    assert pending.count_for_chat(-1) == 2
+    assert sorted(pending.chats_for_user(1)) == [-2, -1]
+    assert pending.pop(-1, 1)[1] == 'a'
+    assert pending.pop(-1, 1) is None
+    assert sorted(pending.users_in_chat(-1)) == [2]
+    assert len(pending) == 2
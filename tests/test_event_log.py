@@ -0,0 +1,112 @@
+import random
+import time
+
+from event_log import DAY, EVENT_LEFT, EVENT_REQUEST, HOUR, MINUTE, NUM_EVENTS, EventLog
+
+
+def brute_force(events, start, end):
+    start -= start % MINUTE
+    end -= end % MINUTE
+    result = {}
+    for ts, chat_id, event_type in events:
+        if start <= ts < end:
+            counts = result.setdefault(chat_id, [0] * NUM_EVENTS)
+            counts[event_type] += 1
+    return result
+
+
+def as_lists(counts_by_chat):
+    return {chat_id: list(counts) for chat_id, counts in counts_by_chat.items()}
+
+
+def fill(log, now, span, count, seed=1):
+    rng = random.Random(seed)
+    events = []
+    for i in range(count):
+        event = (now - span + i * span // count, -rng.randrange(1, 6), rng.randrange(NUM_EVENTS))
+        log.append(event[2], event[1], event[0])
+        events.append(event)
+    return events
+
+
+def test_query_matches_events_within_minute_retention(tmp_path):
+    now = int(time.time())
+    log = EventLog(str(tmp_path / 'events.log'))
+    events = fill(log, now, 2 * HOUR, 5000)
+
+    for start, end in [
+        (now - 2 * HOUR, now),
+        (now - 2 * HOUR + 59, now - 61),
+        (now - HOUR - HOUR // 2, now - HOUR // 2 + 7),
+        (now - 90, now - 30),
+    ]:
+        assert as_lists(log.query(start, end)) == brute_force(events, start, end)
+
+
+def test_query_uses_hour_and_day_buckets(tmp_path):
+    now = int(time.time())
+    log = EventLog(str(tmp_path / 'events.log'))
+    events = fill(log, now, 3 * DAY, 20000)
+
+    # Границы по часам и дням берутся целыми агрегатами
+    start = now - 3 * DAY
+    start -= start % DAY
+    end = now - now % HOUR
+    assert as_lists(log.query(start, end)) == brute_force(events, start, end)
+
+
+def test_totals_sum_all_chats(tmp_path):
+    log = EventLog(str(tmp_path / 'events.log'))
+    log.append(EVENT_REQUEST, -1, 1000)
+    log.append(EVENT_REQUEST, -2, 1000)
+    log.append(EVENT_LEFT, -2, 1000)
+    totals = EventLog.totals(log.query(960, 1080))
+    assert totals[EVENT_REQUEST] == 2
+    assert totals[EVENT_LEFT] == 1
+
+
+def test_compaction_and_reload_keep_counts(tmp_path):
+    path = str(tmp_path / 'events.log')
+    now = int(time.time())
+    log = EventLog(path)
+    fill(log, now, 2 * DAY, 20000)
+    start = now - 2 * DAY
+    start -= start % DAY
+    end = now - now % HOUR
+    before = as_lists(log.query(start, end))
+
+    compaction = log.compaction(now)
+    assert compaction is not None
+    compaction()
+    # Событие во время сжатия не теряется
+    log.append(EVENT_REQUEST, -1, now)
+    log.close()
+    assert log.compaction(now) is None
+
+    restored = EventLog(path)
+    restored.load()
+    assert as_lists(restored.query(start, end)) == before
+    assert restored.query(now - now % MINUTE, now + MINUTE)[-1][EVENT_REQUEST] >= 1
+
+
+def test_torn_record_is_truncated_before_new_events(tmp_path):
+    path = str(tmp_path / 'events.log')
+    now = int(time.time())
+    log = EventLog(path)
+    log.append(EVENT_REQUEST, -1, now)
+    log.close()
+    # Аварийное завершение посреди записи
+    with open(path, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+
+    for _ in range(2):
+        log = EventLog(path)
+        log.load()
+        log.append(EVENT_LEFT, -1, now)
+        log.close()
+
+    counts = EventLog(path)
+    counts.load()
+    totals = EventLog.totals(counts.query(now - now % MINUTE, now + MINUTE))
+    assert totals[EVENT_REQUEST] == 1
+    assert totals[EVENT_LEFT] == 2
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+from ingress import UpdateIngress
+
+
+def make_update(update_id: int, chat_id: int, text: str = 'hi') -> Update:
+    chat = Chat(chat_id, Chat.SUPERGROUP)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, text=text))
+
+
+def test_updates_of_one_chat_run_in_order():
+    log = []
+
+    async def handle(name, delay):
+        log.append(('start', name))
+        await asyncio.sleep(delay)
+        log.append(('end', name))
+
+    async def main():
+        ingress = UpdateIngress(concurrency=8)
+        await ingress.initialize()
+        # Первое обновление чата -1 самое долгое: остальные обновления чата ждут его
+        await ingress.do_process_update(make_update(1, -1), handle('a1', 0.05))
+        await ingress.do_process_update(make_update(2, -2), handle('b1', 0.01))
+        await ingress.do_process_update(make_update(3, -1), handle('a2', 0.0))
+        await ingress.do_process_update(make_update(4, -1), handle('a3', 0.0))
+        await ingress.shutdown()
+        assert ingress.processed == 4
+
+    asyncio.run(main())
+    chat_a = [entry for entry in log if entry[1].startswith('a')]
+    assert chat_a == [('start', 'a1'), ('end', 'a1'), ('start', 'a2'), ('end', 'a2'), ('start', 'a3'), ('end', 'a3')]
+    # Другой чат не ждал чат -1
+    assert log.index(('end', 'b1')) < log.index(('end', 'a1'))
+
+
+def test_free_slot_goes_to_highest_priority():
+    order = []
+    release = None
+
+    async def blocker():
+        await release.wait()
+
+    async def handle(name):
+        order.append(name)
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        ingress = UpdateIngress(concurrency=1)
+        await ingress.initialize()
+        await ingress.do_process_update(make_update(1, -1), blocker())
+        await asyncio.sleep(0)
+        await ingress.do_process_update(make_update(2, -2, 'hello'), handle('message'))
+        await ingress.do_process_update(make_update(3, -3, '/stats'), handle('command'))
+        await ingress.do_process_update(object(), handle('join_request'))
+        await asyncio.sleep(0)
+        release.set()
+        await ingress.shutdown()
+
+    asyncio.run(main())
+    assert order == ['join_request', 'command', 'message']
+
+
+def test_shutdown_cancels_updates_after_timeout():
+    cancelled = []
+
+    async def hang():
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        ingress = UpdateIngress(concurrency=2, shutdown_timeout=0.05)
+        await ingress.initialize()
+        await ingress.do_process_update(make_update(1, -1), hang())
+        await asyncio.wait_for(ingress.shutdown(), 5)
+        assert ingress.depth == 0
+
+    asyncio.run(main())
+    assert cancelled == [True]
+
+
+def test_drain_waits_for_accepted_updates():
+    done = []
+
+    async def handle(name):
+        await asyncio.sleep(0.02)
+        done.append(name)
+
+    async def main():
+        ingress = UpdateIngress(concurrency=1)
+        await ingress.initialize()
+        await ingress.do_process_update(make_update(1, -1), handle('first'))
+        await ingress.do_process_update(make_update(2, -1), handle('second'))
+        await asyncio.wait_for(ingress.drain(), 5)
+        assert done == ['first', 'second']
+        assert ingress.depth == 0
+        await ingress.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+from member_counts import MemberCountTracker
+
+
+def test_drift_triggers_check():
+    tracker = MemberCountTracker(max_age=3600, drift_min=5, drift_ratio=0.1)
+    now = tracker._started
+    tracker.reconciled('-1', now)
+    assert not tracker.needs_check('-1', 100, now)
+    assert tracker.needs_check('-1', 0, now)
+
+    for delta in (1, -1, 1, 1, 1, 1, 1, -1, 1):
+        tracker.record_change('-1', delta)
+    assert tracker.drift('-1') == 9
+    assert not tracker.needs_check('-1', 100, now)
+    tracker.record_change('-1', -1)
+    assert tracker.needs_check('-1', 100, now)
+
+    tracker.reconciled('-1', now)
+    assert tracker.drift('-1') == 0
+
+
+def test_expected_joins_count_until_they_arrive():
+    tracker = MemberCountTracker(drift_min=3)
+    tracker.reconciled('-1')
+    tracker.expect_joins('-1', 3)
+    assert tracker.drift('-1') == 3
+    # Пришедшее вступление заменяет ожидаемое, расхождение не растет
+    tracker.record_change('-1', 2)
+    assert tracker.drift('-1') == 3
+    tracker.record_change('-1', 1)
+    assert tracker.drift('-1') == 3
+def test_quiet_chats_expire_later():
+    tracker = MemberCountTracker(max_age=3600)
+    now = tracker._started
+    tracker.reconciled('-1', now)
+    later = now + 2 * 3600
+    assert tracker.needs_check('-1', 100, later, idle=60)
+    assert not tracker.needs_check('-1', 100, later, idle=7200)
+    assert tracker.needs_check('-1', 100, now + 20 * 3600, idle=2 * 86400)
+
+
+def test_take_slots_catches_up_missed_ticks():
+    tracker = MemberCountTracker(interval=600, tick=60)
+    assert tracker.slots == 10
+    assert tracker.take_slots(6000) == {0}
+    assert tracker.take_slots(6030) == set()
+    assert tracker.take_slots(6180) == {1, 2, 3}
+    # После долгого простоя слоты проходятся не больше одного раза
+    assert tracker.take_slots(60000) == set(range(10))
+
+
+def test_due_checks_only_current_slots_in_priority_order():
+    tracker = MemberCountTracker(interval=600, tick=60, drift_min=1)
+    now = tracker._started
+    chats = [str(-chat) for chat in range(1, 200)]
+    slot = tracker.slot(chats[0])
+    in_slot = [chat_id for chat_id in chats if tracker.slot(chat_id) == slot]
+    assert len(in_slot) > 3
+    slightly_drifted, drifted, unknown = in_slot[:3]
+    for chat_id in chats:
+        tracker.reconciled(chat_id, now)
+    for _ in range(5):
+        tracker.record_change(drifted, 1)
+    tracker.record_change(slightly_drifted, 2)
+
+    # Тик слота этих чатов в следующем интервале; остальные чаты слота не менялись после сверки
+    tick = (int(now // 60) // 10 + 1) * 10 + slot
+    counts = {chat_id: 0 if chat_id == unknown else 100 for chat_id in chats}
+    due = tracker.due([(chat_id, counts[chat_id], now) for chat_id in chats], now=tick * 60)
+    assert due == [unknown, drifted, slightly_drifted]
@@ -0,0 +1,50 @@
+import asyncio
+
+from notifications import NotificationDigest
+
+
+def test_first_notice_goes_out_at_once_and_rest_are_batched():
+    sent = []
+
+    async def send(admin_id, text):
+        sent.append((admin_id, text))
+
+    async def main():
+        digest = NotificationDigest(send, window=0.05, max_users=2)
+        await digest.add(1, -1, 'Канал', 'u1', 'single u1')
+        for user in ('u2', 'u3', 'u4'):
+            await digest.add(1, -1, 'Канал', user, f'single {user}')
+        # Другой админ получает свое первое уведомление сразу
+        await digest.add(2, -1, 'Канал', 'u2', 'single u2')
+        assert sent == [(1, 'single u1'), (2, 'single u2')]
+        assert len(digest) == 1
+
+        await asyncio.sleep(0.1)
+        assert len(digest) == 0
+
+    asyncio.run(main())
+    assert len(sent) == 3
+    admin_id, text = sent[2]
+    assert admin_id == 1
+    assert "'Канал': 3" in text
+    assert '👤 u2' in text and '👤 u3' in text and 'u4' not in text
+    assert '… и еще 1' in text
+
+
+def test_flush_all_sends_pending_digests():
+    sent = []
+
+    async def send(admin_id, text):
+        sent.append(admin_id)
+
+    async def main():
+        digest = NotificationDigest(send, window=3600)
+        await digest.add(1, -1, 'Канал', 'u1', 'single')
+        await digest.add(1, -1, 'Канал', 'u2', 'single')
+        await digest.add(2, -2, 'Чат', 'u1', 'single')
+        await digest.add(2, -2, 'Чат', 'u3', 'single')
+        await digest.flush_all()
+        assert len(digest) == 0
+
+    asyncio.run(main())
+    assert sorted(sent) == [1, 1, 2, 2]
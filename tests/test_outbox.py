@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+from outbox import Outbox, OutboxClosed, PRIORITY_ADMIN_NOTICE, PRIORITY_STATS, PRIORITY_WELCOME
+
+
+class FakeBot:
+    """send_message отвечает RetryAfter столько раз, сколько указано для чата"""
+
+    def __init__(self, retry_after=None, delay: float = 0.0):
+        self.retry_after = dict(retry_after or {})
+        self.delay = delay
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.retry_after.get(chat_id):
+            self.retry_after[chat_id] -= 1
+            raise RetryAfter(0)
+        self.sent.append((chat_id, text))
+        return text
+
+
+def test_retry_after_requeues_message():
+    bot = FakeBot({1: 2})
+
+    async def main():
+        outbox = Outbox(global_rate=1000, per_chat_rate=1000)
+        outbox.start(bot)
+        result = await asyncio.wait_for(outbox.send_message(1, 'hello'), 5)
+        await outbox.stop()
+        return result
+
+    assert asyncio.run(main()) == 'hello'
+    assert bot.sent == [(1, 'hello')]
+
+
+def test_retry_after_fails_after_max_attempts():
+    bot = FakeBot({1: Outbox.MAX_ATTEMPTS})
+
+    async def main():
+        outbox = Outbox(global_rate=1000, per_chat_rate=1000)
+        outbox.start(bot)
+        try:
+            with pytest.raises(RetryAfter):
+                await asyncio.wait_for(outbox.send_message(1, 'hello'), 5)
+        finally:
+            await outbox.stop()
+
+    asyncio.run(main())
+    assert bot.sent == []
+
+
+def test_messages_go_out_by_priority():
+    bot = FakeBot()
+
+    async def main():
+        outbox = Outbox(global_rate=1000, per_chat_rate=1000)
+        futures = [
+            outbox.submit(1, PRIORITY_STATS, text='stats'),
+            outbox.submit(2, PRIORITY_ADMIN_NOTICE, text='notice'),
+            outbox.submit(3, PRIORITY_WELCOME, text='welcome'),
+        ]
+        outbox.start(bot)
+        await asyncio.wait_for(asyncio.gather(*futures), 5)
+        await outbox.stop()
+
+    asyncio.run(main())
+    assert [text for _, text in bot.sent] == ['welcome', 'notice', 'stats']
+
+
+def test_stop_fails_undelivered_messages():
+    bot = FakeBot(delay=3600)
+
+    async def main():
+        outbox = Outbox(global_rate=1000, per_chat_rate=1)
+        outbox.start(bot)
+        in_flight = outbox.submit(1, text='first')
+        queued = outbox.submit(1, text='second')
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(outbox.stop(timeout=0.1), 5)
+
+        for future in (in_flight, queued):
+            assert isinstance(future.exception(), OutboxClosed)
+        assert isinstance(outbox.submit(2, text='late').exception(), OutboxClosed)
+        assert len(outbox) == 0
+
+    asyncio.run(main())
+
+
+def test_groups_use_their_own_rate():
+    bot = FakeBot()
+
+    async def main():
+        outbox = Outbox(global_rate=1000, per_chat_rate=1000, group_rate=2)
+        outbox.start(bot)
+        for text in ('a', 'b'):
+            outbox.submit(-1, text=text)
+            outbox.submit(1, text=text)
+        await asyncio.sleep(0.2)
+        # В личный чат ушли оба сообщения, в группу - только первое
+        assert bot.sent.count((1, 'b')) == 1
+        assert (-1, 'b') not in bot.sent
+        await asyncio.wait_for(outbox.stop(), 5)
+
+    asyncio.run(main())
+    assert sorted(bot.sent) == [(-1, 'a'), (-1, 'b'), (1, 'a'), (1, 'b')]
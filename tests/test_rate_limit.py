@@ -0,0 +1,23 @@
+import time
+
+from rate_limit import TokenBucket
+
+
+def test_pause_blocks_and_refills_from_unblock_time(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    bucket = TokenBucket(rate=10, capacity=10)
+
+    bucket.pause(5)
+    assert not bucket.try_acquire()
+    assert bucket.wait_time() == 5
+
+    # Сразу после паузы ведро пустое, а не полное
+    now = 1005.0
+    assert not bucket.try_acquire()
+    assert bucket.wait_time() == 0.1
+    now = 1005.5
+    acquired = 0
+    while bucket.try_acquire():
+        acquired += 1
+    assert acquired == 5
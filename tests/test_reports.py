@@ -0,0 +1,27 @@
+from reports import paginate
+
+
+def test_single_page_has_no_number():
+    assert paginate("header", ["a", "b"]) == ["header\n\na\n\nb"]
+
+
+def test_pages_respect_limit_and_keep_order():
+    blocks = [f"block {i} " + "x" * 40 for i in range(30)]
+    pages = paginate("header", blocks, limit=300)
+
+    assert len(pages) > 1
+    assert all(len(page) <= 300 for page in pages)
+    assert all(page.endswith(f"📄 {number}/{len(pages)}") for number, page in enumerate(pages, 1))
+    text = "".join(pages)
+    positions = [text.index(block) for block in blocks]
+    assert positions == sorted(positions)
+    assert pages[0].startswith("header")
+
+
+def test_oversized_block_is_split_after_current_page():
+    pages = paginate("header", ["small", "y" * 700], limit=300)
+
+    assert pages[0].startswith("header\n\nsmall")
+    assert "y" not in pages[0]
+    assert all(len(page) <= 300 for page in pages)
+    assert sum(page.count("y") for page in pages) == 700
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from stats import TOTAL_APPROVED, TOTAL_REQUESTS, StatsTable
+from storage import JsonStorage, SnapshotError, SqliteStorage, WriteBehind, read_latest_snapshot, write_snapshot
+
+
+def test_sqlite_saves_only_changed_channels(tmp_path):
+    path = str(tmp_path / 'stats.db')
+    table = StatsTable()
+    first = table.create('-1', 'Первый')
+    second = table.create('-2', 'Второй')
+    table.increment(first, TOTAL_REQUESTS, 3)
+    table.increment(second, TOTAL_REQUESTS, 5)
+    storage = SqliteStorage(path, legacy_json=None)
+    storage.save(table, table.values(), {'tracked_groups': [-1, -2]})
+
+    table.increment(first, TOTAL_APPROVED, 2)
+    table.increment(second, TOTAL_APPROVED, 4)
+    # Сохраняется только первый канал
+    storage.save(table, [first], {'tracked_groups': [-1, -2]})
+    storage.close()
+
+    restored = StatsTable()
+    storage = SqliteStorage(path, legacy_json=None)
+    state = storage.load(restored)
+    storage.close()
+    assert state == {'tracked_groups': [-1, -2]}
+    assert restored['-1'].title == 'Первый'
+    assert (restored['-1'].total_requests, restored['-1'].total_approved) == (3, 2)
+    assert (restored['-2'].total_requests, restored['-2'].total_approved) == (5, 0)
+
+
+def test_corrupted_snapshot_falls_back_to_previous_generation(tmp_path):
+    path = str(tmp_path / 'stats.json')
+    write_snapshot(path, {'version': 1}, generations=2)
+    write_snapshot(path, {'version': 2}, generations=2)
+    assert read_latest_snapshot(path, 2) == {'version': 2}
+
+    # Содержимое подменено, контрольная сумма не сходится
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    data['version'] = 3
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    assert read_latest_snapshot(path, 2) == {'version': 1}
+
+    with open(f"{path}.1", 'w', encoding='utf-8') as f:
+        f.write('{"version": ')
+    with pytest.raises(SnapshotError):
+        read_latest_snapshot(path, 2)
+    assert read_latest_snapshot(str(tmp_path / 'missing.json'), 2) is None
+
+
+def test_json_storage_rotates_generations_once_per_interval(tmp_path, monkeypatch):
+    path = str(tmp_path / 'stats.json')
+    now = 1000.0
+    monkeypatch.setattr('storage.time.monotonic', lambda: now)
+    storage = JsonStorage(path, generations=2, rotate_interval=3600)
+    table = StatsTable()
+    stats = table.create('-1', 'Канал')
+
+    for value in range(1, 4):
+        table.increment(stats, TOTAL_REQUESTS)
+        storage.save(table, [], {'saved': value})
+    # Первая запись создала файл, дальше до конца интервала переписывается только он
+    assert not os.path.exists(f"{path}.1")
+    assert read_latest_snapshot(path)['saved'] == 3
+
+    now += 3600
+    storage.save(table, [], {'saved': 4})
+    storage.close()
+    assert read_latest_snapshot(path)['saved'] == 4
+    assert read_latest_snapshot(f"{path}.1")['saved'] == 3
+
+
+def test_write_behind_flushes_by_count_and_on_stop():
+    flushes = []
+
+    async def flush():
+        flushes.append(True)
+
+    async def main():
+        write_behind = WriteBehind(flush, interval=3600, max_events=3)
+        write_behind.start()
+        write_behind.notify(2)
+        await asyncio.sleep(0.01)
+        assert flushes == []
+        write_behind.notify()
+        await asyncio.sleep(0.01)
+        assert len(flushes) == 1
+        write_behind.notify()
+        await write_behind.stop()
+        assert len(flushes) == 2
+        assert write_behind.pending_events == 0
+
+    asyncio.run(main())
+
+
+def test_write_behind_skips_interval_without_changes():
+    flushes = []
+
+    async def flush():
+        flushes.append(True)
+
+    async def main():
+        write_behind = WriteBehind(flush, interval=0.01, max_events=1000)
+        write_behind.start()
+        await asyncio.sleep(0.05)
+        assert flushes == []
+        write_behind.notify()
+        await asyncio.sleep(0.05)
+        assert len(flushes) == 1
+        await write_behind.stop()
+
+    asyncio.run(main())
@@ -22,7 +22,7 @@ def set_webhook(token, webhook_url):
     url = f"https://api.telegram.org/bot{token}/setWebhook"
     data = {
         'url': webhook_url,
-        'allowed_updates': ['message', 'chat_join_request', 'chat_member']
+        'allowed_updates': ['message', 'chat_join_request', 'chat_member', 'my_chat_member']
     }
     response = requests.post(url, data=data)
     return response.json()
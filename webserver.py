@@ -0,0 +1,92 @@
+import hmac
+import json
+import logging
+from typing import Optional
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class _WebhookHandler(tornado.web.RequestHandler):
+    """Принимает обновления Telegram и ставит их в очередь приложения"""
+
+    def initialize(self, telegram_app: Application, secret_token: Optional[str]):
+        self.telegram_app = telegram_app
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token is not None:
+            received = self.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        update = Update.de_json(data, self.telegram_app.bot)
+        if update is not None:
+            # Очередь ограничена: пока она заполнена, Telegram ждет ответа
+            await self.telegram_app.update_queue.put(update)
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, tornado.web.HTTPError):
+            logger.error(f"Ошибка обработки webhook: {value}")
+
+
+class _MetricsHandler(tornado.web.RequestHandler):
+    """Метрики Prometheus - только с заголовком Authorization: Bearer <token>"""
+
+    def initialize(self, metrics: MetricsRegistry, token: str):
+        self.metrics = metrics
+        self.token = token
+
+    def get(self):
+        received = self.request.headers.get('Authorization', '')
+        if not hmac.compare_digest(received.encode(), f"Bearer {self.token}".encode()):
+            self.set_header('WWW-Authenticate', 'Bearer')
+            raise tornado.web.HTTPError(401)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.metrics.render())
+
+
+class _HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({'status': 'ok'})
+
+
+class WebhookServer:
+    """HTTP-сервер бота: webhook Telegram, /metrics для Prometheus и /health на одном порту.
+
+    Порт webhook публичный, поэтому /metrics включается только вместе с
+    metrics_token и отдается лишь запросам с этим токеном.
+    """
+
+    def __init__(self, application: Application, url_path: str, metrics: MetricsRegistry,
+                 secret_token: Optional[str] = None, metrics_token: Optional[str] = None):
+        handlers = [
+            (url_path, _WebhookHandler, {'telegram_app': application, 'secret_token': secret_token}),
+            (r'/health', _HealthHandler),
+        ]
+        if metrics_token:
+            handlers.append((r'/metrics', _MetricsHandler, {'metrics': metrics, 'token': metrics_token}))
+        self.app = tornado.web.Application(handlers, log_function=lambda handler: None)
+        self.server: Optional[HTTPServer] = None
+
+    def start(self, listen: str, port: int):
+        self.server = HTTPServer(self.app, xheaders=True)
+        self.server.listen(port, listen)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            await self.server.close_all_connections()
+            self.server = None